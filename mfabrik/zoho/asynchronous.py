@@ -0,0 +1,119 @@
+"""
+
+    Non-blocking Zoho API clients.
+
+    AsyncCRM and AsyncSupport have the same methods as L{mfabrik.zoho.crm.CRM}
+    and L{mfabrik.zoho.support.SUPPORT}, but the calls return immediately
+    with a L{mfabrik.zoho.workers.Future}. The HTTP calls are run in a
+    bounded worker pool, so the calling thread (e.g. an event loop)
+    never blocks on the network.
+
+    Example::
+
+        crm = AsyncCRM(authtoken="authtoken", scope="crmapi", max_concurrency=20)
+
+        futures = [crm.get_record_by_id(id) for id in ids]
+
+        # Either wait for the results...
+        records = [future.result() for future in futures]
+
+        # ...or get a callback when each one completes
+        futures[0].add_done_callback(lambda future: handle(future.result()))
+
+"""
+
+__copyright__ = "2010 mFabrik Research Oy"
+__author__ = "Mikko Ohtamaa <mikko@mfabrik.com>"
+__license__ = "GPL"
+__docformat__ = "Epytext"
+
+from crm import CRM
+from pool import ConnectionPool
+from support import SUPPORT
+from workers import WorkerPool
+
+
+class AsyncConnection(object):
+    """ Run the calls of a wrapped Zoho connection in background threads.
+
+    Absract base class. Subclasses set connection_class.
+    """
+
+    connection_class = None
+
+    def __init__(self, **kwargs):
+        """
+        @param max_concurrency: Maximum number of calls in flight at once. Default is 10.
+
+        @param workers: Existing L{WorkerPool} to run the calls in. Several clients can share one.
+
+        @param pool: L{mfabrik.zoho.pool.ConnectionPool} for the HTTP calls. Its maxsize should
+            be at least max_concurrency. By default the client gets its own pool of that size,
+            so that the shared default pool is not changed.
+
+        Other parameters are passed to the wrapped connection class.
+        """
+        max_concurrency = kwargs.pop("max_concurrency", 10)
+        workers = kwargs.pop("workers", None)
+
+        if workers is None:
+            workers = WorkerPool(max_concurrency)
+        self.workers = workers
+
+        if kwargs.get("pool") is None:
+            # Room for all concurrent calls
+            kwargs["pool"] = ConnectionPool(maxsize=workers.max_workers)
+
+        self.connection = self.connection_class(**kwargs)
+
+    def submit(self, func, *args, **kwargs):
+        """ Run any callable in the worker pool.
+
+        @return: L{mfabrik.zoho.workers.Future}
+        """
+        return self.workers.submit(func, *args, **kwargs)
+
+    def open(self):
+        """ Open a new Zoho API session.
+
+        @return: Future
+        """
+        return self.submit(self.connection.open)
+
+    def close(self):
+        """ Wait for the pending calls and stop the worker threads """
+        self.workers.shutdown()
+
+
+def _background(name):
+    """ Create a method which runs the named connection method in the worker pool """
+
+    def method(self, *args, **kwargs):
+        return self.submit(getattr(self.connection, name), *args, **kwargs)
+
+    method.__name__ = name
+    method.__doc__ = "Non-blocking %s(). Returns Future which resolves to the result." % name
+    return method
+
+
+class AsyncCRM(AsyncConnection):
+    """ Non-blocking Zoho CRM API """
+
+    connection_class = CRM
+
+    insert_records = _background("insert_records")
+    insert_records_bulk = _background("insert_records_bulk")
+    get_records = _background("get_records")
+    get_record_by_id = _background("get_record_by_id")
+    search_records = _background("search_records")
+    search_records_pdc = _background("search_records_pdc")
+    update_record = _background("update_record")
+    delete_record = _background("delete_record")
+
+
+class AsyncSupport(AsyncConnection):
+    """ Non-blocking Zoho Support API """
+
+    connection_class = SUPPORT
+
+    add_records = _background("add_records")
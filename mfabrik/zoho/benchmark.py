@@ -0,0 +1,249 @@
+"""
+
+    Benchmark suite running against the local fake Zoho server.
+
+    Measures throughput, latency percentiles and memory use of the insert,
+    fetch and parse paths, without touching a real Zoho account::
+
+        python -m mfabrik.zoho.benchmark --latency 0.05 --rows 2000 --columns 30
+
+"""
+
+__copyright__ = "2010 mFabrik Research Oy"
+__author__ = "Mikko Ohtamaa <mikko@mfabrik.com>"
+__license__ = "GPL"
+__docformat__ = "Epytext"
+
+import gc
+import multiprocessing
+import optparse
+import resource
+import time
+
+from StringIO import StringIO
+
+from core import decode_json, iter_json_rows, flatten_row, simplejson, tostring
+from crm import CRM, build_xml
+from fakeserver import FakeZohoServer
+from metrics import MetricsCollector
+from pool import ConnectionPool
+from serializer import XMLSerializer
+
+
+def percentile(values, percent):
+    """ @return: Value below which given percent of the values fall """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+
+class Result(object):
+    """ Measurements of one benchmark """
+
+    def __init__(self, name, rows, elapsed, latencies=(), memory=None):
+        """
+        @param rows: Number of records processed
+
+        @param elapsed: Wall clock seconds
+
+        @param latencies: Seconds spent in each API call
+
+        @param memory: Peak memory growth in kilobytes
+        """
+        self.name = name
+        self.rows = rows
+        self.elapsed = elapsed
+        self.latencies = list(latencies)
+        self.memory = memory
+
+    def format(self):
+        line = "%-28s %9.0f rows/s" % (self.name, self.rows / max(self.elapsed, 1e-9))
+        if self.latencies:
+            line += "  p50 %7.1f ms  p90 %7.1f ms  p99 %7.1f ms" % (
+                percentile(self.latencies, 50) * 1000,
+                percentile(self.latencies, 90) * 1000,
+                percentile(self.latencies, 99) * 1000)
+        if self.memory is not None:
+            line += "  peak memory +%d kB" % self.memory
+        return line
+
+
+def timed_calls(func, args_list):
+    """ Call func for each argument tuple.
+
+    @return: Tuple (total elapsed seconds, list of call latencies)
+    """
+    latencies = []
+    start = time.time()
+    for args in args_list:
+        call_start = time.time()
+        func(*args)
+        latencies.append(time.time() - call_start)
+    return time.time() - start, latencies
+
+
+def benchmark_insert(crm, options):
+    leads = [{"First Name": "First%d" % i, "Last Name": "Last%d" % i, "Company": "Company %d" % i} for i in range(options.rows)]
+    chunks = [("Leads", leads[i:i + 100]) for i in range(0, len(leads), 100)]
+
+    elapsed, latencies = timed_calls(crm.insert_records, chunks)
+    yield Result("insert sequential", len(leads), elapsed, latencies)
+
+    start = time.time()
+    crm.insert_records_bulk("Leads", leads, max_workers=options.workers)
+    yield Result("insert bulk (%d workers)" % options.workers, len(leads), time.time() - start)
+
+
+def benchmark_fetch(crm, options):
+    pages = [("All", {"fromIndex": i + 1, "toIndex": i + 200}) for i in range(0, options.rows, 200)]
+
+    elapsed, latencies = timed_calls(crm.get_records, pages)
+    yield Result("getRecords pages", options.rows, elapsed, latencies)
+
+    start = time.time()
+    count = 0
+    for record in crm.iter_records("All"):
+        count += 1
+    yield Result("iter_records prefetch", count, time.time() - start)
+
+    ids = [(record["LEADID"],) for record in crm.get_records("All", {"fromIndex": 1, "toIndex": 200})]
+    elapsed, latencies = timed_calls(crm.get_record_by_id, ids[:options.calls])
+    yield Result("getRecordById", len(latencies), elapsed, latencies)
+
+
+def make_page(rows, columns):
+    """ @return: getRecords JSON response body with the given number of rows and columns """
+    output = []
+    for i in range(rows):
+        cells = [{"val": "LEADID", "content": str(177376000000000000 + i)}]
+        cells += [{"val": "Field %d" % column, "content": "value-%d-%d" % (i, column)} for column in range(columns)]
+        output.append({"no": str(i + 1), "FL": cells})
+    return simplejson.dumps({"response": {"uri": "/crm/private/json/Leads/getRecords", "result": {"Leads": {"row": output}}}})
+
+
+def parse_tree(body):
+    return CRM(authtoken="fake", scope="crmapi")._parse_json_response(decode_json(body))
+
+
+def parse_compact(body):
+    return CRM(authtoken="fake", scope="crmapi")._parse_json_response(decode_json(body), compact=True)
+
+
+def parse_stream(body):
+    # Consume rows one by one, as a streaming caller would
+    count = 0
+    for row in iter_json_rows(StringIO(body)):
+        flatten_row(row)
+        count += 1
+    return count
+
+
+def _measure(func, body, queue):
+    gc.collect()
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    result = func(body)
+    elapsed = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    del result
+    queue.put((elapsed, after - before))
+
+
+def measure_in_child(func, body):
+    """ Run func(body) in a child process, so that peak memory is not shared between benchmarks.
+
+    @return: Tuple (elapsed seconds, peak memory growth in kB)
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_measure, args=(func, body, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def benchmark_parse(options):
+    body = make_page(options.rows, options.columns)
+    for name, func in (("parse tree", parse_tree), ("parse compact", parse_compact), ("parse stream", parse_stream)):
+        elapsed, memory = measure_in_child(func, body)
+        yield Result(name, options.rows, elapsed, memory=memory)
+
+
+def serialize_tree(records):
+    return tostring(build_xml("Leads", records))
+
+
+def serialize_fast(records):
+    return XMLSerializer().serialize("Leads", records)
+
+
+def benchmark_serialize(options):
+    records = []
+    for i in range(options.rows):
+        record = {"First Name": u"First%d" % i, "Last Name": u"Last%d" % i, "Company": u"Company & Co %d" % i}
+        for column in range(options.columns):
+            record["Field %d" % column] = u"value-%d-%d" % (i, column)
+        records.append(record)
+
+    for name, func in (("serialize tree", serialize_tree), ("serialize fast", serialize_fast)):
+        elapsed, memory = measure_in_child(func, records)
+        yield Result(name, options.rows, elapsed, memory=memory)
+
+
+def main():
+    parser = optparse.OptionParser(description="Benchmark mfabrik.zoho against a local fake Zoho server")
+    parser.add_option("--latency", type="float", default=0.02, help="Fake server latency per call in seconds")
+    parser.add_option("--rows", type="int", default=1000, help="Number of records to insert, fetch and parse")
+    parser.add_option("--columns", type="int", default=20, help="Extra fields per record")
+    parser.add_option("--workers", type="int", default=4, help="Parallel workers for bulk calls")
+    parser.add_option("--calls", type="int", default=50, help="Number of single record lookups")
+    parser.add_option("--compression", action="store_true", default=False, help="Gzip requests and responses")
+    parser.add_option("--only", default="insert,fetch,parse,serialize", help="Comma separated benchmarks to run")
+    options, args = parser.parse_args()
+
+    only = options.only.split(",")
+
+    server = FakeZohoServer(latency=options.latency, extra_columns=options.columns)
+    server.start()
+    try:
+        pool = ConnectionPool(maxsize=options.workers)
+        metrics = MetricsCollector()
+        compress_requests = None
+        if options.compression:
+            compress_requests = 1024
+        crm = CRM(authtoken="fake", scope="crmapi", api_url=server.url, pool=pool, observers=[metrics],
+                  compression=options.compression, compress_requests=compress_requests)
+
+        if "insert" in only:
+            for result in benchmark_insert(crm, options):
+                print result.format()
+
+        if "fetch" in only:
+            # Replace inserted records with ones having the requested payload size
+            server.store.modules.pop("Leads", None)
+            server.seed("Leads", options.rows)
+            for result in benchmark_fetch(crm, options):
+                print result.format()
+
+        print "connection pool:", pool.stats()
+
+        for (endpoint, module), series in sorted(metrics.get_series().items()):
+            print "%-28s sent %9d bytes (saved %9d)  received %9d bytes (saved %9d)" % (
+                endpoint, series["request_bytes"], series["request_bytes_saved"],
+                series["response_bytes"], series["response_bytes_saved"])
+    finally:
+        server.stop()
+
+    if "parse" in only:
+        for result in benchmark_parse(options):
+            print result.format()
+
+    if "serialize" in only:
+        for result in benchmark_serialize(options):
+            print result.format()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+
+    Read-through record cache.
+
+    L{mfabrik.zoho.crm.CRM} can keep records fetched by id in a cache, so
+    that repeated lookups of the same records do not cost an API call.
+    Updates and deletes through the same CRM object invalidate the entry.
+
+    Any object with get(), set() and delete() methods works as the cache,
+    see L{CacheBackend}. L{LRUCache} is a size bounded in-process cache.
+    L{MemcacheBackend} shares the cache between processes.
+
+"""
+
+__copyright__ = "2010 mFabrik Research Oy"
+__author__ = "Mikko Ohtamaa <mikko@mfabrik.com>"
+__license__ = "GPL"
+__docformat__ = "Epytext"
+
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class CacheBackend(object):
+    """ Cache interface.
+
+    Absract base class for cache backends.
+    """
+
+    def get(self, key):
+        """ @return: Cached value or None if not cached or expired """
+        raise NotImplementedError("Subclass must implement")
+
+    def set(self, key, value):
+        raise NotImplementedError("Subclass must implement")
+
+    def delete(self, key):
+        raise NotImplementedError("Subclass must implement")
+
+
+class LRUCache(CacheBackend):
+    """ Thread-safe in-process cache with LRU eviction and per-entry time to live. """
+
+    def __init__(self, maxsize=1000, ttl=300):
+        """
+        @param maxsize: Maximum number of entries
+
+        @param ttl: Seconds after which an entry expires. None never expires.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # key -> (expires, value), least recently used first
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is None or (entry[0] is not None and entry[0] < time.time()):
+                self.misses += 1
+                return None
+
+            # Move to the most recently used end
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        if self.ttl is None:
+            expires = None
+        else:
+            expires = time.time() + self.ttl
+
+        self._lock.acquire()
+        try:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            self._entries.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+        finally:
+            self._lock.release()
+
+
+class MemcacheBackend(CacheBackend):
+    """ Cache shared between processes using a memcached client.
+
+    Works with any client having memcache style get(), set() and delete(),
+    like python-memcached or pylibmc.
+    """
+
+    def __init__(self, client, ttl=300, prefix="mfabrik.zoho:"):
+        """
+        @param client: memcache.Client instance
+
+        @param ttl: Seconds after which an entry expires
+
+        @param prefix: Key prefix separating our entries from other users of the server
+        """
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _key(self, key):
+        # memcached keys cannot contain spaces
+        return (self.prefix + key).replace(" ", "_")
+
+    def get(self, key):
+        return self.client.get(self._key(key))
+
+    def set(self, key, value):
+        self.client.set(self._key(key), value, self.ttl or 0)
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
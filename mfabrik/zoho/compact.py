@@ -0,0 +1,166 @@
+"""
+
+    Compact column-oriented result sets.
+
+    A list of record dictionaries repeats every field name in every record.
+    L{ResultSet} keeps the field names once and each record as a tuple of
+    values, which takes a fraction of the memory for large exports.
+    Records are accessed through lightweight L{Row} views, which behave
+    like read-only dictionaries.
+
+"""
+
+__copyright__ = "2010 mFabrik Research Oy"
+__author__ = "Mikko Ohtamaa <mikko@mfabrik.com>"
+__license__ = "GPL"
+__docformat__ = "Epytext"
+
+
+class _Missing(object):
+    """ Marker for a field the record does not have """
+
+    def __repr__(self):
+        return "<missing>"
+
+_missing = _Missing()
+
+
+class Row(object):
+    """ Read-only dictionary-like view to one record of a L{ResultSet} """
+
+    __slots__ = ("result_set", "values")
+
+    def __init__(self, result_set, values):
+        self.result_set = result_set
+        self.values = values
+
+    def _value(self, position):
+        if position < len(self.values):
+            return self.values[position]
+        # Column was added after this row
+        return _missing
+
+    def __getitem__(self, key):
+        position = self.result_set.positions.get(key)
+        if position is not None:
+            value = self._value(position)
+            if value is not _missing:
+                return value
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    has_key = __contains__
+
+    def keys(self):
+        return [name for name, value in zip(self.result_set.columns, self.values) if value is not _missing]
+
+    def items(self):
+        return [(name, value) for name, value in zip(self.result_set.columns, self.values) if value is not _missing]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def to_dict(self):
+        """ @return: Plain dictionary copy of the record """
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, Row):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "Row(%r)" % self.to_dict()
+
+
+class ResultSet(object):
+    """ List-like collection of records sharing one column schema.
+
+    Rows may have different fields. New columns are added to the schema
+    when they are first seen.
+    """
+
+    def __init__(self, columns=()):
+        """
+        @param columns: Initial column names
+        """
+        self.columns = []
+        self.positions = {}
+        self.rows = []
+        for name in columns:
+            self.add_column(name)
+
+    def add_column(self, name):
+        """ @return: Position of the column """
+        position = self.positions.get(name)
+        if position is None:
+            position = len(self.columns)
+            self.columns.append(name)
+            self.positions[name] = position
+        return position
+
+    def append_cells(self, cells):
+        """ Add a record from Zoho JSON cells without building a dictionary first.
+
+        @param cells: List of {'val': field name, 'content': value} dictionaries
+        """
+        values = [_missing] * len(self.columns)
+        for cell in cells:
+            position = self.positions.get(cell["val"])
+            if position is None:
+                position = self.add_column(cell["val"])
+            if position >= len(values):
+                values.extend([_missing] * (position - len(values) + 1))
+            values[position] = cell["content"]
+        self.rows.append(tuple(values))
+
+    def append(self, record):
+        """ Add a record dictionary """
+        values = [_missing] * len(self.columns)
+        for name, value in record.items():
+            position = self.add_column(name)
+            if position >= len(values):
+                values.extend([_missing] * (position - len(values) + 1))
+            values[position] = value
+        self.rows.append(tuple(values))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [Row(self, values) for values in self.rows[index]]
+        return Row(self, self.rows[index])
+
+    def __iter__(self):
+        for values in self.rows:
+            yield Row(self, values)
+
+    def column(self, name):
+        """ @return: List of the values of one field, None where the record does not have it """
+        position = self.positions[name]
+        output = []
+        for values in self.rows:
+            if position < len(values) and values[position] is not _missing:
+                output.append(values[position])
+            else:
+                output.append(None)
+        return output
+
+    def to_dicts(self):
+        """ @return: List of plain record dictionaries """
+        return [row.to_dict() for row in self]
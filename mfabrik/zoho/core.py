@@ -9,9 +9,15 @@ __author__ = "Mikko Ohtamaa <mikko@mfabrik.com>"
 __license__ = "GPL"
 __docformat__ = "Epytext"
 
-import urllib, urllib2
+import urllib
 
 import logging
+import re
+import threading
+import time
+import zlib
+
+from pool import default_pool
 
 try:
     from xml import etree
@@ -37,6 +43,9 @@ except ImportError:
 
 logger = logging.getLogger("Zoho API")
 
+#: Zoho error code for an expired or otherwise invalid login ticket
+INVALID_TICKET = 4834
+
 
 class ZohoException(Exception):
     """ Bad stuff happens.
@@ -47,12 +56,30 @@ class ZohoException(Exception):
     Play some Munchkin.
     """
 
+    def __init__(self, message, code=None):
+        """
+        @param message: Error message
+
+        @param code: Zoho error code, like 4401, if Zoho gave one
+        """
+        Exception.__init__(self, message)
+        self.code = code
+
 
 class Connection(object):
     """ Zoho API connector.
 
     Absract base class for all different Zoho API connections.
     Subclass this and override necessary methods to support different Zoho API groups.
+
+    Connections are thread safe: one connection object can be shared by
+    any number of threads, which then share its HTTP connection pool,
+    rate limiter, retry policy and login ticket. All per-request state
+    lives in local variables and in the returned L{ZohoResponse}.
+    Concurrent threads logging in or replacing an expired ticket
+    cause only one login. The connection settings must not be changed
+    while other threads are using the connection, and objects given to
+    it, like caches and observers, must be thread safe themselves.
     """
 
     def __init__(self, **kwargs):
@@ -66,13 +93,45 @@ class Connection(object):
         @param extra_auth_params: Dictionary of optional HTTP POST parameters passed to the login call
 
         @param auth_url: Which URL we use for authentication
+
+        @param api_url: Base URL of the API, like https://crm.zoho.com. Default is set by the subclass.
+
+        @param pool: L{mfabrik.zoho.pool.ConnectionPool} used for HTTP calls.
+            By default all connections share one process-wide pool.
+
+        @param rate_limiter: Optional L{mfabrik.zoho.ratelimit.RateLimiter}.
+            Share one limiter between all connections using the same Zoho organization.
+
+        @param retry_policy: Optional L{mfabrik.zoho.retry.RetryPolicy} for retrying
+            transient failures. By default failed calls are not retried.
+
+        @param observers: List of objects notified before and after every API call,
+            see L{mfabrik.zoho.metrics.CallObserver}
+
+        @param compression: Ask Zoho to gzip the responses. They are decompressed
+            while they are read, so streaming parsers work as before.
+
+        @param compress_requests: Gzip POST payloads larger than this many bytes.
+            Use only with endpoints which accept gzip encoded requests. None, the default,
+            never compresses requests.
+
+        @param ticket_cache: Optional L{mfabrik.zoho.tickets.TicketCache} for sharing
+            the login ticket between connections and processes
         """
         options = {
             'username': None,
             'password': None,
             'authtoken': None,
             'auth_url': "https://accounts.zoho.com/login",
-            'scope': None
+            'api_url': None,
+            'scope': None,
+            'pool': None,
+            'rate_limiter': None,
+            'retry_policy': None,
+            'observers': (),
+            'compression': False,
+            'compress_requests': None,
+            'ticket_cache': None
         }
         options.update(kwargs)
         if options['username'] is not None and options['password'] is not None:
@@ -84,21 +143,74 @@ class Connection(object):
 
         self.auth_url = options['auth_url']
 
+        if options['api_url'] is not None:
+            self.api_url = options['api_url']
+
         if options['scope'] is not None:
             self.scope = options["scope"]
         else:
             raise ZohoException("No Scope")
 
+        if options['pool'] is not None:
+            self.pool = options['pool']
+        else:
+            self.pool = default_pool
+
+        self.rate_limiter = options['rate_limiter']
+        self.retry_policy = options['retry_policy']
+        self.observers = list(options['observers'])
+        self.compression = options['compression']
+        self.compress_requests = options['compress_requests']
+        self.ticket_cache = options['ticket_cache']
+
         # Ticket is none until the conneciton is opened
         self.ticket = None
+        # Serializes logins of the threads sharing this connection
+        self._ticket_lock = threading.Lock()
 
     def get_service_name(self):
         """ Return API name which we are using. """
         raise NotImplementedError("Subclass must implement")
 
     def open(self):
-        """ Open a new Zoho API session """
-        self.ticket = self._create_ticket()
+        """ Open a new Zoho API session.
+
+        With a ticket cache, a valid ticket of the same account is reused
+        instead of logging in.
+        """
+        self._ticket_lock.acquire()
+        try:
+            self.ticket = self._get_ticket()
+        finally:
+            self._ticket_lock.release()
+
+    def _get_ticket(self):
+        if self.ticket_cache is None:
+            return self._create_ticket()
+        return self.ticket_cache.get_ticket(self._get_ticket_key(), self._create_ticket)
+
+    def refresh_ticket(self, stale_ticket):
+        """ Replace a ticket Zoho no longer accepts.
+
+        If another thread or another connection sharing the ticket cache has
+        already logged in again, its ticket is used.
+
+        @param stale_ticket: The rejected ticket
+        """
+        self._ticket_lock.acquire()
+        try:
+            if self.ticket != stale_ticket:
+                # Another thread has already replaced the ticket
+                return
+            if self.ticket_cache is not None:
+                self.ticket_cache.invalidate(self._get_ticket_key(), stale_ticket)
+            self.ticket = self._get_ticket()
+        finally:
+            self._ticket_lock.release()
+
+    def _get_ticket_key(self):
+        """ @return: Ticket cache key identifying the account and the service """
+        return "%s:%s:%s" % (self.get_service_name(), self.username, self.auth_url)
 
     def _create_ticket(self):
         """
@@ -116,9 +228,7 @@ class Connection(object):
             'PASSWORD': self.password
         }
 
-        request_url = "https://accounts.zoho.com/login"
-        request = urllib2.Request(request_url, urllib.urlencode(params))
-        body = urllib2.urlopen(request).read()
+        body = self.pool.urlopen(self.auth_url, urllib.urlencode(params)).read()
 
         data = self._parse_ticket_response(body)
 
@@ -179,23 +289,218 @@ class Connection(object):
 
         @param root: ElementTree DOM root node to be serialized.
         """
+        return self.xml_request(url, parameters, root).body
+
+    def do_call(self, url, parameters):
+        """ Do Zoho API call.
+
+        @param url: URL to be called
+
+        @param parameters: Optional POST parameters.
+        """
+        return self.request(url, parameters).body
+
+    def xml_request(self, url, parameters, root, check=None, idempotent=False):
+        """ Do Zoho API call with outgoing XML payload.
+
+        @param root: ElementTree DOM root node to be serialized, or already serialized XML string.
 
+        @return: L{ZohoResponse}, see L{request}
+        """
         parameters = parameters.copy()
-        parameters[self.parameter_xml] = tostring(root)
-        return self.do_call(url, parameters)
+        if isinstance(root, basestring):
+            parameters[self.parameter_xml] = root
+        else:
+            parameters[self.parameter_xml] = tostring(root)
+        return self.request(url, parameters, check, idempotent)
 
-    def do_call(self, url, parameters):
+    def add_observer(self, observer):
+        """ Start notifying observer about API calls.
+
+        @param observer: Object with before_call(info) and after_call(info) methods,
+            see L{mfabrik.zoho.metrics.CallObserver}
+        """
+        self.observers.append(observer)
+
+    def notify_observers(self, event, info):
+        """ Call event method of all observers.
+
+        A failing observer is logged, but it does not fail the API call.
+
+        @param event: "before_call" or "after_call"
+
+        @param info: L{CallInfo}
+        """
+        for observer in self.observers:
+            try:
+                getattr(observer, event)(info)
+            except Exception:
+                logger.exception("Zoho API call observer failed")
+
+    def request(self, url, parameters, check=None, idempotent=False):
         """ Do Zoho API call.
 
         @param url: URL to be called
 
         @param parameters: Optional POST parameters.
+
+        @param check: "xml" or "json" to raise ZohoException right away if the response
+            is a Zoho error message. The parsed response is kept, so the check
+            does not cost an extra parse.
+
+        @param idempotent: True if repeating the call does no harm.
+            Used by the retry policy to decide whether a failed call can be retried.
+
+        @return: L{ZohoResponse}
+        """
+        info = CallInfo(url)
+        self.notify_observers("before_call", info)
+
+        try:
+            ticket = self.ticket
+            try:
+                response = self._request_retrying(url, parameters, check, idempotent, info)
+            except ZohoException, e:
+                if e.code != INVALID_TICKET or ticket is None:
+                    raise
+                # Ticket has expired. The call was not processed, so it is safe to repeat it after logging in again.
+                self.refresh_ticket(ticket)
+                response = self._request_retrying(url, parameters, check, idempotent, info)
+        except Exception, e:
+            info.set_error(e)
+            self.notify_observers("after_call", info)
+            raise
+
+        info.rows = response.get_row_count()
+        self.notify_observers("after_call", info)
+        return response
+
+    def _request_retrying(self, url, parameters, check, idempotent, info):
+        if self.retry_policy is None:
+            return self._request_once(url, parameters, check, info)
+
+        def call():
+            return self._request_once(url, parameters, check, info)
+
+        response, retries = self.retry_policy.call(call, idempotent)
+        response.retries = retries
+        return response
+
+    def _request_once(self, url, parameters, check, info):
+        info.attempts += 1
+
+        start = time.time()
+        stream = self.do_stream_call(url, parameters, info)
+        try:
+            read_start = time.time()
+            body = stream.read()
+            end = time.time()
+        finally:
+            stream.close()
+        response = ZohoResponse(url, body, end - start)
+
+        info.network_time += end - read_start
+        info.set_response_bytes(stream, len(body))
+
+        if logger.getEffectiveLevel() == logging.DEBUG:
+            # Output Zoho API call payload
+            logger.debug("ZOHO API response:" + url)
+            logger.debug(body)
+
+        start = time.time()
+        try:
+            try:
+                if check == "xml":
+                    response.check_successful_xml()
+                elif check == "json":
+                    response.json()
+            except ZohoException, e:
+                self.report_error(e)
+                raise
+        finally:
+            info.parse_time += time.time() - start
+
+        return response
+
+    def stream_rows(self, url, parameters):
+        """ Do Zoho JSON API call and parse the returned rows incrementally.
+
+        Observers are notified when the response has been consumed,
+        or when the generator is closed.
+
+        @return: Generator yielding raw Zoho row dictionaries, see L{iter_json_rows}
+        """
+        info = CallInfo(url)
+        info.attempts = 1
+        self.notify_observers("before_call", info)
+
+        # Time spent in this generator, not in the caller consuming the rows
+        busy = 0.0
+        resumed = time.time()
+        stream = None
+        try:
+            try:
+                stream = MeteredStream(self.do_stream_call(url, parameters, info))
+                info.rows = 0
+                for row in iter_json_rows(stream):
+                    info.rows += 1
+                    busy += time.time() - resumed
+                    yield row
+                    resumed = time.time()
+            except ZohoException, e:
+                self.report_error(e)
+                info.set_error(e)
+                raise
+            except Exception, e:
+                info.set_error(e)
+                raise
+        finally:
+            busy += time.time() - resumed
+            if stream is not None:
+                stream.close()
+                info.set_response_bytes(stream.stream, stream.bytes)
+                info.parse_time = max(busy - info.wait_time - info.network_time - stream.elapsed, 0.0)
+                info.network_time += stream.elapsed
+            self.notify_observers("after_call", info)
+
+    def stream_records(self, url, parameters):
+        """ Do Zoho JSON API call and parse the returned records incrementally.
+
+        @return: Generator yielding flat record dictionaries, see L{flatten_row}
+        """
+        for row in self.stream_rows(url, parameters):
+            yield flatten_row(row)
+
+    def report_error(self, exception):
+        """ Let the rate limiter know about a Zoho error response.
+
+        @param exception: ZohoException raised for the response
+        """
+        if self.rate_limiter is not None:
+            self.rate_limiter.report_error(exception)
+
+    def do_stream_call(self, url, parameters, info=None):
+        """ Do Zoho API call without reading the response.
+
+        The caller must read the response completely or close() it,
+        so that the HTTP connection is returned to the pool.
+
+        @param url: URL to be called
+
+        @param parameters: Optional POST parameters.
+
+        @param info: Optional L{CallInfo} to record the request size, rate limiter
+            wait and the time spent waiting for the response headers
+
+        @return: File-like response object
         """
         # Do not mutate orginal dict
         parameters = parameters.copy()
-        if self.ticket != None:
-            parameters["ticket"] = self.ticket
-        parameters["authtoken"] = self.authtoken
+        ticket = self.ticket
+        if ticket != None:
+            parameters["ticket"] = ticket
+        if hasattr(self, "authtoken"):
+            parameters["authtoken"] = self.authtoken
         parameters["scope"] = self.scope
 
         stringify(parameters)
@@ -205,16 +510,36 @@ class Connection(object):
             logger.debug("Doing ZOHO API call:" + url)
             for key, value in parameters.items():
                 logger.debug(key + ": " + value)
-        self.parameters = parameters
-        self.parameters_encoded = urllib.urlencode(parameters)
-        request = urllib2.Request(url, urllib.urlencode(parameters))
-        response = urllib2.urlopen(request).read()
-
-        if logger.getEffectiveLevel() == logging.DEBUG:
-            # Output Zoho API call payload
-            logger.debug("ZOHO API response:" + url)
-            logger.debug(response)
-
+        data = urllib.urlencode(parameters)
+
+        if self.rate_limiter is not None:
+            start = time.time()
+            self.rate_limiter.acquire()
+            if info is not None:
+                info.wait_time += time.time() - start
+
+        headers = {}
+        if self.compression:
+            headers["Accept-Encoding"] = "gzip"
+
+        size = len(data)
+        if self.compress_requests is not None and size > self.compress_requests:
+            compressed = gzip_compress(data)
+            if len(compressed) < size:
+                headers["Content-Encoding"] = "gzip"
+                data = compressed
+
+        start = time.time()
+        try:
+            response = self.pool.urlopen(url, data, headers)
+        finally:
+            if info is not None:
+                info.network_time += time.time() - start
+                info.request_bytes = len(data)
+                info.request_bytes_saved = size - len(data)
+
+        if response.getheader("Content-Encoding", "").lower() == "gzip":
+            return GzipStream(response)
         return response
 
     def check_successful_xml(self, response):
@@ -222,35 +547,237 @@ class Connection(object):
         
         Throw exception of the response looks like something not liked.
         
+        @param response: L{ZohoResponse} or response body string
+
         @raise: ZohoException if any error
         
+        @return: Always True
+        """
+        return as_response(response).check_successful_xml()
+
+    def get_inserted_records(self, response):
+        """
+        @param response: L{ZohoResponse} or response body string
+
+        @return: List of record ids which were created by insert recoreds
+        """
+        return as_response(response).get_inserted_records()
+
+
+class CallInfo(object):
+    """ Measurements of one Zoho API call, passed to the call observers.
+
+    before_call() gets the endpoint and module only. The other fields
+    are filled in when after_call() is called.
+    """
+
+    def __init__(self, url):
+        """
+        @param url: Called URL, like https://crm.zoho.com/crm/private/json/Leads/getRecords
+        """
+        self.url = url
+
+        # API method and module are the last two parts of the URL path
+        parts = url.rstrip("/").split("/")
+        #: API method, like getRecords
+        self.endpoint = parts[-1]
+        #: Zoho module, like Leads
+        self.module = parts[-2]
+
+        #: Number of rows in the response, None if not known
+        self.rows = None
+        #: Bytes sent and received over the network
+        self.request_bytes = 0
+        self.response_bytes = 0
+        #: Bytes saved by gzip compression
+        self.request_bytes_saved = 0
+        self.response_bytes_saved = 0
+        #: Seconds spent sending the request and reading the response, summed over all attempts
+        self.network_time = 0.0
+        #: Seconds spent parsing the response
+        self.parse_time = 0.0
+        #: Seconds spent waiting for the rate limiter
+        self.wait_time = 0.0
+        self.attempts = 0
+        #: Exception which failed the call, or None
+        self.error = None
+        #: Zoho error code or HTTP status of a failed call, None if there was none
+        self.error_code = None
+
+    def get_retries(self):
+        return max(self.attempts - 1, 0)
+
+    retries = property(get_retries)
+
+    def set_response_bytes(self, stream, size):
+        """ Record the response size.
+
+        @param stream: Response stream, L{GzipStream} for a compressed response
+
+        @param size: Number of bytes read from the stream
+        """
+        raw_bytes = getattr(stream, "raw_bytes", None)
+        if raw_bytes is None:
+            self.response_bytes = size
+        else:
+            self.response_bytes = raw_bytes
+            self.response_bytes_saved = size - raw_bytes
+
+    def set_error(self, exception):
+        """ Record the exception which failed the call """
+        self.error = exception
+        # Both ZohoException and urllib2.HTTPError have a code
+        self.error_code = getattr(exception, "code", None)
+
+
+class MeteredStream(object):
+    """ File-like wrapper counting the bytes read and the time spent reading """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes = 0
+        self.elapsed = 0.0
+
+    def read(self, amt=None):
+        start = time.time()
+        if amt is None:
+            data = self.stream.read()
+        else:
+            data = self.stream.read(amt)
+        self.elapsed += time.time() - start
+        self.bytes += len(data)
+        return data
+
+    def close(self):
+        self.stream.close()
+
+
+class GzipStream(object):
+    """ File-like wrapper decompressing a gzip encoded response while it is read """
+
+    def __init__(self, stream, chunk_size=16384):
+        """
+        @param stream: Compressed response
+
+        @param chunk_size: Compressed bytes to read at a time
+        """
+        self.stream = stream
+        self.chunk_size = chunk_size
+        # 16 + MAX_WBITS expects gzip header and trailer
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buffer = ""
+        self.eof = False
+        #: Compressed bytes read so far
+        self.raw_bytes = 0
+
+    def getheader(self, name, default=None):
+        return self.stream.getheader(name, default)
+
+    def _fill(self):
+        data = self.stream.read(self.chunk_size)
+        if data:
+            self.raw_bytes += len(data)
+            self.buffer += self.decompressor.decompress(data)
+        else:
+            self.buffer += self.decompressor.flush()
+            self.eof = True
+
+    def read(self, amt=None):
+        """ Read decompressed data.
+
+        @param amt: Maximum number of bytes to read. None reads everything.
+        """
+        if amt is None:
+            while not self.eof:
+                self._fill()
+            data = self.buffer
+            self.buffer = ""
+            return data
+
+        while len(self.buffer) < amt and not self.eof:
+            self._fill()
+        data = self.buffer[:amt]
+        self.buffer = self.buffer[amt:]
+        return data
+
+    def close(self):
+        self.stream.close()
+
+
+def gzip_compress(data, level=6):
+    """ @return: data compressed in gzip format """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ZohoResponse(object):
+    """ Response of one Zoho API call.
+
+    The body is parsed lazily on first use and only once,
+    no matter how many times the result is accessed.
+    """
+
+    def __init__(self, url, body, elapsed=None):
+        """
+        @param url: Called URL
+
+        @param body: Raw response bytes
+
+        @param elapsed: Seconds spent in the HTTP call
+        """
+        self.url = url
+        self.body = body
+        self.elapsed = elapsed
+        # How many times the call was retried before this response
+        self.retries = 0
+        self._root = None
+        self._json = None
+
+    def __str__(self):
+        return self.body
+
+    def get_root(self):
+        """ @return: Parsed XML root element """
+        if self._root is None:
+            self._root = fromstring(self.body)
+        return self._root
+
+    root = property(get_root)
+
+    def json(self):
+        """ @return: Decoded JSON data, see L{decode_json} """
+        if self._json is None:
+            self._json = decode_json(self.body)
+        return self._json
+
+    def check_successful_xml(self):
+        """ Make sure that the XML response is not an error message.
+
+        @raise: ZohoException if any error
+
         @return: Always True
         """
 
         # Example response
         # <response uri="/crm/private/xml/Leads/insertRecords"><result><message>Record(s) added successfully</message><recorddetail><FL val="Id">177376000000142007</FL><FL val="Created Time">2010-06-27 21:37:20</FL><FL val="Modified Time">2010-06-27 21:37:20</FL><FL val="Created By">Ohtamaa</FL><FL val="Modified By">Ohtamaa</FL></recorddetail></result></response>
 
-        root = fromstring(response)
-            
         # Check error response
         # <response uri="/crm/private/xml/Leads/insertRecords"><error><code>4401</code><message>Unable to populate data, please check if mandatory value is entered correctly.</message></error></response>
-        for error in root.findall("error"):
-            parameters = self.parameters
-            parameters_encoded = self.parameters_encoded
-            print "Got error"
+        for error in self.root.findall("error"):
+            code = error.findtext("code")
+            if code is not None and code.isdigit():
+                code = int(code)
             for message in error.findall("message"):
-                raise ZohoException(message.text)
-        
+                raise ZohoException(message.text, code)
+
         return True
 
-    def get_inserted_records(self, response):
+    def get_inserted_records(self):
         """
         @return: List of record ids which were created by insert recoreds
         """
-        root = fromstring(response)
-        
         records = []
-        for result in root.findall("result"):
+        for result in self.root.findall("result"):
             for record in result.findall("recorddetail"):
                 record_detail = {}
                 for fl in record.findall("FL"):
@@ -258,6 +785,80 @@ class Connection(object):
                 records.append(record_detail)
         return records
 
+    def get_row_count(self):
+        """ Count the rows of an already parsed response.
+
+        The body is not parsed just for counting.
+
+        @return: Number of rows or records in the result, or None if not known
+        """
+        if self._json is not None:
+            response = self._json.get("response", {})
+            if response.get("nodata"):
+                return 0
+            result = response.get("result")
+            if not isinstance(result, dict):
+                return None
+            for value in result.values():
+                if isinstance(value, dict) and "row" in value:
+                    rows = value["row"]
+                    # If single item returned
+                    if type(rows) == dict:
+                        return 1
+                    return len(rows)
+            return None
+
+        if self._root is not None:
+            count = 0
+            for result in self._root.findall("result"):
+                count += len(result.findall("row")) + len(result.findall("recorddetail"))
+            return count
+
+        return None
+
+    def get_row_results(self):
+        """ Results of a multi-row write call made with version=4.
+
+        Example response::
+
+            <response uri="/crm/private/xml/Leads/updateRecords"><result>
+            <row no="1"><success><code>2001</code><details><FL val="Id">177376000000142007</FL>...</details></success></row>
+            <row no="2"><error><code>4401</code><details>Unable to populate data</details></error></row>
+            </result></response>
+
+        @return: Dictionary mapping row number to the record details dictionary,
+            or to ZohoException if the row failed
+        """
+        results = {}
+        for result in self.root.findall("result"):
+            for row in result.findall("row"):
+                no = int(row.get("no"))
+
+                success = row.find("success")
+                if success is not None:
+                    details = {}
+                    for fl in success.findall("details/FL"):
+                        details[fl.get("val")] = fl.text
+                    results[no] = details
+                    continue
+
+                error = row.find("error")
+                if error is not None:
+                    code = error.findtext("code")
+                    if code is not None and code.isdigit():
+                        code = int(code)
+                    message = error.findtext("details") or error.findtext("message")
+                    results[no] = ZohoException(message, code)
+        return results
+
+
+def as_response(response):
+    """ Wrap a raw response body to L{ZohoResponse} if needed """
+    if isinstance(response, ZohoResponse):
+        return response
+    return ZohoResponse(None, response)
+
+
 def stringify(params):
     """ Make sure all params are urllib compatible strings """
     for key, value in params.items():
@@ -279,6 +880,9 @@ def decode_json(json_data):
     @raise: ZohoException if JSON'ified error message is given by Zoho
     """
 
+    if isinstance(json_data, ZohoResponse):
+        return json_data.json()
+
     # {"response": {"uri":"/crm/private/json/Leads/getRecords","error": {"code":4500,"message":"Problem occured while processing the request"}}}
     data = simplejson.loads(json_data)
 
@@ -286,6 +890,115 @@ def decode_json(json_data):
     if response:
         error = response.get("error", None)
         if error:
-            raise ZohoException("Error while calling JSON Zoho api:" + str(error))
+            code = error.get("code", None)
+            try:
+                code = int(code)
+            except (TypeError, ValueError):
+                pass
+            raise ZohoException("Error while calling JSON Zoho api:" + str(error), code)
 
     return data
+
+
+def flatten_row(row):
+    """ Convert one Zoho JSON row to a Python dictionary.
+
+    {'no': '1', 'FL': [{'content': '177376000000142085', 'val': 'LEADID'}, ...]}
+    becomes {'LEADID': '177376000000142085', ...}
+
+    Zoho Support rows have the cells in lowercase 'fl'.
+    """
+    if "FL" in row:
+        cells = row["FL"]
+    else:
+        cells = row["fl"]
+    # Single column rows are not wrapped in a list
+    if type(cells) == dict:
+        cells = [cells]
+
+    item = {}
+    for cell in cells:
+        item[cell["val"]] = cell["content"]
+    return item
+
+
+_row_list_start = re.compile(r'"row"\s*:\s*')
+
+_whitespace = " \t\r\n,"
+
+
+def iter_json_rows(stream, chunk_size=65536):
+    """ Incrementally parse rows from Zoho JSON response.
+
+    Reads the response in chunks and decodes one row at a time,
+    so that the whole document tree is never held in memory.
+
+    @param stream: File-like object, e.g. from L{Connection.do_stream_call}
+
+    @param chunk_size: Bytes to read from stream at a time
+
+    @return: Generator yielding raw Zoho row dictionaries, see L{flatten_row}
+
+    @raise: ZohoException if JSON'ified error message is given by Zoho
+    """
+    decoder = simplejson.JSONDecoder()
+    buffer = ""
+
+    # Find the start of the row list. Everything before it is short
+    # {"response":{"uri":"/crm/private/json/Leads/getRecords","result":{"Leads":{"row":[
+    while True:
+        match = _row_list_start.search(buffer)
+        if match:
+            break
+
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            # No rows at all: nodata or error response, which are small
+            data = decode_json(buffer)
+            if data.get("response", {}).get("nodata"):
+                return
+            raise ZohoException("Unexpected JSON response from Zoho:" + buffer[:200])
+        buffer += chunk
+
+    pos = match.end()
+    in_list = None
+    eof = False
+
+    while True:
+        while pos < len(buffer) and buffer[pos] in _whitespace:
+            pos += 1
+
+        if pos < len(buffer):
+            char = buffer[pos]
+
+            if in_list is None:
+                # Single item is returned as object, not as a list
+                in_list = (char == "[")
+                if in_list:
+                    pos += 1
+                continue
+
+            if char == "]" and in_list:
+                return
+
+            try:
+                row, end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                # Row continues in the next chunk, unless there is nothing more to read
+                if eof:
+                    raise ZohoException("Truncated JSON response from Zoho")
+            else:
+                yield row
+                if not in_list:
+                    return
+                pos = end
+                continue
+
+        if eof:
+            raise ZohoException("Truncated JSON response from Zoho")
+
+        chunk = stream.read(chunk_size)
+        eof = not chunk
+        # Drop already parsed rows from the buffer
+        buffer = buffer[pos:] + chunk
+        pos = 0
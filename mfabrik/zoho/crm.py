@@ -20,64 +20,124 @@ except ImportError:
     except ImportError:
         raise RuntimeError("XML library not available:  no etree, no lxml")
    
-from core import Connection, ZohoException, decode_json
+from core import Connection, ZohoException, flatten_row
+from workers import WorkerPool, chunked, iter_pages
+from compact import ResultSet
+from serializer import default_serializer
+
+
+def build_xml(module, leads):
+    """ Build XML payload of CRM write calls as ElementTree.
+
+    L{mfabrik.zoho.serializer.XMLSerializer} produces the same XML faster
+    and is used by the CRM methods.
+
+    @param module: Zoho CRM module name, the root element
+
+    @param leads: List of record dictionaries
+
+    @return: ElementTree root element
+    """
+    root = Element(module)
+    
+    # Row counter
+    no = 1
+    for lead in leads:
+        row = Element("row", no=str(no))
+        root.append(row)
+        
+        assert type(lead) == dict, "Leads must be dictionaries inside a list, got:" + str(type(lead))
+        
+        for key, value in lead.items():
+            # <FL val="Lead Source">Web Download</FL>
+            # <FL val="First Name">contacto 1</FL>
+            fl = Element("FL", val=key)
+            if type(value) == dict: # If it's an attached module, accept multiple groups
+                mod_attach_no = 1
+                for module_key, module_value in value.items(): # The first group defines the module name, yank that and iterate through the contents
+                    for mod_item in module_value:
+                        mod_fl = SubElement(fl, module_key, no=str(mod_attach_no))
+                        for mod_item_key, mod_item_value in mod_item.items():
+                            attach_fl = SubElement(mod_fl, "FL", val=mod_item_key)
+                            attach_fl.text = mod_item_value
+                        mod_attach_no += 1
+            elif type(value) not in (str, unicode):
+                fl.text = unicode(value)
+            else:
+                fl.text = value
+            row.append(fl)
+        no += 1
+    return root
+
 
 class CRM(Connection):
     """ CRM specific Zoho APIs mapped to Python """
     
-    def _parse_json_response(self, data):
+    def __init__(self, **kwargs):
+        """
+        @param cache: Optional L{mfabrik.zoho.cache.CacheBackend} for records fetched
+            with get_record_by_id(). Updates and deletes invalidate the cached records.
+        
+        Other parameters are described in L{Connection}.
+        """
+        self.cache = kwargs.pop("cache", None)
+        Connection.__init__(self, **kwargs)
+    
+    def _cache_key(self, module, id):
+        return module + ":" + str(id)
+    
+    def get_id_column(self, module):
+        """ @return: Name of the record id field of a module, like LEADID for Leads or CONTACTID for Contacts """
+        return module[:-1].upper() + "ID"
+    
+    def _invalidate(self, module, id):
+        if self.cache is not None:
+            self.cache.delete(self._cache_key(module, id))
+    
+    def _parse_json_response(self, data, module="Leads", compact=False):
+        if compact:
+            output = ResultSet()
+        else:
+            output = []
+        
         if data["response"].get("nodata"):
-            return []
+            return output
         
         # Sanify output data to more Python-like format
-        output = []
-        rows = data["response"]["result"]["Leads"]["row"]
+        result = data["response"]["result"]
+        if module not in result:
+            # Result is keyed by the module name, which may be spelled differently than in the URL
+            module = result.keys()[0]
+        rows = result[module]["row"]
         # If single item returned
         if type(rows) == dict:
             rows = [rows]
         for row in rows:
-            item = {}
-            for cell in row["FL"]:
-                item[cell["val"]] = cell["content"]
-            
-            output.append(item)
+            if compact:
+                cells = row["FL"]
+                if type(cells) == dict:
+                    cells = [cells]
+                output.append_cells(cells)
+            else:
+                output.append(flatten_row(row))
             
         return output
     
     def _prepare_xml_request(self, module, leads):
-        root = Element(module)
-        
-        # Row counter
-        no = 1
-        for lead in leads:
-            row = Element("row", no=str(no))
-            root.append(row)
-            
-            assert type(lead) == dict, "Leads must be dictionaries inside a list, got:" + str(type(lead))
-            
-            for key, value in lead.items():
-                # <FL val="Lead Source">Web Download</FL>
-                # <FL val="First Name">contacto 1</FL>
-                fl = Element("FL", val=key)
-                if type(value) == dict: # If it's an attached module, accept multiple groups
-                    mod_attach_no = 1
-                    for module_key, module_value in value.items(): # The first group defines the module name, yank that and iterate through the contents
-                        for mod_item in module_value:
-                            mod_fl = SubElement(fl, module_key, no=str(mod_attach_no))
-                            for mod_item_key, mod_item_value in mod_item.items():
-                                attach_fl = SubElement(mod_fl, "FL", val=mod_item_key)
-                                attach_fl.text = mod_item_value
-                            mod_attach_no += 1
-                elif type(value) != str:
-                    fl.text = str(value)
-                else:
-                    fl.text = value
-                row.append(fl)
-            no += 1
-        return root
+        """ @return: XML payload string """
+        return self.serializer.serialize(module, leads)
     
     """ Define the standard parameter for the XML data """
     parameter_xml = 'xmlData'
+    
+    """ Where the API lives, can be overridden with api_url parameter """
+    api_url = "https://crm.zoho.com"
+
+    """ Maximum number of rows Zoho accepts in one write call """
+    max_rows_per_call = 100
+
+    """ Serializes the XML payloads, see L{mfabrik.zoho.serializer.XMLSerializer} """
+    serializer = default_serializer
 
     def get_service_name(self):
         """ Called by base class """
@@ -109,13 +169,70 @@ class CRM(Connection):
         
         post.update(extra_post_parameters)
         
-        response = self.do_xml_call("https://crm.zoho.com/crm/private/xml/" + module + "/insertRecords", post, xmldata)
+        response = self.insert_xml(module, xmldata, post)
         
-        self.check_successful_xml(response)
+        return response.get_inserted_records()
+    
+    def insert_xml(self, module, xml, extra_post_parameters={}):
+        """ Insert records from an already built XML payload.
+        
+        Use when the XML is built elsewhere, e.g. in another process.
+        
+        @param xml: XML string or ElementTree root element, see L{mfabrik.zoho.serializer.XMLSerializer}
+        
+        @param extra_post_parameters: Parameters appended to the HTTP POST call,
+            like duplicateCheck or version.
         
-        return self.get_inserted_records(response)
+        @return: L{mfabrik.zoho.core.ZohoResponse}. Use its get_inserted_records(), or
+            get_row_results() if the call was made with version=4.
+        """
+        self.ensure_opened()
+        
+        return self.xml_request(self.api_url + "/crm/private/xml/" + module + "/insertRecords", extra_post_parameters, xml, check="xml")
     
-    def get_records(self, selectColumns='leads(First Name,Last Name,Company)', parameters={}):
+    def insert_records_bulk(self, module, leads, extra_post_parameters={}, chunk_size=None, max_workers=4):
+        """ Insert any number of records to Zoho CRM.
+        
+        Records are split to chunks Zoho accepts in one call and the chunks
+        are sent in parallel. A failing chunk does not stop the others, and
+        the results of the chunks which went in are always returned.
+        
+        Connections are taken from the connection pool, so its maxsize
+        should be at least max_workers.
+        
+        @param leads: List of dictionaries, see L{insert_records}
+        
+        @param chunk_size: Records per API call. Default is max_rows_per_call.
+        
+        @param max_workers: Number of API calls in flight at once
+        
+        @return: List in the order of leads, with the inserted record details,
+            or the exception which failed the chunk of the record
+        """
+        
+        def insert(chunk):
+            inserted = self.insert_records(module, chunk, extra_post_parameters)
+            if len(inserted) != len(chunk):
+                raise ZohoException("Got %d results for %d inserted records" % (len(inserted), len(chunk)))
+            return inserted
+        
+        records = []
+        pool = WorkerPool(max_workers)
+        try:
+            chunks = chunked(leads, chunk_size or self.max_rows_per_call)
+            futures = [(chunk, pool.submit(insert, chunk)) for chunk in chunks]
+            for chunk, future in futures:
+                error = future.exception()
+                if error is None:
+                    records.extend(future.result())
+                else:
+                    records.extend([error] * len(chunk))
+        finally:
+            pool.shutdown()
+        
+        return records
+    
+    def get_records(self, selectColumns='leads(First Name,Last Name,Company)', parameters={}, module="Leads", stream=False, compact=False):
         """ 
         
         http://zohocrmapi.wiki.zoho.com/getRecords-Method.html
@@ -126,6 +243,14 @@ class CRM(Connection):
         @param parameters: Dictionary of filtering parameters which are part of HTTP POST to Zoho.
             For example parameters see Zoho CRM API docs.
         
+        @param module: Zoho CRM module name, like Leads or Contacts.
+        
+        @param stream: Parse the response incrementally while it is being read from the network
+            and return a generator instead of a list. Use for large pages.
+        
+        @param compact: Return L{mfabrik.zoho.compact.ResultSet} which stores the field names
+            only once, instead of a list of dictionaries. Not used with stream.
+        
         @return: Python list of dictionarizied leads. Each dictionary contains lead key-value pairs. LEADID column is always included.
         
         """
@@ -139,19 +264,83 @@ class CRM(Connection):
         
         post_params.update(parameters)
         
-        response = self.do_call("https://crm.zoho.com/crm/private/json/Leads/getRecords", post_params)
+        url = self.api_url + "/crm/private/json/" + module + "/getRecords"
+        
+        if stream:
+            return self.stream_records(url, post_params)
+        
+        response = self.request(url, post_params, check="json", idempotent=True)
         
         # raw data looks like {'response': {'result': {'Leads': {'row': [{'FL': [{'content': '177376000000142085', 'val': 'LEADID'}, ...
-        data =  decode_json(response)
+        data = response.json()
+        
+        return self._parse_json_response(data, module, compact)
+    
+    def iter_records(self, selectColumns='leads(First Name,Last Name,Company)', parameters={}, module="Leads", page_size=200):
+        """ Iterate over all records of a module, page by page.
+        
+        Pages are fetched with L{get_records} using fromIndex and toIndex.
+        The next page is fetched in the background while the caller
+        processes the current one, so at most two pages are held in memory.
+        
+        @param selectColumns: See L{get_records}
+        
+        @param parameters: See L{get_records}. fromIndex and toIndex are set by the iterator.
+        
+        @param module: Zoho CRM module name
+        
+        @param page_size: Records per API call. Zoho allows 200 at most.
+        
+        @return: Generator yielding one record dictionary at a time
+        """
         
-        return self._parse_json_response(data)
+        def fetch(number):
+            page_parameters = parameters.copy()
+            page_parameters["fromIndex"] = number * page_size + 1
+            page_parameters["toIndex"] = (number + 1) * page_size
+            return self.get_records(selectColumns, page_parameters, module)
+        
+        return iter_pages(fetch, page_size)
     
-    def delete_record(self, id, parameters={}):
+    def get_deleted_record_ids(self, module="Leads", lastModifiedTime=None, parameters={}):
+        """ List records which have been deleted.
+        
+        https://www.zoho.com/crm/help/api/getdeletedrecordids.html
+        
+        @param module: Zoho CRM module name
+        
+        @param lastModifiedTime: String, like 2010-06-27 21:37:20. Only list records deleted after this time.
+        
+        @param parameters: Extra HTTP post parameters, like fromIndex and toIndex
+        
+        @return: List of record ids
+        """
+        self.ensure_opened()
+        
+        post_params = {}
+        if lastModifiedTime is not None:
+            post_params["lastModifiedTime"] = lastModifiedTime
+        post_params.update(parameters)
+        
+        response = self.request(self.api_url + "/crm/private/json/" + module + "/getDeletedRecordIds", post_params, check="json", idempotent=True)
+        
+        # raw data looks like {'response': {'result': {'DeletedIDs': '177376000000142085,177376000000142087'}, ...
+        data = response.json()
+        
+        if data["response"].get("nodata"):
+            return []
+        
+        ids = data["response"]["result"].get("DeletedIDs") or ""
+        return [id for id in ids.split(",") if id]
+    
+    def delete_record(self, id, parameters={}, module="Leads"):
         """ Delete one record from Zoho CRM.
         
         @param id: Record id
         
         @param parameters: Extra HTTP post parameters        
+        
+        @param module: Zoho CRM module name
         """
         self.ensure_opened()
         
@@ -159,9 +348,52 @@ class CRM(Connection):
         post_params["id"] = id
         post_params.update(parameters)
         
-        response = self.do_call("https://crm.zoho.com/crm/private/xml/Leads/deleteRecords", post_params)
+        try:
+            self.request(self.api_url + "/crm/private/xml/" + module + "/deleteRecords", post_params, check="xml", idempotent=True)
+        finally:
+            self._invalidate(module, id)
+    
+    def delete_records(self, ids, module="Leads", chunk_size=None, max_workers=4):
+        """ Delete any number of records from Zoho CRM.
+        
+        Ids are sent to deleteRecords in chunks using its idlist parameter,
+        and the chunks are deleted in parallel. A failing chunk does not
+        stop the others.
+        
+        @param ids: List of record ids
+        
+        @param module: Zoho CRM module name
+        
+        @param chunk_size: Ids per API call. Default is max_rows_per_call.
         
-        self.check_successful_xml(response)
+        @param max_workers: Number of API calls in flight at once
+        
+        @return: Dictionary mapping each id to None if it was deleted,
+            or to the exception which failed its chunk
+        """
+        self.ensure_opened()
+        
+        url = self.api_url + "/crm/private/xml/" + module + "/deleteRecords"
+        
+        def delete(chunk):
+            try:
+                self.request(url, {"idlist": ";".join([str(id) for id in chunk])}, check="xml", idempotent=True)
+            finally:
+                for id in chunk:
+                    self._invalidate(module, id)
+        
+        results = {}
+        pool = WorkerPool(max_workers)
+        try:
+            futures = [(chunk, pool.submit(delete, chunk)) for chunk in chunked(ids, chunk_size or self.max_rows_per_call)]
+            for chunk, future in futures:
+                error = future.exception()
+                for id in chunk:
+                    results[id] = error
+        finally:
+            pool.shutdown()
+        
+        return results
     
     def update_record(self, module, id, lead):
         """ Update record in Zoho CRM database.
@@ -185,38 +417,189 @@ class CRM(Connection):
             'id': id,
         }
         
-        response = self.do_xml_call("https://crm.zoho.com/crm/private/xml/" + module + "/updateRecords", post, xmldata)
+        try:
+            response = self.xml_request(self.api_url + "/crm/private/xml/" + module + "/updateRecords", post, xmldata, check="xml", idempotent=True)
+        finally:
+            # Even a failed update may have changed the record
+            self._invalidate(module, id)
+        
+        return response.get_inserted_records()
+    
+    def update_records(self, module, records, extra_post_parameters={}, chunk_size=None, max_workers=4):
+        """ Update any number of records in Zoho CRM.
+        
+        Many records are packed to each updateRecords call, with the record
+        ids inline in the XML. The calls are made in parallel.
+        
+        https://www.zoho.com/crm/help/api/updaterecords.html
+        
+        @param records: Dictionary mapping record id to dictionary of changed fields
+        
+        @param extra_post_parameters: Parameters appended to the HTTP POST call.
+        
+        @param chunk_size: Records per API call. Default is max_rows_per_call.
+        
+        @param max_workers: Number of API calls in flight at once
+        
+        @return: Dictionary mapping each id to its updated record details,
+            or to the exception if the update of the record failed
+        """
+        self.ensure_opened()
+        
+        url = self.api_url + "/crm/private/xml/" + module + "/updateRecords"
+        
+        post = {
+            'newFormat': 1,
+            'version': 4,
+        }
+        post.update(extra_post_parameters)
+        
+        def update(chunk):
+            rows = []
+            for id, fields in chunk:
+                row = fields.copy()
+                row["Id"] = id
+                rows.append(row)
+            
+            try:
+                response = self.xml_request(url, post, self._prepare_xml_request(module, rows), check="xml", idempotent=True)
+            finally:
+                for id, fields in chunk:
+                    self._invalidate(module, id)
+            
+            # Rows are numbered from 1 in the order they were sent
+            row_results = response.get_row_results()
+            results = {}
+            for no, (id, fields) in enumerate(chunk):
+                results[id] = row_results.get(no + 1, ZohoException("No result for updated record:" + str(id)))
+            return results
+        
+        results = {}
+        pool = WorkerPool(max_workers)
+        try:
+            chunks = chunked(records.items(), chunk_size or self.max_rows_per_call)
+            futures = [(chunk, pool.submit(update, chunk)) for chunk in chunks]
+            for chunk, future in futures:
+                error = future.exception()
+                if error is None:
+                    results.update(future.result())
+                else:
+                    for id, fields in chunk:
+                        results[id] = error
+        finally:
+            pool.shutdown()
         
-        self.check_successful_xml(response)
+        return results
     
-    def get_record_by_id(self, id):
+    def get_record_by_id(self, id, module="Leads"):
         """
         
         https://www.zoho.com/crm/help/api/getrecordbyid.html
         
         @param id: String. Lead id to fetch.
         
+        @param module: Zoho CRM module name
+        
         @return: Python dictionary which contains lead key-value pairs.
+            If the CRM has a cache, the record may come from the cache.
         
         """
         self.ensure_opened()
         
+        if self.cache is not None:
+            record = self.cache.get(self._cache_key(module, id))
+            if record is not None:
+                # Callers may modify the returned dictionary
+                return dict(record)
         
         post_params = {
             "id": id,
             "newFormat" : 2
         }
         
-        response = self.do_call("https://crm.zoho.com/crm/private/json/Leads/getRecordById", post_params)
+        response = self.request(self.api_url + "/crm/private/json/" + module + "/getRecordById", post_params, check="json", idempotent=True)
         
         # raw data looks like {'response': {'result': {'Leads': {'row': [{'FL': [{'content': '177376000000142085', 'val': 'LEADID'}, ...
-        data =  decode_json(response)
+        data = response.json()
+        
+        parsed = self._parse_json_response(data, module)
+        
+        if not len(parsed):
+            return None
+        
+        if self.cache is not None:
+            self.cache.set(self._cache_key(module, id), dict(parsed[0]))
+        
+        return parsed[0]
+    
+    def get_records_by_ids(self, ids, module="Leads", chunk_size=None, max_workers=4):
+        """ Fetch many records by their ids.
+        
+        Ids are sent to getRecordById in chunks using its idlist parameter,
+        and the chunks are fetched in parallel. If the CRM has a cache,
+        cached records are not fetched again.
         
-        parsed = self._parse_json_response(data)
+        @param ids: List of record ids
         
-        return parsed[0] if len(parsed) else None
+        @param module: Zoho CRM module name
+        
+        @param chunk_size: Ids per API call. Default is max_rows_per_call.
+        
+        @param max_workers: Number of API calls in flight at once
+        
+        @return: Dictionary mapping id to record dictionary. Records which were not found are left out.
+        """
+        self.ensure_opened()
+        
+        records = {}
+        missing = []
+        for id in ids:
+            id = str(id)
+            if id in records:
+                continue
+            if self.cache is not None:
+                record = self.cache.get(self._cache_key(module, id))
+                if record is not None:
+                    records[id] = dict(record)
+                    continue
+            # Placeholder, so that duplicate ids are fetched once
+            records[id] = None
+            missing.append(id)
+        
+        url = self.api_url + "/crm/private/json/" + module + "/getRecordById"
+        id_column = self.get_id_column(module)
+        
+        def fetch(chunk):
+            post_params = {
+                "idlist": ";".join(chunk),
+                "newFormat": 2
+            }
+            response = self.request(url, post_params, check="json", idempotent=True)
+            return self._parse_json_response(response.json(), module)
+        
+        if len(missing) <= (chunk_size or self.max_rows_per_call):
+            # No need for threads
+            pages = [fetch(missing)] if missing else []
+        else:
+            pool = WorkerPool(max_workers)
+            try:
+                pages = pool.map(fetch, chunked(missing, chunk_size or self.max_rows_per_call))
+            finally:
+                pool.shutdown()
+        
+        for id in missing:
+            del records[id]
+        
+        for page in pages:
+            for record in page:
+                id = record.get(id_column)
+                records[id] = record
+                if self.cache is not None:
+                    self.cache.set(self._cache_key(module, id), dict(record))
+        
+        return records
     
-    def search_records(self, searchCondition, selectColumns='leads(First Name,Last Name,Company)'):
+    def search_records(self, searchCondition, selectColumns='leads(First Name,Last Name,Company)', stream=False, compact=False, module="Leads"):
         """
         
         https://www.zoho.com/crm/help/api/getsearchrecords.html
@@ -226,6 +609,12 @@ class CRM(Connection):
         @param selectColumns: String. What columns to query. For example query format,
             see API doc. Default is leads(First Name,Last Name,Company).
         
+        @param stream: Return a generator which parses the response incrementally, see L{get_records}.
+        
+        @param compact: Return compact result set, see L{get_records}.
+        
+        @param module: Zoho CRM module name
+        
         @return: Python list of dictionarizied leads. Each dictionary contains lead key-value pairs. LEADID column is always included.
         
         """
@@ -238,14 +627,19 @@ class CRM(Connection):
             "newFormat" : 2
         }
         
-        response = self.do_call("https://crm.zoho.com/crm/private/json/Leads/getSearchRecords", post_params)
+        url = self.api_url + "/crm/private/json/" + module + "/getSearchRecords"
+        
+        if stream:
+            return self.stream_records(url, post_params)
+        
+        response = self.request(url, post_params, check="json", idempotent=True)
         
         # raw data looks like {'response': {'result': {'Leads': {'row': [{'FL': [{'content': '177376000000142085', 'val': 'LEADID'}, ...
-        data =  decode_json(response)
+        data = response.json()
         
-        return self._parse_json_response(data)
+        return self._parse_json_response(data, module, compact)
     
-    def search_records_pdc(self, searchColumn, searchValue, selectColumns='leads(First Name,Last Name,Company)'):
+    def search_records_pdc(self, searchColumn, searchValue, selectColumns='leads(First Name,Last Name,Company)', stream=False, compact=False, module="Leads"):
         """
         
         https://www.zoho.com/crm/help/api/getsearchrecordsbypdc.html
@@ -257,6 +651,12 @@ class CRM(Connection):
         @param selectColumns: String. What columns to query. For example query format,
             see API doc. Default is leads(First Name,Last Name,Company).
         
+        @param stream: Return a generator which parses the response incrementally, see L{get_records}.
+        
+        @param compact: Return compact result set, see L{get_records}.
+        
+        @param module: Zoho CRM module name
+        
         @return: Python list of dictionarizied leads. Each dictionary contains lead key-value pairs. LEADID column is always included.
         
         """
@@ -270,9 +670,14 @@ class CRM(Connection):
             "newFormat" : 2
         }
         
-        response = self.do_call("https://crm.zoho.com/crm/private/json/Leads/getSearchRecordsByPDC", post_params)
+        url = self.api_url + "/crm/private/json/" + module + "/getSearchRecordsByPDC"
+        
+        if stream:
+            return self.stream_records(url, post_params)
+        
+        response = self.request(url, post_params, check="json", idempotent=True)
         
         # raw data looks like {'response': {'result': {'Leads': {'row': [{'FL': [{'content': '177376000000142085', 'val': 'LEADID'}, ...
-        data =  decode_json(response)
+        data = response.json()
         
-        return self._parse_json_response(data)
+        return self._parse_json_response(data, module, compact)
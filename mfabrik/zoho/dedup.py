@@ -0,0 +1,315 @@
+"""
+
+    Local duplicate detection before inserting records.
+
+    insertRecords with duplicateCheck lets Zoho find duplicates, but each
+    duplicate still costs a row in an API call. When most records of an
+    import already exist, it is cheaper to keep a local index of the
+    records in Zoho, and to skip the known ones or update them by id
+    before anything is sent.
+
+    Records are identified by configurable fields, like Email or
+    Company and Last Name. Values are compared case insensitively and
+    with whitespace normalized.
+
+        * L{DedupIndex} knows the id of each record. It is held in memory,
+          or in a dbm file if a path is given.
+
+        * L{BloomDedupIndex} is a Bloom filter using a fraction of the memory.
+          It does not know ids, and a small share of new records is
+          wrongly taken for duplicates.
+
+    Example::
+
+        index = DedupIndex(["Email"], path="/var/lib/zoho/leads.db")
+        if not len(index):
+            index.seed(crm, "Leads")
+
+        result = insert_new_records(crm, "Leads", records, index, on_duplicate="update")
+
+"""
+
+__copyright__ = "2010 mFabrik Research Oy"
+__author__ = "Mikko Ohtamaa <mikko@mfabrik.com>"
+__license__ = "GPL"
+__docformat__ = "Epytext"
+
+import anydbm
+import hashlib
+import math
+import struct
+import threading
+
+from export import Exporter
+
+
+def normalize(value):
+    """ @return: Value as comparable unicode string """
+    if not isinstance(value, unicode):
+        value = str(value).decode("utf-8")
+    return u" ".join(value.lower().split())
+
+
+class DedupIndex(object):
+    """ Exact index of records known to exist in Zoho, mapping them to their ids.
+
+    Thread safe.
+    """
+
+    #: Index knows the ids of the records, so duplicates can be updated
+    exact = True
+
+    def __init__(self, fields, path=None):
+        """
+        @param fields: Names of the fields identifying a record, like ["Email"]
+
+        @param path: dbm file to keep the index in, or None to hold it in memory
+        """
+        self.fields = list(fields)
+        self.path = path
+        self._lock = threading.Lock()
+        if path is None:
+            self._entries = {}
+        else:
+            self._entries = anydbm.open(path, "c")
+
+    def key(self, record):
+        """ Hash of the identifying field values of a record.
+
+        @return: Digest string, or None if any of the fields is empty.
+            Such records are never taken for duplicates.
+        """
+        values = []
+        for field in self.fields:
+            value = record.get(field)
+            if value is None:
+                return None
+            value = normalize(value)
+            if not value:
+                return None
+            values.append(value)
+        return hashlib.sha1(u"\x1f".join(values).encode("utf-8")).digest()
+
+    def get(self, record):
+        """ @return: Id of the existing record, or None if the record is not known """
+        key = self.key(record)
+        if key is None:
+            return None
+        return self.lookup(key)
+
+    def __contains__(self, record):
+        return self.get(record) is not None
+
+    def __len__(self):
+        self._lock.acquire()
+        try:
+            return len(self._entries)
+        finally:
+            self._lock.release()
+
+    def lookup(self, key):
+        """ @return: Id stored for a key, or None """
+        self._lock.acquire()
+        try:
+            if key in self._entries:
+                return self._entries[key]
+            return None
+        finally:
+            self._lock.release()
+
+    def add(self, record, id):
+        """ Remember a record which exists in Zoho.
+
+        @param record: Record dictionary having the identifying fields
+
+        @param id: Zoho id of the record
+        """
+        key = self.key(record)
+        if key is not None and id is not None:
+            self.store(key, id)
+
+    def store(self, key, id):
+        self._lock.acquire()
+        try:
+            self._entries[key] = str(id)
+        finally:
+            self._lock.release()
+
+    def seed(self, crm, module="Leads", **kwargs):
+        """ Add all records of a Zoho module to the index.
+
+        Only the identifying fields are fetched.
+
+        @param crm: L{mfabrik.zoho.crm.CRM} connection
+
+        @param kwargs: Passed to L{mfabrik.zoho.export.Exporter}, like max_workers
+
+        @return: Number of records read
+        """
+        id_column = crm.get_id_column(module)
+        columns = "%s(%s)" % (module, ",".join(self.fields))
+        count = 0
+        for record in Exporter(crm, module, columns, **kwargs).iter_records():
+            self.add(record, record.get(id_column))
+            count += 1
+        self.sync()
+        return count
+
+    def sync(self):
+        """ Write the index to disk """
+        if self.path is not None and hasattr(self._entries, "sync"):
+            self._lock.acquire()
+            try:
+                self._entries.sync()
+            finally:
+                self._lock.release()
+
+    def close(self):
+        if self.path is not None:
+            self._lock.acquire()
+            try:
+                self._entries.close()
+            finally:
+                self._lock.release()
+
+
+class BloomFilter(object):
+    """ Set of digests with a fixed memory use and false positives """
+
+    def __init__(self, capacity, error_rate=0.001):
+        """
+        @param capacity: Number of items before the error rate is exceeded
+
+        @param error_rate: Share of unknown items reported as known
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / float(capacity) * math.log(2))))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, digest):
+        # Double hashing from the two halves of a SHA-1 digest
+        h1, h2 = struct.unpack("<QQ", digest[:16])
+        for i in xrange(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, digest):
+        for position in self._positions(digest):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, digest):
+        for position in self._positions(digest):
+            if not self._bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class BloomDedupIndex(DedupIndex):
+    """ Index of records known to exist in Zoho, as a Bloom filter.
+
+    Uses about 1.8 bytes per record at the default error rate. Records
+    are reported as known with True instead of their id, so duplicates
+    can be skipped only.
+    """
+
+    exact = False
+
+    def __init__(self, fields, capacity=1000000, error_rate=0.001):
+        """
+        @param fields: Names of the fields identifying a record
+
+        @param capacity: Number of records the filter is sized for
+
+        @param error_rate: Share of new records wrongly taken for duplicates
+        """
+        DedupIndex.__init__(self, fields)
+        self._entries = BloomFilter(capacity, error_rate)
+
+    def __len__(self):
+        return self._entries.count
+
+    def lookup(self, key):
+        self._lock.acquire()
+        try:
+            return key in self._entries or None
+        finally:
+            self._lock.release()
+
+    def store(self, key, id):
+        self._lock.acquire()
+        try:
+            self._entries.add(key)
+        finally:
+            self._lock.release()
+
+
+def insert_new_records(crm, module, records, index, on_duplicate="skip", extra_post_parameters={}, **kwargs):
+    """ Insert the records which are not in the index.
+
+    Records already in the index are skipped, or updated by their id.
+    Of records repeated in the list, only the first one is inserted.
+    The inserted records are added to the index.
+
+    @param crm: L{mfabrik.zoho.crm.CRM} connection
+
+    @param index: L{DedupIndex} of the module
+
+    @param on_duplicate: "skip" or "update". Updating needs an exact index.
+
+    @param extra_post_parameters: Parameters appended to the insertRecords calls
+
+    @param kwargs: Passed to L{mfabrik.zoho.crm.CRM.insert_records_bulk}, like max_workers
+
+    @return: Dictionary with the list of inserted record details, the list of skipped records,
+        the list of (record, exception) tuples of records which failed to insert,
+        and the update results as returned by L{mfabrik.zoho.crm.CRM.update_records}
+    """
+    if on_duplicate not in ("skip", "update"):
+        raise ValueError("Unknown on_duplicate action:" + on_duplicate)
+    if on_duplicate == "update" and not index.exact:
+        raise ValueError("Updating duplicates needs an index knowing the record ids")
+
+    new = []
+    skipped = []
+    updates = {}
+    seen = set()
+
+    for record in records:
+        key = index.key(record)
+        if key is None:
+            new.append(record)
+            continue
+
+        if key in seen:
+            skipped.append(record)
+            continue
+        seen.add(key)
+
+        id = index.lookup(key)
+        if id is None:
+            new.append(record)
+        elif on_duplicate == "update":
+            updates[id] = record
+        else:
+            skipped.append(record)
+
+    inserted = []
+    failed = []
+    if new:
+        results = crm.insert_records_bulk(module, new, extra_post_parameters, **kwargs)
+        for record, result in zip(new, results):
+            if isinstance(result, Exception):
+                failed.append((record, result))
+            else:
+                inserted.append(result)
+                index.add(record, result.get("Id"))
+        index.sync()
+
+    updated = {}
+    if updates:
+        updated = crm.update_records(module, updates, **kwargs)
+
+    return {"inserted": inserted, "skipped": skipped, "failed": failed, "updated": updated}
@@ -0,0 +1,200 @@
+"""
+
+    Parallel export of Zoho CRM modules to JSON lines and CSV files.
+
+    Pages of a module are fetched with several getRecords calls in flight
+    at once. Records are written in the order Zoho returns them, and at
+    most one page per worker is held in memory, so modules of any size
+    can be exported.
+
+    Command line::
+
+        zoho-export --authtoken 123123123 --module Contacts contacts.csv
+
+    From Python::
+
+        exporter = Exporter(crm, "Contacts", max_workers=8)
+        f = open("contacts.jsonl", "wb")
+        exporter.write_jsonl(f)
+
+"""
+
+__copyright__ = "2010 mFabrik Research Oy"
+__author__ = "Mikko Ohtamaa <mikko@mfabrik.com>"
+__license__ = "GPL"
+__docformat__ = "Epytext"
+
+import csv
+import optparse
+import os
+import re
+
+from core import simplejson
+from crm import CRM
+from pool import ConnectionPool
+from retry import RetryPolicy
+from workers import iter_pages
+
+_select_columns = re.compile(r"^\w+\((.*)\)$")
+
+
+class Exporter(object):
+    """ Read all records of a module with pages fetched in parallel """
+
+    def __init__(self, crm, module="Leads", selectColumns="All", parameters={}, page_size=200, max_workers=4):
+        """
+        @param crm: L{mfabrik.zoho.crm.CRM} connection. Its connection pool should
+            have room for max_workers connections.
+
+        @param module: Zoho CRM module name
+
+        @param selectColumns: Columns to export, see L{mfabrik.zoho.crm.CRM.get_records}
+
+        @param parameters: Extra getRecords parameters, like sortColumnString or lastModifiedTime
+
+        @param page_size: Records per call. Zoho allows 200 at most.
+
+        @param max_workers: Number of pages fetched at once
+        """
+        self.crm = crm
+        self.module = module
+        self.selectColumns = selectColumns
+        self.parameters = parameters
+        self.page_size = page_size
+        self.max_workers = max_workers
+
+    def fetch_page(self, number):
+        """
+        @param number: Page number, starting from 0
+
+        @return: List of record dictionaries
+        """
+        parameters = self.parameters.copy()
+        parameters["fromIndex"] = number * self.page_size + 1
+        parameters["toIndex"] = (number + 1) * self.page_size
+        return self.crm.get_records(self.selectColumns, parameters, self.module)
+
+    def iter_records(self):
+        """ Iterate over all records of the module in order.
+
+        @return: Generator yielding record dictionaries
+        """
+        return iter_pages(self.fetch_page, self.page_size, self.max_workers)
+
+    def write_jsonl(self, f):
+        """ Write records as JSON lines.
+
+        @param f: File opened for writing
+
+        @return: Number of written records
+        """
+        count = 0
+        for record in self.iter_records():
+            f.write(simplejson.dumps(record) + "\n")
+            count += 1
+        return count
+
+    def get_columns(self):
+        """ @return: Column names from selectColumns, or None if they are not listed """
+        match = _select_columns.match(self.selectColumns)
+        if not match:
+            return None
+        return [column.strip() for column in match.group(1).split(",")]
+
+    def write_csv(self, f, columns=None, encoding="utf-8"):
+        """ Write records as CSV with a header row.
+
+        @param f: File opened for writing in binary mode
+
+        @param columns: Column names in order. By default the columns listed in
+            selectColumns, or if all columns are selected, the fields of the first record.
+            Fields not in the columns are left out.
+
+        @return: Number of written records
+        """
+        records = self.iter_records()
+        count = 0
+
+        first = None
+        if columns is None:
+            columns = self.get_columns()
+            if columns is None:
+                for first in records:
+                    columns = sorted(first.keys())
+                    break
+                else:
+                    columns = []
+
+        writer = csv.writer(f)
+        writer.writerow([column.encode(encoding) for column in columns])
+
+        def write(record):
+            writer.writerow([unicode(record.get(column, "")).encode(encoding) for column in columns])
+
+        if first is not None:
+            write(first)
+            count += 1
+
+        for record in records:
+            write(record)
+            count += 1
+        return count
+
+
+def export(crm, module, path, format=None, **kwargs):
+    """ Export all records of a module to a file.
+
+    @param format: "csv" or "jsonl". By default guessed from the file name extension.
+
+    @param kwargs: Passed to L{Exporter}
+
+    @return: Number of exported records
+    """
+    if format is None:
+        if os.path.splitext(path)[1].lower() == ".csv":
+            format = "csv"
+        else:
+            format = "jsonl"
+
+    exporter = Exporter(crm, module, **kwargs)
+    f = open(path, "wb")
+    try:
+        if format == "csv":
+            return exporter.write_csv(f)
+        elif format == "jsonl":
+            return exporter.write_jsonl(f)
+        else:
+            raise ValueError("Unknown file format:" + format)
+    finally:
+        f.close()
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] FILE", description="Export Zoho CRM module to CSV or JSON lines file")
+    parser.add_option("--authtoken", default=os.environ.get("ZOHO_AUTHTOKEN"), help="Zoho API authtoken, default from ZOHO_AUTHTOKEN environment variable")
+    parser.add_option("--scope", default="crmapi")
+    parser.add_option("--api-url", default=None, help="Zoho CRM base URL")
+    parser.add_option("--module", default="Leads", help="Zoho CRM module name")
+    parser.add_option("--columns", default="All", help="Zoho selectColumns, like 'Leads(First Name,Last Name)'")
+    parser.add_option("--format", default=None, help="csv or jsonl, default is guessed from the file name")
+    parser.add_option("--workers", type="int", default=4, help="API calls in flight at once")
+    options, args = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error("Give the file to export to")
+    if not options.authtoken:
+        parser.error("Zoho authtoken is needed")
+
+    kwargs = {}
+    if options.api_url:
+        kwargs["api_url"] = options.api_url
+
+    crm = CRM(authtoken=options.authtoken, scope=options.scope, pool=ConnectionPool(maxsize=options.workers),
+              retry_policy=RetryPolicy(), **kwargs)
+
+    count = export(crm, options.module, args[0], options.format, selectColumns=options.columns, max_workers=options.workers)
+    print "%d records exported" % count
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,569 @@
+"""
+
+    Local stand-in for Zoho API servers.
+
+    Implements enough of the Zoho CRM and Support APIs to run the client
+    against without Zoho credentials: for offline tests and benchmarks.
+    Records are kept in memory.
+
+    Example::
+
+        server = FakeZohoServer(latency=0.05)
+        server.start()
+        server.seed("Leads", 1000)
+
+        crm = CRM(authtoken="fake", scope="crmapi", api_url=server.url)
+        leads = crm.get_records()
+
+        server.stop()
+
+"""
+
+__copyright__ = "2010 mFabrik Research Oy"
+__author__ = "Mikko Ohtamaa <mikko@mfabrik.com>"
+__license__ = "GPL"
+__docformat__ = "Epytext"
+
+import BaseHTTPServer
+import SocketServer
+import cgi
+import re
+import threading
+import time
+import zlib
+
+from collections import OrderedDict
+from xml.sax.saxutils import escape, quoteattr
+
+from core import fromstring, gzip_compress, simplejson
+
+#: Fields Zoho requires when inserting to a module
+MANDATORY_FIELDS = {
+    "Leads": ("Last Name", "Company"),
+}
+
+#: Zoho limits for rows per call
+MAX_WRITE_ROWS = 100
+MAX_READ_ROWS = 200
+
+_search_condition = re.compile(r"^\((.+?)\|(.+?)\|(.*)\)$")
+_select_columns = re.compile(r"^\w+\((.*)\)$")
+
+
+def id_column(module):
+    """ @return: Name of the id field of a module, like LEADID """
+    return module[:-1].upper() + "ID"
+
+
+def now():
+    return time.strftime("%Y-%m-%d %H:%M:%S")
+
+
+class ZohoError(Exception):
+    """ Error returned to the client as Zoho error response """
+
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+        self.message = message
+
+
+class RecordStore(object):
+    """ In-memory records of all modules """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # module -> id -> record dictionary
+        self.modules = {}
+        # module -> list of (id, deletion time)
+        self.deleted = {}
+        self.next_id = 177376000000000001
+
+    def get_module(self, module):
+        return self.modules.setdefault(module, OrderedDict())
+
+    def insert(self, module, fields):
+        self.lock.acquire()
+        try:
+            id = str(self.next_id)
+            self.next_id += 1
+            timestamp = now()
+            record = OrderedDict()
+            record[id_column(module)] = id
+            record.update(fields)
+            record["Created Time"] = timestamp
+            record["Modified Time"] = timestamp
+            record["Created By"] = "Fake"
+            record["Modified By"] = "Fake"
+            self.get_module(module)[id] = record
+            return record
+        finally:
+            self.lock.release()
+
+    def update(self, module, id, fields):
+        self.lock.acquire()
+        try:
+            record = self.get_module(module).get(id)
+            if record is None:
+                raise ZohoError(4103, "Record does not exist")
+            record.update(fields)
+            record["Modified Time"] = now()
+            return record
+        finally:
+            self.lock.release()
+
+    def delete(self, module, id):
+        self.lock.acquire()
+        try:
+            if self.get_module(module).pop(id, None) is None:
+                raise ZohoError(4103, "Record does not exist")
+            self.deleted.setdefault(module, []).append((id, now()))
+        finally:
+            self.lock.release()
+
+    def records(self, module):
+        self.lock.acquire()
+        try:
+            return list(self.get_module(module).values())
+        finally:
+            self.lock.release()
+
+
+class FakeZohoHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Dispatch Zoho API calls to handler methods """
+
+    protocol_version = "HTTP/1.1"
+
+    # Send each response in one packet, so that delayed ACKs do not stall keep-alive connections
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    routes = [
+        (re.compile(r"^/crm/private/(xml|json)/(\w+)/(\w+)$"), "crm"),
+        (re.compile(r"^/api/(xml|json)/(requests)/(\w+)$"), "support"),
+        (re.compile(r"^/login$"), "login"),
+    ]
+
+    def log_message(self, format, *args):
+        # Keep test and benchmark output clean
+        pass
+
+    def do_GET(self):
+        self.handle_call("")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if self.headers.get("Content-Encoding", "").lower() == "gzip":
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        self.handle_call(body)
+
+    def handle_call(self, body):
+        server = self.server
+        server.count_request(self.path)
+        self.truncate = False
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        path, sep, query = self.path.partition("?")
+        params = dict(cgi.parse_qsl(query))
+        params.update(dict(cgi.parse_qsl(body, keep_blank_values=True)))
+
+        for pattern, name in self.routes:
+            match = pattern.match(path)
+            if match:
+                break
+        else:
+            self.send_body(404, "text/plain", "Not found")
+            return
+
+        if name == "login":
+            ticket = server.create_ticket()
+            self.send_body(200, "text/plain", "#\nGETUSERNAME=null\nWARNING=null\nPASS_EXPIRY=-1\nTICKET=%s\nRESULT=TRUE\n" % ticket)
+            return
+
+        format, module, method = match.groups()
+        if name == "support":
+            module = "Requests"
+
+        failure = server.pop_failure()
+        try:
+            if failure is not None:
+                status, code, message = failure
+                if status is None:
+                    # Like a server dropping an idle keep-alive connection
+                    self.close_connection = 1
+                    return
+                if status == "truncate":
+                    self.truncate = True
+                elif status != 200:
+                    self.send_body(status, "text/plain", message)
+                    return
+                else:
+                    raise ZohoError(code, message)
+
+            if "ticket" in params and not server.is_valid_ticket(params["ticket"]):
+                raise ZohoError(4834, "Invalid Ticket Id")
+
+            handler = getattr(self, "call_" + method, None)
+            if handler is None:
+                raise ZohoError(4600, "Unsupported method:" + method)
+
+            output = handler(module, params)
+        except ZohoError, e:
+            output = self.format_error(format, path, e)
+
+        if format == "json":
+            self.send_body(200, "application/json", output)
+        else:
+            self.send_body(200, "text/xml", output)
+
+    def send_body(self, status, content_type, body):
+        if isinstance(body, unicode):
+            body = body.encode("utf-8")
+        compress = self.server.compression and "gzip" in self.headers.get("Accept-Encoding", "")
+        if compress:
+            body = gzip_compress(body)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type + "; charset=UTF-8")
+        if compress:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.truncate:
+            # Connection lost in the middle of the response
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = 1
+        else:
+            self.wfile.write(body)
+
+    def format_error(self, format, path, error):
+        if format == "json":
+            return simplejson.dumps({"response": {"uri": path, "error": {"code": error.code, "message": error.message}}})
+        return '<response uri=%s><error><code>%s</code><message>%s</message></error></response>' % (quoteattr(path), error.code, escape(error.message))
+
+    # XML in
+
+    def parse_rows(self, params):
+        """ @return: List of field dictionaries from the posted XML """
+        xml = params.get("xmlData", params.get("xml"))
+        if not xml:
+            raise ZohoError(4600, "Unable to process your request. Please verify whether you have entered proper method name, parameter and parameter values.")
+
+        rows = []
+        for row in fromstring(xml).findall("row"):
+            fields = OrderedDict()
+            for fl in row.getchildren():
+                if fl.tag.lower() == "fl":
+                    fields[fl.get("val")] = fl.text or ""
+            rows.append(fields)
+        return rows
+
+    # XML out
+
+    def format_fields(self, fields):
+        return "".join(['<FL val=%s>%s</FL>' % (quoteattr(key), escape(value)) for key, value in fields])
+
+    def format_record_details(self, module, records, message):
+        details = []
+        for record in records:
+            details.append("<recorddetail>%s</recorddetail>" % self.format_fields([
+                ("Id", record[id_column(module)]),
+                ("Created Time", record["Created Time"]),
+                ("Modified Time", record["Modified Time"]),
+                ("Created By", record["Created By"]),
+                ("Modified By", record["Modified By"]),
+            ]))
+        return '<response uri=%s><result><message>%s</message>%s</result></response>' % (quoteattr(self.path), message, "".join(details))
+
+    # JSON out
+
+    def format_rows(self, module, records, params, cell_key="FL", select_key="selectColumns"):
+        if not records:
+            return simplejson.dumps({"response": {"nodata": {"code": "4422", "message": "There is no data to show"}, "uri": self.path}})
+
+        columns = self.selected_columns(module, params, select_key)
+        rows = []
+        for no, record in enumerate(records):
+            cells = [{"val": key, "content": value} for key, value in record.items() if columns is None or key in columns]
+            rows.append({"no": str(no + 1), cell_key: cells})
+
+        if len(rows) == 1:
+            # Zoho does not wrap single item to a list
+            rows = rows[0]
+
+        return simplejson.dumps({"response": {"uri": self.path, "result": {module: {"row": rows}}}})
+
+    def selected_columns(self, module, params, select_key="selectColumns"):
+        match = _select_columns.match(params.get(select_key, "All"))
+        if not match:
+            return None
+        columns = set([column.strip() for column in match.group(1).split(",")])
+        columns.add(id_column(module))
+        return columns
+
+    def page(self, records, params, from_key="fromIndex", to_key="toIndex"):
+        start = int(params.get(from_key, 1))
+        end = int(params.get(to_key, 20))
+        if end - start + 1 > MAX_READ_ROWS:
+            raise ZohoError(4600, "Unable to process your request. toIndex - fromIndex must not exceed 200.")
+        return records[start - 1:end]
+
+    # API methods
+
+    def call_insertRecords(self, module, params):
+        rows = self.parse_rows(params)
+        if len(rows) > MAX_WRITE_ROWS:
+            raise ZohoError(4600, "Unable to process your request. Maximum 100 records per call.")
+
+        store = self.server.store
+
+        if params.get("version") == "4":
+            # Each row succeeds or fails on its own
+            output = []
+            for no, fields in enumerate(rows):
+                try:
+                    self.check_mandatory(module, fields)
+                except ZohoError, e:
+                    output.append('<row no="%d"><error><code>%s</code><details>%s</details></error></row>' % (no + 1, e.code, escape(e.message)))
+                    continue
+                record = store.insert(module, fields)
+                details = self.format_fields([("Id", record[id_column(module)]), ("Created Time", record["Created Time"])])
+                output.append('<row no="%d"><success><code>2000</code><details>%s</details></success></row>' % (no + 1, details))
+            return '<response uri=%s><result>%s</result></response>' % (quoteattr(self.path), "".join(output))
+
+        for fields in rows:
+            self.check_mandatory(module, fields)
+
+        records = [store.insert(module, fields) for fields in rows]
+        return self.format_record_details(module, records, "Record(s) added successfully")
+
+    def check_mandatory(self, module, fields):
+        for name in MANDATORY_FIELDS.get(module, ()):
+            if not fields.get(name):
+                raise ZohoError(4401, "Unable to populate data, please check if mandatory value is entered correctly.")
+
+    def call_addrecords(self, module, params):
+        rows = self.parse_rows(params)
+        if len(rows) > MAX_WRITE_ROWS:
+            raise ZohoError(4600, "Unable to process your request. Maximum 100 records per call.")
+
+        records = []
+        for fields in rows:
+            # Requests belong to the department and portal they were added to
+            fields["Department"] = params.get("department", "")
+            fields["Portal"] = params.get("portal", "")
+            records.append(self.server.store.insert(module, fields))
+        return self.format_record_details(module, records, "Record(s) added successfully")
+
+    def call_updateRecords(self, module, params):
+        rows = self.parse_rows(params)
+        store = self.server.store
+
+        if params.get("version") != "4":
+            record = store.update(module, params.get("id"), rows[0])
+            return self.format_record_details(module, [record], "Record(s) updated successfully")
+
+        if len(rows) > MAX_WRITE_ROWS:
+            raise ZohoError(4600, "Unable to process your request. Maximum 100 records per call.")
+
+        output = []
+        for no, fields in enumerate(rows):
+            id = fields.pop("Id", None)
+            try:
+                record = store.update(module, id, fields)
+            except ZohoError, e:
+                output.append('<row no="%d"><error><code>%s</code><details>%s</details></error></row>' % (no + 1, e.code, escape(e.message)))
+            else:
+                details = self.format_fields([("Id", id), ("Modified Time", record["Modified Time"])])
+                output.append('<row no="%d"><success><code>2001</code><details>%s</details></success></row>' % (no + 1, details))
+        return '<response uri=%s><result>%s</result></response>' % (quoteattr(self.path), "".join(output))
+
+    def call_deleteRecords(self, module, params):
+        ids = [id for id in params.get("idlist", params.get("id", "")).split(";") if id]
+        if not ids:
+            raise ZohoError(4600, "Unable to process your request. Please verify whether you have entered proper method name, parameter and parameter values.")
+        for id in ids:
+            self.server.store.delete(module, id)
+        return '<response uri=%s><result><code>5000</code><message>Record Id(s) : %s,Record(s) deleted successfully</message></result></response>' % (quoteattr(self.path), ",".join(ids))
+
+    def call_getRecords(self, module, params):
+        records = self.server.store.records(module)
+        since = params.get("lastModifiedTime")
+        if since:
+            records = [record for record in records if record["Modified Time"] >= since]
+        return self.format_rows(module, self.page(records, params), params)
+
+    def call_getrecords(self, module, params):
+        """ Support getrecords, with lowercase parameters and fl cells """
+        records = self.server.store.records(module)
+        for field, param in (("Department", "department"), ("Portal", "portal")):
+            if params.get(param):
+                records = [record for record in records if record.get(field) == params[param]]
+        return self.format_rows(module, self.page(records, params, "fromindex", "toindex"), params, "fl", "selectfields")
+
+    def call_getRecordById(self, module, params):
+        records = self.server.store.get_module(module)
+        ids = [id for id in params.get("idlist", params.get("id", "")).split(";") if id]
+        if len(ids) > MAX_WRITE_ROWS:
+            raise ZohoError(4600, "Unable to process your request. Maximum 100 ids per call.")
+        return self.format_rows(module, [records[id] for id in ids if id in records], params)
+
+    def call_getSearchRecords(self, module, params):
+        match = _search_condition.match(params.get("searchCondition", ""))
+        if not match:
+            raise ZohoError(4832, "Invalid search condition")
+
+        field, operator, value = match.groups()
+        if operator == "=":
+            matches = lambda content: content == value
+        elif operator == "contains":
+            value = value.strip("*")
+            matches = lambda content: value in content
+        elif operator == "starts with":
+            value = value.rstrip("*")
+            matches = lambda content: content.startswith(value)
+        else:
+            raise ZohoError(4832, "Unsupported search operator:" + operator)
+
+        records = [record for record in self.server.store.records(module) if matches(record.get(field) or "")]
+        return self.format_rows(module, self.page(records, params), params)
+
+    def call_getSearchRecordsByPDC(self, module, params):
+        column = params.get("searchColumn", "").lower()
+        value = params.get("searchValue")
+        records = []
+        for record in self.server.store.records(module):
+            for key, content in record.items():
+                if key.replace(" ", "").lower() == column and content == value:
+                    records.append(record)
+                    break
+        return self.format_rows(module, self.page(records, params), params)
+
+    def call_getDeletedRecordIds(self, module, params):
+        since = params.get("lastModifiedTime", "")
+        ids = [id for id, deleted in self.server.store.deleted.get(module, []) if deleted >= since]
+        return simplejson.dumps({"response": {"uri": self.path, "result": {"DeletedIDs": ",".join(self.page(ids, params))}}})
+
+
+class FakeZohoServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Threaded HTTP server mimicking Zoho CRM and Support APIs """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, latency=0.0, extra_columns=0, value_size=10, compression=True):
+        """
+        @param port: TCP port to listen on localhost. 0 picks a free port.
+
+        @param latency: Seconds to wait before answering each call
+
+        @param extra_columns: Number of filler fields in seeded records, to control payload size
+
+        @param value_size: Length of filler field values
+
+        @param compression: Gzip responses for clients sending Accept-Encoding: gzip
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port), FakeZohoHandler)
+        self.latency = latency
+        self.extra_columns = extra_columns
+        self.value_size = value_size
+        self.compression = compression
+        self.store = RecordStore()
+        self.requests = {}
+        self.failures = []
+        self.tickets = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def get_url(self):
+        return "http://%s:%d" % self.server_address
+
+    url = property(get_url)
+
+    def start(self):
+        """ Serve requests in a background thread """
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def count_request(self, path):
+        method = path.partition("?")[0].split("/")[-1]
+        self.lock.acquire()
+        try:
+            self.requests[method] = self.requests.get(method, 0) + 1
+        finally:
+            self.lock.release()
+
+    def create_ticket(self):
+        """ @return: New login ticket """
+        self.lock.acquire()
+        try:
+            ticket = "fake-ticket-%d" % self.requests.get("login", 0)
+            self.tickets.add(ticket)
+            return ticket
+        finally:
+            self.lock.release()
+
+    def is_valid_ticket(self, ticket):
+        return ticket in self.tickets
+
+    def expire_tickets(self):
+        """ Make Zoho reject all issued tickets """
+        self.lock.acquire()
+        try:
+            self.tickets = set()
+        finally:
+            self.lock.release()
+
+    def fail_next(self, count=1, code=4500, message="Problem occured while processing the request", status=200):
+        """ Make the next calls fail.
+
+        @param code: Zoho error code returned in the response
+
+        @param status: HTTP status. Other than 200 returns a plain HTTP error.
+            None closes the connection without a response.
+        """
+        self._add_failures([(status, code, message)] * count)
+
+    def truncate_next(self, count=1):
+        """ Make the next calls close the connection halfway through the response body """
+        self._add_failures([("truncate", None, None)] * count)
+
+    def _add_failures(self, failures):
+        self.lock.acquire()
+        try:
+            self.failures.extend(failures)
+        finally:
+            self.lock.release()
+
+    def pop_failure(self):
+        self.lock.acquire()
+        try:
+            if self.failures:
+                return self.failures.pop(0)
+            return None
+        finally:
+            self.lock.release()
+
+    def seed(self, module="Leads", count=100):
+        """ Insert generated records.
+
+        @return: List of inserted records
+        """
+        records = []
+        for i in xrange(count):
+            fields = OrderedDict()
+            fields["First Name"] = "First%d" % i
+            fields["Last Name"] = "Last%d" % i
+            fields["Company"] = "Company %d" % i
+            fields["Email"] = "lead%d@example.com" % i
+            for column in xrange(self.extra_columns):
+                fields["Field %d" % column] = ("%d-" % i).ljust(self.value_size, "x")
+            records.append(self.store.insert(module, fields))
+        return records
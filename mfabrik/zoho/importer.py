@@ -0,0 +1,447 @@
+"""
+
+    Bulk import of CSV and JSON lines files to Zoho CRM.
+
+    Rows are read as a stream, so the file can be of any size. The XML
+    payloads are built in a process pool and the chunks are sent in
+    parallel over pooled HTTP connections.
+
+    Each acknowledged chunk is recorded in a checkpoint file. An import
+    which was interrupted continues from the checkpoint when it is run
+    again with the same file and chunk size, without sending the
+    acknowledged chunks again. Chunks which were in flight when the import
+    died are sent again; use Zoho's duplicateCheck to make that harmless.
+
+    Rows Zoho rejects and the throughput are written to a report file
+    as JSON lines.
+
+    Command line::
+
+        zoho-import --authtoken 123123123 --module Leads --map "E-mail=Email" leads.csv
+
+    From Python::
+
+        importer = Importer(crm, "Leads", mapping={"E-mail": "Email"},
+                            checkpoint="leads.checkpoint", report="leads.report")
+        stats = importer.run(read_records("leads.csv"))
+
+"""
+
+__copyright__ = "2010 mFabrik Research Oy"
+__author__ = "Mikko Ohtamaa <mikko@mfabrik.com>"
+__license__ = "GPL"
+__docformat__ = "Epytext"
+
+import csv
+import multiprocessing
+import optparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from core import ZohoException, simplejson
+from crm import CRM
+from pool import ConnectionPool
+from retry import RetryPolicy
+from serializer import default_serializer
+from workers import WorkerPool, iter_chunks
+
+
+def read_csv(path, encoding="utf-8"):
+    """ Read a CSV file with a header row.
+
+    @return: Generator yielding one dictionary per row
+    """
+    f = open(path, "rb")
+    try:
+        for row in csv.DictReader(f):
+            record = {}
+            for key, value in row.items():
+                if key is None:
+                    # Row has more cells than the header
+                    continue
+                record[key.decode(encoding)] = (value or "").decode(encoding)
+            yield record
+    finally:
+        f.close()
+
+
+def read_jsonl(path):
+    """ Read a file with one JSON object per line.
+
+    @return: Generator yielding one dictionary per line
+    """
+    f = open(path, "rb")
+    try:
+        for line in f:
+            if line.strip():
+                yield simplejson.loads(line)
+    finally:
+        f.close()
+
+
+def read_records(path, format=None, encoding="utf-8"):
+    """ Read CSV or JSON lines file.
+
+    @param format: "csv" or "jsonl". By default guessed from the file name extension.
+
+    @return: Generator yielding record dictionaries
+    """
+    if format is None:
+        if os.path.splitext(path)[1].lower() in (".jsonl", ".json", ".ndjson"):
+            format = "jsonl"
+        else:
+            format = "csv"
+
+    if format == "csv":
+        return read_csv(path, encoding)
+    elif format == "jsonl":
+        return read_jsonl(path)
+    else:
+        raise ValueError("Unknown file format:" + format)
+
+
+def map_columns(record, mapping=None):
+    """ Rename the fields of a record to Zoho field names.
+
+    @param mapping: Dictionary of source column name to Zoho field name.
+        Columns not in the mapping are dropped. None keeps all columns as is.
+
+    @return: Dictionary of Zoho fields. Empty values are left out.
+    """
+    output = {}
+    for key, value in record.items():
+        if mapping is not None:
+            key = mapping.get(key)
+            if key is None:
+                continue
+        if value is None or value == "":
+            continue
+        output[key] = value
+    return output
+
+
+def serialize_chunk(module, records):
+    """ Build the insertRecords XML payload of one chunk.
+
+    Run in the worker processes.
+
+    @return: XML string
+    """
+    return default_serializer.serialize(module, records)
+
+
+def _write_atomically(path, data):
+    fd, temp_path = tempfile.mkstemp(prefix=".checkpoint", dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+    os.rename(temp_path, path)
+
+
+class Checkpoint(object):
+    """ Chunks of an import acknowledged by Zoho, stored in a file.
+
+    Chunks complete out of order. The file holds the number of chunks
+    completed from the start of the input, and the numbers of the
+    chunks completed after the first unfinished one.
+    """
+
+    def __init__(self, path, chunk_size):
+        """
+        @param path: Checkpoint file. Read if it exists.
+
+        @param chunk_size: Rows per chunk. Must be the same when resuming.
+        """
+        self.path = path
+        self.chunk_size = chunk_size
+        self.done = 0
+        self.done_after = set()
+        self.lock = threading.Lock()
+
+        if path is not None and os.path.exists(path):
+            f = open(path, "rb")
+            try:
+                data = simplejson.loads(f.read())
+            finally:
+                f.close()
+
+            if data["chunk_size"] != chunk_size:
+                raise ValueError("Checkpoint %s was written with chunk size %d" % (path, data["chunk_size"]))
+            self.done = data["done"]
+            self.done_after = set(data["done_after"])
+
+    def is_done(self, index):
+        return index < self.done or index in self.done_after
+
+    def mark_done(self, index):
+        """ Record a chunk as acknowledged and save the checkpoint """
+        self.lock.acquire()
+        try:
+            self.done_after.add(index)
+            while self.done in self.done_after:
+                self.done_after.remove(self.done)
+                self.done += 1
+
+            if self.path is not None:
+                _write_atomically(self.path, simplejson.dumps({
+                    "chunk_size": self.chunk_size,
+                    "done": self.done,
+                    "done_after": sorted(self.done_after),
+                }))
+        finally:
+            self.lock.release()
+
+
+class Report(object):
+    """ JSON lines side file for rejected rows and throughput """
+
+    def __init__(self, path=None, interval=10.0):
+        """
+        @param path: Report file, appended to. None writes nothing.
+
+        @param interval: Seconds between throughput lines
+        """
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.last_progress = time.time()
+        if path is None:
+            self.file = None
+        else:
+            self.file = open(path, "ab")
+
+    def write(self, entry):
+        if self.file is None:
+            return
+        self.lock.acquire()
+        try:
+            self.file.write(simplejson.dumps(entry) + "\n")
+            self.file.flush()
+        finally:
+            self.lock.release()
+
+    def error(self, row, record, exception):
+        """
+        @param row: Number of the data row in the input file, starting from 1
+        """
+        self.write({"type": "error", "row": row, "code": getattr(exception, "code", None),
+                    "message": unicode(exception), "record": record})
+
+    def progress(self, stats, force=False):
+        now = time.time()
+        if not force and now - self.last_progress < self.interval:
+            return
+        self.last_progress = now
+        entry = {"type": "progress", "time": time.strftime("%Y-%m-%d %H:%M:%S")}
+        entry.update(stats)
+        self.write(entry)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class Importer(object):
+    """ Insert a stream of records to a Zoho CRM module """
+
+    def __init__(self, crm, module="Leads", mapping=None, chunk_size=100, max_workers=4, processes=None,
+                 checkpoint=None, report=None, extra_post_parameters={}):
+        """
+        @param crm: L{mfabrik.zoho.crm.CRM} connection. Its connection pool should
+            have room for max_workers connections.
+
+        @param module: Zoho CRM module name
+
+        @param mapping: Source column to Zoho field name mapping, see L{map_columns}
+
+        @param chunk_size: Records per insertRecords call. Zoho accepts 100 at most.
+
+        @param max_workers: Number of API calls in flight at once
+
+        @param processes: Number of processes building the XML payloads. None uses
+            one per CPU, 0 builds them in the sending threads.
+
+        @param checkpoint: Path of the checkpoint file, None does not checkpoint
+
+        @param report: Path of the report file, None does not report
+
+        @param extra_post_parameters: Parameters appended to the insertRecords calls
+        """
+        self.crm = crm
+        self.module = module
+        self.mapping = mapping
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+        self.processes = processes
+        self.checkpoint = Checkpoint(checkpoint, chunk_size)
+        self.report_path = report
+
+        self.post = {
+            "newFormat": 1,
+            "duplicateCheck": 2,
+        }
+        self.post.update(extra_post_parameters)
+        # Results per row, so that one bad row does not fail its chunk
+        self.post["version"] = 4
+
+    def run(self, records):
+        """ Import records.
+
+        Rows Zoho rejects one by one are written to the report. The run stops
+        at the first call which failed as a whole, like a network failure or
+        a Zoho error response. Running the import again continues from the
+        checkpoint, which has only the chunks Zoho answered row by row.
+
+        @param records: Iterable of record dictionaries, see L{read_records}
+
+        @return: Dictionary with counts of sent rows, inserted rows, failed rows,
+            rows skipped as already imported, elapsed seconds and rows per second
+        """
+        stats = {"rows": 0, "inserted": 0, "failed": 0, "skipped": 0}
+        stats_lock = threading.Lock()
+        failures = []
+        report = Report(self.report_path)
+
+        # Bound the chunks read ahead of the sending threads
+        in_flight = threading.Semaphore(self.max_workers * 2)
+
+        processes = None
+        if self.processes != 0:
+            processes = multiprocessing.Pool(self.processes)
+        workers = WorkerPool(self.max_workers)
+        start = time.time()
+
+        def update(**counts):
+            stats_lock.acquire()
+            try:
+                for key, count in counts.items():
+                    stats[key] += count
+                stats["elapsed"] = time.time() - start
+                stats["rows_per_second"] = stats["rows"] / max(stats["elapsed"], 1e-9)
+                report.progress(stats)
+            finally:
+                stats_lock.release()
+
+        def send(index, first_row, records, xml):
+            if xml is None:
+                xml = serialize_chunk(self.module, [map_columns(record, self.mapping) for record in records])
+            else:
+                xml = xml.get()
+
+            # If Zoho rejects the whole chunk, like with a throttling or an internal
+            # error, the error stops the run and the chunk is sent again on resume
+            response = self.crm.insert_xml(self.module, xml, self.post)
+            results = response.get_row_results()
+
+            failed = 0
+            for no, record in enumerate(records):
+                result = results.get(no + 1, ZohoException("No result for inserted row"))
+                if isinstance(result, Exception):
+                    report.error(first_row + no, record, result)
+                    failed += 1
+
+            self.checkpoint.mark_done(index)
+            update(rows=len(records), inserted=len(records) - failed, failed=failed)
+
+        def done(future):
+            if future.exception() is not None:
+                failures.append(future)
+            in_flight.release()
+
+        try:
+            first_row = 1
+            for index, chunk in enumerate(iter_chunks(records, self.chunk_size)):
+                if failures:
+                    break
+
+                if self.checkpoint.is_done(index):
+                    update(skipped=len(chunk))
+                    first_row += len(chunk)
+                    continue
+
+                in_flight.acquire()
+
+                xml = None
+                if processes is not None:
+                    rows = [map_columns(record, self.mapping) for record in chunk]
+                    xml = processes.apply_async(serialize_chunk, (self.module, rows))
+
+                workers.submit(send, index, first_row, chunk, xml).add_done_callback(done)
+                first_row += len(chunk)
+        finally:
+            workers.shutdown()
+            if processes is not None:
+                processes.close()
+                processes.join()
+            update()
+            report.progress(stats, force=True)
+            report.close()
+
+        if failures:
+            # Raise the original exception with its traceback
+            failures[0].result()
+
+        return stats
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] FILE", description="Import CSV or JSON lines file to Zoho CRM")
+    parser.add_option("--authtoken", default=os.environ.get("ZOHO_AUTHTOKEN"), help="Zoho API authtoken, default from ZOHO_AUTHTOKEN environment variable")
+    parser.add_option("--scope", default="crmapi")
+    parser.add_option("--api-url", default=None, help="Zoho CRM base URL")
+    parser.add_option("--module", default="Leads", help="Zoho CRM module name")
+    parser.add_option("--format", default=None, help="csv or jsonl, default is guessed from the file name")
+    parser.add_option("--encoding", default="utf-8", help="CSV file encoding")
+    parser.add_option("--map", action="append", default=[], metavar="COLUMN=FIELD",
+                      help="Map file column to Zoho field. Can be given many times. Unmapped columns are left out.")
+    parser.add_option("--chunk-size", type="int", default=100, help="Records per API call")
+    parser.add_option("--workers", type="int", default=4, help="API calls in flight at once")
+    parser.add_option("--processes", type="int", default=None, help="Processes building XML, default is one per CPU")
+    parser.add_option("--duplicate-check", type="int", default=2, help="Zoho duplicateCheck: 1 skips, 2 updates duplicates")
+    parser.add_option("--checkpoint", default=None, help="Checkpoint file, default is FILE.checkpoint")
+    parser.add_option("--report", default=None, help="Report file for rejected rows and throughput, default is FILE.report")
+    options, args = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error("Give one file to import")
+    if not options.authtoken:
+        parser.error("Zoho authtoken is needed")
+
+    path = args[0]
+
+    mapping = None
+    if options.map:
+        mapping = {}
+        for item in options.map:
+            if "=" not in item:
+                parser.error("Bad mapping, use COLUMN=FIELD:" + item)
+            column, field = item.split("=", 1)
+            mapping[column.decode(options.encoding)] = field.decode(options.encoding)
+
+    kwargs = {}
+    if options.api_url:
+        kwargs["api_url"] = options.api_url
+
+    crm = CRM(authtoken=options.authtoken, scope=options.scope, pool=ConnectionPool(maxsize=options.workers),
+              retry_policy=RetryPolicy(), **kwargs)
+
+    importer = Importer(crm, options.module, mapping,
+                        chunk_size=options.chunk_size,
+                        max_workers=options.workers,
+                        processes=options.processes,
+                        checkpoint=options.checkpoint or path + ".checkpoint",
+                        report=options.report or path + ".report",
+                        extra_post_parameters={"duplicateCheck": options.duplicate_check})
+
+    stats = importer.run(read_records(path, options.format, options.encoding))
+
+    print "%(rows)d rows sent, %(inserted)d inserted, %(failed)d failed, %(skipped)d skipped in %(elapsed).1f seconds (%(rows_per_second).0f rows/s)" % stats
+    if stats["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+
+    Coalescing record lookups.
+
+    When many threads look up records at the same moment, L{RecordLoader}
+    turns the lookups into as few API calls as possible:
+
+        * Concurrent lookups of the same id share one call (single flight).
+
+        * Lookups of different ids arriving within a short window are
+          fetched together with one getRecordById idlist call, and the
+          results are handed back to each caller.
+
+    Example::
+
+        loader = RecordLoader(crm, "Leads", window=0.005)
+
+        # In web request threads
+        lead = loader.get(lead_id)
+
+"""
+
+__copyright__ = "2010 mFabrik Research Oy"
+__author__ = "Mikko Ohtamaa <mikko@mfabrik.com>"
+__license__ = "GPL"
+__docformat__ = "Epytext"
+
+import sys
+import threading
+import time
+
+from workers import Future, WorkerPool
+
+
+class RecordLoader(object):
+    """ Batch and deduplicate concurrent lookups of records by id.
+
+    Thread safe. Statistics are available as attributes:
+
+        * lookups: number of ids requested
+
+        * coalesced: lookups which joined a call already queued or in flight
+
+        * calls: number of API calls made
+    """
+
+    def __init__(self, crm, module="Leads", window=0.005, max_batch=100, max_workers=4):
+        """
+        @param crm: L{mfabrik.zoho.crm.CRM} connection
+
+        @param module: Zoho CRM module name
+
+        @param window: Seconds to wait for more lookups after the first one,
+            before the batch is sent
+
+        @param max_batch: Ids per call. The batch is sent right away when it is full.
+            Zoho accepts 100 at most.
+
+        @param max_workers: Number of API calls in flight at once
+        """
+        self.crm = crm
+        self.module = module
+        self.window = window
+        self.max_batch = max_batch
+
+        self.lookups = 0
+        self.coalesced = 0
+        self.calls = 0
+
+        self._cond = threading.Condition()
+        # id -> Future of the id, queued or being fetched
+        self._pending = {}
+        # Ids waiting for the next batch
+        self._batch = []
+        self._deadline = None
+        self._closed = False
+        self._thread = None
+        self._workers = WorkerPool(max_workers)
+
+    def load(self, id):
+        """ Look up a record without waiting for it.
+
+        The returned future is shared with other callers of the same id,
+        so do not cancel it.
+
+        @return: L{mfabrik.zoho.workers.Future} resolving to the record dictionary,
+            or None if there is no such record
+        """
+        id = str(id)
+        self._cond.acquire()
+        try:
+            if self._closed:
+                raise RuntimeError("Record loader has been closed")
+
+            self.lookups += 1
+
+            future = self._pending.get(id)
+            if future is not None:
+                self.coalesced += 1
+                return future
+
+            future = Future()
+            self._pending[id] = future
+            self._batch.append(id)
+
+            if len(self._batch) >= self.max_batch:
+                self._dispatch()
+            elif len(self._batch) == 1:
+                self._deadline = time.time() + self.window
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run)
+                    self._thread.setDaemon(True)
+                    self._thread.start()
+                self._cond.notify()
+
+            return future
+        finally:
+            self._cond.release()
+
+    def get(self, id, timeout=None):
+        """ Look up a record.
+
+        @return: Record dictionary or None if there is no such record
+        """
+        return self.load(id).result(timeout)
+
+    def get_many(self, ids, timeout=None):
+        """ Look up many records.
+
+        @return: Dictionary mapping id to record dictionary or None
+        """
+        futures = [(str(id), self.load(id)) for id in ids]
+        return dict([(id, future.result(timeout)) for id, future in futures])
+
+    def _dispatch(self):
+        """ Send the current batch. Called with the lock held. """
+        batch = self._batch
+        self._batch = []
+        self._deadline = None
+        self.calls += 1
+        self._workers.submit(self._fetch, batch)
+
+    def _run(self):
+        """ Send batches when their window has passed """
+        self._cond.acquire()
+        try:
+            while True:
+                if self._batch:
+                    remaining = self._deadline - time.time()
+                    if remaining <= 0:
+                        self._dispatch()
+                    else:
+                        self._cond.wait(remaining)
+                elif self._closed:
+                    return
+                else:
+                    self._cond.wait()
+        finally:
+            self._cond.release()
+
+    def _fetch(self, batch):
+        try:
+            records = self.crm.get_records_by_ids(batch, self.module)
+        except:
+            exc_info = sys.exc_info()
+            for future in self._forget(batch):
+                future.set_exception(exc_info)
+        else:
+            for id, future in zip(batch, self._forget(batch)):
+                future.set_result(records.get(id))
+
+    def _forget(self, batch):
+        """ Stop coalescing with finished ids, so that later lookups fetch fresh data.
+
+        @return: Futures of the ids
+        """
+        self._cond.acquire()
+        try:
+            return [self._pending.pop(id) for id in batch]
+        finally:
+            self._cond.release()
+
+    def close(self):
+        """ Send the queued lookups and wait for them to complete """
+        self._cond.acquire()
+        try:
+            self._closed = True
+            if self._batch:
+                self._dispatch()
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+        if self._thread is not None:
+            self._thread.join()
+        self._workers.shutdown()
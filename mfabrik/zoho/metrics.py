@@ -0,0 +1,273 @@
+"""
+
+    Metrics of Zoho API calls.
+
+    Connections notify their observers before and after every API call
+    with a L{mfabrik.zoho.core.CallInfo}. L{MetricsCollector} keeps
+    in-memory histograms of the calls per endpoint and module, and can
+    output them in Prometheus text exposition format.
+
+    Example::
+
+        metrics = MetricsCollector()
+        crm = CRM(authtoken="authtoken", scope="crmapi", observers=[metrics])
+
+        crm.get_records()
+
+        print metrics.get_series()[("getRecords", "Leads")]["network_time"].percentile(99)
+
+        # Serve this from your /metrics page
+        text = metrics.prometheus()
+
+    Share one collector between all connections of a process.
+
+"""
+
+__copyright__ = "2010 mFabrik Research Oy"
+__author__ = "Mikko Ohtamaa <mikko@mfabrik.com>"
+__license__ = "GPL"
+__docformat__ = "Epytext"
+
+import bisect
+import threading
+
+#: Upper bounds of the time histogram buckets in seconds
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+#: Upper bounds of the size histogram buckets in bytes
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class CallObserver(object):
+    """ Base class for Zoho API call observers.
+
+    Observers are given to a connection with the observers parameter or
+    L{mfabrik.zoho.core.Connection.add_observer}. They are called from
+    the thread making the call, so they must be thread safe if the
+    connection is used from several threads.
+    """
+
+    def before_call(self, info):
+        """ Called before the HTTP request is sent.
+
+        @param info: L{mfabrik.zoho.core.CallInfo} with the endpoint and the module
+        """
+
+    def after_call(self, info):
+        """ Called when the call has completed or failed.
+
+        @param info: L{mfabrik.zoho.core.CallInfo} with the measurements
+        """
+
+
+class Histogram(object):
+    """ Counts of observed values in fixed buckets """
+
+    def __init__(self, buckets=TIME_BUCKETS):
+        """
+        @param buckets: Sorted upper bounds of the buckets. Values above the last bound
+            go to an implicit +Inf bucket.
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """ @return: List of (upper bound, number of values at most the bound) tuples, last bound is None for +Inf """
+        output = []
+        total = 0
+        for bound, count in zip(self.buckets + (None,), self.counts):
+            total += count
+            output.append((bound, total))
+        return output
+
+    def percentile(self, percent):
+        """ Estimate a percentile.
+
+        @return: Upper bound of the bucket the percentile falls in, None if it is in the +Inf bucket
+            or nothing has been observed
+        """
+        if not self.count:
+            return None
+        rank = self.count * percent / 100.0
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return bound
+        return None
+
+    def mean(self):
+        if not self.count:
+            return None
+        return float(self.sum) / self.count
+
+
+class MetricsCollector(CallObserver):
+    """ In-memory metrics of Zoho API calls, per endpoint and module.
+
+    Thread safe.
+    """
+
+    def __init__(self, time_buckets=TIME_BUCKETS, size_buckets=SIZE_BUCKETS):
+        """
+        @param time_buckets: Histogram bucket bounds for network and parse times in seconds
+
+        @param size_buckets: Histogram bucket bounds for response sizes in bytes
+        """
+        self.time_buckets = time_buckets
+        self.size_buckets = size_buckets
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Forget all collected metrics """
+        self.lock.acquire()
+        try:
+            self.series = {}
+            self.in_flight = 0
+        finally:
+            self.lock.release()
+
+    def _get_series(self, info):
+        key = (info.endpoint, info.module)
+        series = self.series.get(key)
+        if series is None:
+            series = {
+                "calls": 0,
+                "rows": 0,
+                "retries": 0,
+                "request_bytes": 0,
+                "response_bytes": 0,
+                "request_bytes_saved": 0,
+                "response_bytes_saved": 0,
+                # Zoho error code or HTTP status -> count. Other failures are counted under None.
+                "errors": {},
+                "network_time": Histogram(self.time_buckets),
+                "parse_time": Histogram(self.time_buckets),
+                "wait_time": Histogram(self.time_buckets),
+                "response_size": Histogram(self.size_buckets),
+            }
+            self.series[key] = series
+        return series
+
+    def before_call(self, info):
+        self.lock.acquire()
+        try:
+            self.in_flight += 1
+        finally:
+            self.lock.release()
+
+    def after_call(self, info):
+        self.lock.acquire()
+        try:
+            self.in_flight -= 1
+
+            series = self._get_series(info)
+            series["calls"] += 1
+            series["rows"] += info.rows or 0
+            series["retries"] += info.retries
+            series["request_bytes"] += info.request_bytes
+            series["response_bytes"] += info.response_bytes
+            series["request_bytes_saved"] += info.request_bytes_saved
+            series["response_bytes_saved"] += info.response_bytes_saved
+            series["network_time"].observe(info.network_time)
+            series["parse_time"].observe(info.parse_time)
+            series["wait_time"].observe(info.wait_time)
+            series["response_size"].observe(info.response_bytes)
+
+            if info.error is not None:
+                errors = series["errors"]
+                errors[info.error_code] = errors.get(info.error_code, 0) + 1
+        finally:
+            self.lock.release()
+
+    def get_series(self):
+        """ @return: Dictionary mapping (endpoint, module) to dictionary of counters and L{Histogram}s.
+            Do not modify the returned data.
+        """
+        self.lock.acquire()
+        try:
+            return dict(self.series)
+        finally:
+            self.lock.release()
+
+    def prometheus(self, prefix="zoho_api"):
+        """ Format the metrics in Prometheus text exposition format.
+
+        @param prefix: Prefix of the metric names
+
+        @return: String
+        """
+        self.lock.acquire()
+        try:
+            output = []
+
+            def header(name, kind, help):
+                output.append("# HELP %s_%s %s" % (prefix, name, help))
+                output.append("# TYPE %s_%s %s" % (prefix, name, kind))
+
+            def sample(name, labels, value):
+                text = ",".join(['%s="%s"' % (label, _escape(label_value)) for label, label_value in labels])
+                output.append("%s_%s{%s} %s" % (prefix, name, text, _number(value)))
+
+            keys = sorted(self.series.keys())
+
+            header("in_flight", "gauge", "Zoho API calls in progress")
+            output.append("%s_in_flight %d" % (prefix, self.in_flight))
+
+            for name, help in (("calls", "Zoho API calls"),
+                               ("rows", "Rows returned or written by Zoho API calls"),
+                               ("retries", "Retried Zoho API call attempts"),
+                               ("request_bytes", "Bytes sent to Zoho API"),
+                               ("response_bytes", "Bytes received from Zoho API"),
+                               ("request_bytes_saved", "Bytes saved by compressing requests"),
+                               ("response_bytes_saved", "Bytes saved by compressed responses")):
+                header(name + "_total", "counter", help)
+                for key in keys:
+                    sample(name + "_total", _labels(key), self.series[key][name])
+
+            header("errors_total", "counter", "Failed Zoho API calls by Zoho error code or HTTP status")
+            for key in keys:
+                for code, count in sorted(self.series[key]["errors"].items()):
+                    if code is None:
+                        code = ""
+                    sample("errors_total", _labels(key) + [("code", code)], count)
+
+            for name, metric, help in (("network_time", "network_seconds", "Seconds spent sending requests and reading responses"),
+                                       ("parse_time", "parse_seconds", "Seconds spent parsing responses"),
+                                       ("wait_time", "wait_seconds", "Seconds spent waiting for the rate limiter"),
+                                       ("response_size", "response_size_bytes", "Response sizes in bytes")):
+                header(metric, "histogram", help)
+                for key in keys:
+                    histogram = self.series[key][name]
+                    for bound, total in histogram.cumulative():
+                        if bound is None:
+                            bound = "+Inf"
+                        sample(metric + "_bucket", _labels(key) + [("le", bound)], total)
+                    sample(metric + "_sum", _labels(key), histogram.sum)
+                    sample(metric + "_count", _labels(key), histogram.count)
+
+            return "\n".join(output) + "\n"
+        finally:
+            self.lock.release()
+
+
+def _labels(key):
+    endpoint, module = key
+    return [("endpoint", endpoint), ("module", module)]
+
+
+def _escape(value):
+    """ Escape Prometheus label value """
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
@@ -0,0 +1,230 @@
+"""
+
+    Local SQLite mirror of a Zoho CRM module.
+
+    The first sync loads the whole module. The following syncs fetch only
+    records modified since the previous sync and remove deleted records.
+    Lookups on indexed columns are then answered from the local database
+    without calling Zoho.
+
+    Example::
+
+        mirror = Mirror(crm, "/var/lib/zoho/crm.sqlite", "Leads", indexes=["Email", "Company"])
+        mirror.sync()
+
+        leads = mirror.find("Email", "mikko@mfabrik.com")
+        leads = mirror.find_prefix("Company", "mFabrik")
+
+    A mirror object must be used from one thread only.
+
+"""
+
+__copyright__ = "2010 mFabrik Research Oy"
+__author__ = "Mikko Ohtamaa <mikko@mfabrik.com>"
+__license__ = "GPL"
+__docformat__ = "Epytext"
+
+import re
+import sqlite3
+
+from core import simplejson
+from workers import iter_pages
+
+
+def _identifier(name):
+    """ Turn Zoho module or field name to SQL identifier """
+    return re.sub(r"\W", "_", name).lower()
+
+
+class Mirror(object):
+    """ Incrementally synchronized local copy of one CRM module. """
+
+    def __init__(self, crm, path, module="Leads", indexes=(), selectColumns="All", id_column=None, modified_column="Modified Time"):
+        """
+        @param crm: L{mfabrik.zoho.crm.CRM} connection
+
+        @param path: SQLite database file. Several modules can share one file.
+
+        @param module: Zoho CRM module name
+
+        @param indexes: Field names which can be queried with L{find} and L{find_prefix}
+
+        @param selectColumns: Columns to mirror, see L{mfabrik.zoho.crm.CRM.get_records}.
+            Must include the modified column.
+
+        @param id_column: Name of the record id field. Default is given by
+            L{mfabrik.zoho.crm.CRM.get_id_column}, like LEADID for Leads.
+
+        @param modified_column: Field telling when the record was last modified
+        """
+        self.crm = crm
+        self.module = module
+        self.selectColumns = selectColumns
+        self.id_column = id_column or crm.get_id_column(module)
+        self.modified_column = modified_column
+
+        self.table = _identifier(module)
+        self.columns = {}
+        for name in indexes:
+            self.columns[name] = "f_" + _identifier(name)
+
+        self.db = sqlite3.connect(path)
+        self._create_tables()
+
+    def _create_tables(self):
+        columns = "".join([", %s TEXT" % column for column in self.columns.values()])
+        self.db.execute("CREATE TABLE IF NOT EXISTS %s (id TEXT PRIMARY KEY, data TEXT%s)" % (self.table, columns))
+        self.db.execute("CREATE TABLE IF NOT EXISTS mirror_state (module TEXT PRIMARY KEY, last_modified TEXT)")
+
+        existing = [row[1] for row in self.db.execute("PRAGMA table_info(%s)" % self.table)]
+        for column in self.columns.values():
+            if column not in existing:
+                # Index added after the table was created, populated by the next full sync
+                self.db.execute("ALTER TABLE %s ADD COLUMN %s TEXT" % (self.table, column))
+            self.db.execute("CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)" % (self.table, column, self.table, column))
+        self.db.commit()
+
+    def get_last_modified(self):
+        """ @return: Modification time of the newest mirrored record, or None before the first sync """
+        row = self.db.execute("SELECT last_modified FROM mirror_state WHERE module = ?", (self.module,)).fetchone()
+        if row:
+            return row[0]
+        return None
+
+    def _set_last_modified(self, value):
+        self.db.execute("INSERT OR REPLACE INTO mirror_state (module, last_modified) VALUES (?, ?)", (self.module, value))
+
+    def _store(self, record):
+        names = ["id", "data"]
+        values = [record[self.id_column], simplejson.dumps(record)]
+        for name, column in self.columns.items():
+            names.append(column)
+            values.append(record.get(name))
+
+        sql = "INSERT OR REPLACE INTO %s (%s) VALUES (%s)" % (self.table, ", ".join(names), ", ".join(["?"] * len(names)))
+        self.db.execute(sql, values)
+
+    def sync(self, full=False, batch_size=1000, page_size=200):
+        """ Bring the mirror up to date.
+
+        @param full: Reload the whole module, even if it has been synced before.
+            Local records not in Zoho any more are removed.
+
+        @param batch_size: Commit after this many records
+
+        @param page_size: Deleted record ids fetched per API call
+
+        @return: Tuple (number of stored records, number of removed records)
+        """
+        last_modified = self.get_last_modified()
+        if full:
+            last_modified = None
+
+        parameters = {}
+        if last_modified is not None:
+            parameters["lastModifiedTime"] = last_modified
+
+        newest = last_modified
+        stored = 0
+        seen = set()
+        for record in self.crm.iter_records(self.selectColumns, parameters, self.module):
+            self._store(record)
+            stored += 1
+            if last_modified is None:
+                seen.add(record[self.id_column])
+
+            modified = record.get(self.modified_column)
+            # Zoho times are yyyy-MM-dd HH:mm:ss, so they sort as strings
+            if modified and (newest is None or modified > newest):
+                newest = modified
+
+            if stored % batch_size == 0:
+                self.db.commit()
+
+        if last_modified is None:
+            # Everything in Zoho was loaded, the rest is gone
+            local = [row[0] for row in self.db.execute("SELECT id FROM %s" % self.table)]
+            removed = self._remove([id for id in local if id not in seen])
+        else:
+            removed = self._remove(self.get_deleted_ids(last_modified, page_size))
+
+        if newest is not None:
+            self._set_last_modified(newest)
+
+        self.db.commit()
+        return stored, removed
+
+    def get_deleted_ids(self, since, page_size=200):
+        """ @return: Ids of all records deleted in Zoho after the given time """
+
+        def fetch(number):
+            parameters = {"fromIndex": number * page_size + 1, "toIndex": (number + 1) * page_size}
+            return self.crm.get_deleted_record_ids(self.module, since, parameters)
+
+        return list(iter_pages(fetch, page_size))
+
+    def reconcile(self):
+        """ Remove local records which no longer exist in Zoho.
+
+        Unlike L{sync}, which relies on Zoho's list of deleted records, this
+        compares all record ids, so it is slower but catches everything.
+
+        @return: Number of removed records
+        """
+        remote = set()
+        for record in self.crm.iter_records("%s(%s)" % (self.module, self.modified_column), {}, self.module):
+            remote.add(record[self.id_column])
+
+        local = [row[0] for row in self.db.execute("SELECT id FROM %s" % self.table)]
+        removed = self._remove([id for id in local if id not in remote])
+        self.db.commit()
+        return removed
+
+    def _remove(self, ids):
+        self.db.executemany("DELETE FROM %s WHERE id = ?" % self.table, [(id,) for id in ids])
+        return len(ids)
+
+    def _column(self, name):
+        try:
+            return self.columns[name]
+        except KeyError:
+            raise ValueError("Field is not indexed in the mirror:" + name)
+
+    def _records(self, sql, params):
+        return [simplejson.loads(row[0]) for row in self.db.execute(sql, params)]
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM %s" % self.table).fetchone()[0]
+
+    def get(self, id):
+        """ @return: Record dictionary or None """
+        records = self._records("SELECT data FROM %s WHERE id = ?" % self.table, (id,))
+        if records:
+            return records[0]
+        return None
+
+    def find(self, name, value):
+        """ Find records whose indexed field equals value.
+
+        @return: List of record dictionaries
+        """
+        return self._records("SELECT data FROM %s WHERE %s = ?" % (self.table, self._column(name)), (value,))
+
+    def find_prefix(self, name, prefix):
+        """ Find records whose indexed field starts with prefix.
+
+        @return: List of record dictionaries
+        """
+        column = self._column(name)
+        if not prefix:
+            return self._records("SELECT data FROM %s WHERE %s IS NOT NULL" % (self.table, column), ())
+
+        if isinstance(prefix, str):
+            prefix = prefix.decode("utf-8")
+
+        # Range scan uses the index, unlike LIKE
+        upper = prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+        return self._records("SELECT data FROM %s WHERE %s >= ? AND %s < ?" % (self.table, column, column), (prefix, upper))
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,314 @@
+"""
+
+    Keep-alive HTTP connection pool for Zoho API calls.
+
+    urllib2 opens a new TCP and SSL connection for every request. Zoho API
+    calls are small, so the handshake easily costs more than the call itself.
+    The pool keeps finished connections open per host and hands them
+    out again for the following calls.
+
+    All Zoho connections share L{default_pool} unless they are given
+    their own pool with the C{pool} constructor argument.
+
+"""
+
+__copyright__ = "2010 mFabrik Research Oy"
+__author__ = "Mikko Ohtamaa <mikko@mfabrik.com>"
+__license__ = "GPL"
+__docformat__ = "Epytext"
+
+import errno
+import httplib
+import socket
+import threading
+import time
+import urllib2
+import urlparse
+
+from StringIO import StringIO
+
+
+class ConnectError(socket.error):
+    """ Could not open connection to the server.
+
+    The request was never sent, so it is always safe to try again.
+    """
+
+
+class PooledResponse(object):
+    """ File-like HTTP response.
+
+    The underlying connection is returned to the pool when the response body
+    has been completely read, reading it fails or the response is closed.
+    """
+
+    def __init__(self, pool, key, conn, response):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.msg = response.msg
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def read(self, amt=None):
+        """ Read the response body.
+
+        @param amt: Maximum number of bytes to read. None reads everything.
+        """
+        if self.conn is None:
+            return ""
+
+        try:
+            if amt is None:
+                data = self.response.read()
+            else:
+                data = self.response.read(amt)
+        except:
+            # Connection is in an unknown state, never reuse it
+            self._release(False)
+            raise
+
+        if self.response.isclosed():
+            # Body consumed, the connection can serve the next request
+            self._release(not self.response.will_close)
+
+        return data
+
+    def close(self):
+        """ Release the connection.
+
+        A connection with unread body data cannot be reused and is closed.
+        """
+        if self.conn is not None:
+            self._release(self.response.isclosed() and not self.response.will_close)
+
+    def _release(self, reusable):
+        conn = self.conn
+        self.conn = None
+        self.pool.release(self.key, conn, reusable)
+
+
+class ConnectionPool(object):
+    """ Thread-safe pool of persistent HTTP(S) connections, keyed by host.
+
+    Statistics are available as attributes and through L{stats}:
+
+        * hits: a request reused an idle connection
+
+        * new_connections: a new connection had to be opened
+
+        * waits: a request had to wait because all connections of the host were busy
+    """
+
+    def __init__(self, maxsize=4, idle_timeout=60.0, timeout=60.0):
+        """
+        @param maxsize: Maximum number of open connections per host
+
+        @param idle_timeout: Seconds after which an unused connection is closed
+
+        @param timeout: Socket timeout in seconds
+        """
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+
+        self.hits = 0
+        self.new_connections = 0
+        self.waits = 0
+
+        self._cond = threading.Condition()
+        # (scheme, host) -> list of (connection, last used timestamp)
+        self._idle = {}
+        # (scheme, host) -> number of connections handed out
+        self._active = {}
+
+    def stats(self):
+        """ @return: Dictionary of pool usage counters """
+        self._cond.acquire()
+        try:
+            return {
+                "hits": self.hits,
+                "new_connections": self.new_connections,
+                "waits": self.waits,
+                "active": sum(self._active.values()),
+                "idle": sum([len(idle) for idle in self._idle.values()]),
+            }
+        finally:
+            self._cond.release()
+
+    def clear(self):
+        """ Close all idle connections """
+        self._cond.acquire()
+        try:
+            idle = self._idle
+            self._idle = {}
+        finally:
+            self._cond.release()
+
+        for conns in idle.values():
+            for conn, last_used in conns:
+                conn.close()
+
+    def _acquire(self, key):
+        """ Check out an idle connection or reserve a slot for a new one.
+
+        @return: Tuple (connection, reused). Connection is None if a new one must be opened.
+        """
+        waited = False
+        stale = []
+        self._cond.acquire()
+        try:
+            while True:
+                idle = self._idle.get(key, [])
+                now = time.time()
+
+                fresh = []
+                for conn, last_used in idle:
+                    if now - last_used > self.idle_timeout:
+                        stale.append(conn)
+                    else:
+                        fresh.append((conn, last_used))
+                self._idle[key] = fresh
+
+                active = self._active.get(key, 0)
+
+                if fresh:
+                    # Most recently used connection is the least likely to be dropped by the server
+                    conn, last_used = fresh.pop()
+                    self._active[key] = active + 1
+                    self.hits += 1
+                    return conn, True
+
+                if active < self.maxsize:
+                    self._active[key] = active + 1
+                    self.new_connections += 1
+                    return None, False
+
+                if not waited:
+                    self.waits += 1
+                    waited = True
+                self._cond.wait()
+        finally:
+            self._cond.release()
+            for conn in stale:
+                conn.close()
+
+    def release(self, key, conn, reusable=True):
+        """ Return a checked out connection to the pool. """
+        self._cond.acquire()
+        try:
+            self._active[key] = self._active.get(key, 1) - 1
+            if reusable and conn is not None:
+                self._idle.setdefault(key, []).append((conn, time.time()))
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+        if not reusable and conn is not None:
+            conn.close()
+
+    def _connect(self, scheme, netloc):
+        if scheme == "https":
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        elif scheme == "http":
+            return httplib.HTTPConnection(netloc, timeout=self.timeout)
+        else:
+            raise ValueError("Unsupported URL scheme:" + scheme)
+
+    def _open(self, scheme, netloc):
+        """ @return: New connected connection """
+        conn = self._connect(scheme, netloc)
+        try:
+            conn.connect()
+        except socket.error, e:
+            raise ConnectError(*e.args)
+        return conn
+
+    def _is_dropped(self, e):
+        """ Did the server close the idle connection without answering?
+
+        Only then the request is sent again. A timeout or any other failure
+        may come after the server has received and processed the request,
+        and resending e.g. an insert would create duplicates.
+        """
+        if isinstance(e, httplib.BadStatusLine):
+            # Connection closed without a single byte of response. The message
+            # depends on the Python version.
+            return e.line in ("", "''") or e.line.startswith("No status line received")
+        if isinstance(e, socket.timeout):
+            return False
+        if isinstance(e, socket.error):
+            return bool(e.args) and e.args[0] in (errno.ECONNRESET, errno.EPIPE)
+        return False
+
+    def _send(self, conn, selector, data, headers):
+        if data is None:
+            conn.request("GET", selector, headers=headers)
+        else:
+            conn.request("POST", selector, data, headers)
+        return conn.getresponse()
+
+    def urlopen(self, url, data=None, headers={}):
+        """ Do HTTP request over a pooled connection.
+
+        Mimics urllib2.urlopen(): POST if data is given, GET otherwise.
+
+        @param url: Full URL
+
+        @param data: Already urlencoded POST payload
+
+        @param headers: Extra HTTP headers
+
+        @return: L{PooledResponse}
+
+        @raise: urllib2.HTTPError if server responds with an error status
+        """
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        key = (scheme, netloc)
+        selector = path or "/"
+        if query:
+            selector += "?" + query
+
+        all_headers = {}
+        if data is not None:
+            all_headers["Content-Type"] = "application/x-www-form-urlencoded"
+        all_headers.update(headers)
+
+        conn, reused = self._acquire(key)
+        try:
+            if conn is None:
+                conn = self._open(scheme, netloc)
+            try:
+                response = self._send(conn, selector, data, all_headers)
+            except (httplib.HTTPException, socket.error), e:
+                if not reused or not self._is_dropped(e):
+                    raise
+                # Server closed the idle keep-alive connection under us, retry once with a fresh one
+                conn.close()
+                conn = None
+                self._cond.acquire()
+                try:
+                    self.new_connections += 1
+                finally:
+                    self._cond.release()
+                conn = self._open(scheme, netloc)
+                response = self._send(conn, selector, data, all_headers)
+        except:
+            self.release(key, conn, False)
+            raise
+
+        pooled = PooledResponse(self, key, conn, response)
+
+        if response.status >= 400:
+            body = pooled.read()
+            raise urllib2.HTTPError(url, response.status, response.reason, response.msg, StringIO(body))
+
+        return pooled
+
+
+#: Pool shared by all Zoho connections in this process
+default_pool = ConnectionPool()
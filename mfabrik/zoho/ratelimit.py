@@ -0,0 +1,143 @@
+"""
+
+    Client side rate limiting for Zoho API calls.
+
+    Zoho limits the number of API calls per organization and throttles
+    bursts. A L{RateLimiter} shared by all connections and threads
+    keeps the call rate under the quota, and slows down further
+    when Zoho reports throttling.
+
+"""
+
+__copyright__ = "2010 mFabrik Research Oy"
+__author__ = "Mikko Ohtamaa <mikko@mfabrik.com>"
+__license__ = "GPL"
+__docformat__ = "Epytext"
+
+import datetime
+import threading
+import time
+
+from core import ZohoException
+
+#: Zoho error code for too many calls in a short period
+RATE_LIMIT_EXCEEDED = 4820
+
+#: Zoho error code for exhausted daily API call quota
+DAILY_LIMIT_EXCEEDED = 4421
+
+THROTTLE_CODES = (RATE_LIMIT_EXCEEDED, DAILY_LIMIT_EXCEEDED)
+
+
+class RateLimiter(object):
+    """ Thread-safe token bucket limiting the API call rate.
+
+    When Zoho reports throttling, all calls are paused for throttle_pause
+    seconds and the rate is halved. The rate recovers linearly back to
+    calls_per_minute in recovery_time seconds.
+    """
+
+    def __init__(self, calls_per_minute=None, daily_limit=None, burst=None,
+                 throttle_pause=60.0, recovery_time=300.0):
+        """
+        @param calls_per_minute: Sustained call rate. None does not limit the rate.
+
+        @param daily_limit: Maximum number of calls per day. None does not limit.
+
+        @param burst: Number of calls which can be made back to back. Default is one second worth of calls.
+
+        @param throttle_pause: Seconds to stop calling after Zoho has throttled us
+
+        @param recovery_time: Seconds to recover from halved rate back to full rate
+        """
+        self.calls_per_minute = calls_per_minute
+        self.daily_limit = daily_limit
+        self.throttle_pause = throttle_pause
+        self.recovery_time = recovery_time
+
+        if burst is None and calls_per_minute:
+            burst = max(1.0, calls_per_minute / 60.0)
+        self.burst = burst
+
+        self.tokens = burst
+        self.rate_factor = 1.0
+        self.paused_until = 0
+        self.updated = time.time()
+
+        self.day = datetime.date.today()
+        self.daily_calls = 0
+        self.daily_exhausted = False
+
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        self.updated = now
+
+        if self.rate_factor < 1.0:
+            self.rate_factor = min(1.0, self.rate_factor + 0.5 * elapsed / self.recovery_time)
+
+        if self.calls_per_minute:
+            rate = self.calls_per_minute * self.rate_factor / 60.0
+            self.tokens = min(self.burst, self.tokens + elapsed * rate)
+
+        today = datetime.date.today()
+        if today != self.day:
+            self.day = today
+            self.daily_calls = 0
+            self.daily_exhausted = False
+
+    def acquire(self):
+        """ Wait until a call is allowed.
+
+        @raise: ZohoException if the daily budget has been used
+        """
+        while True:
+            self._lock.acquire()
+            try:
+                now = time.time()
+                self._refill(now)
+
+                if self.daily_exhausted or (self.daily_limit is not None and self.daily_calls >= self.daily_limit):
+                    raise ZohoException("Daily Zoho API call budget used", DAILY_LIMIT_EXCEEDED)
+
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                elif not self.calls_per_minute:
+                    self.daily_calls += 1
+                    return
+                elif self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    self.daily_calls += 1
+                    return
+                else:
+                    rate = self.calls_per_minute * self.rate_factor / 60.0
+                    delay = (1.0 - self.tokens) / rate
+            finally:
+                self._lock.release()
+
+            time.sleep(delay)
+
+    def throttled(self, code=RATE_LIMIT_EXCEEDED):
+        """ Slow down after Zoho has rejected a call because of limits.
+
+        @param code: Zoho error code
+        """
+        self._lock.acquire()
+        try:
+            if code == DAILY_LIMIT_EXCEEDED:
+                self.daily_exhausted = True
+            else:
+                self.paused_until = time.time() + self.throttle_pause
+                self.rate_factor = max(0.1, self.rate_factor / 2)
+                self.tokens = 0
+        finally:
+            self._lock.release()
+
+    def report_error(self, exception):
+        """ Inspect a failed call and slow down if it was throttled.
+
+        @param exception: ZohoException
+        """
+        if getattr(exception, "code", None) in THROTTLE_CODES:
+            self.throttled(exception.code)
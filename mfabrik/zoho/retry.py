@@ -0,0 +1,116 @@
+"""
+
+    Retrying failed Zoho API calls.
+
+    Network hiccups, HTTP 5xx responses and Zoho internal errors (code 4500)
+    are usually transient. L{RetryPolicy} decides which failures are
+    worth another attempt and how long to wait between the attempts.
+
+"""
+
+__copyright__ = "2010 mFabrik Research Oy"
+__author__ = "Mikko Ohtamaa <mikko@mfabrik.com>"
+__license__ = "GPL"
+__docformat__ = "Epytext"
+
+import httplib
+import random
+import socket
+import time
+import urllib2
+
+from core import ZohoException, logger
+from pool import ConnectError
+from ratelimit import RATE_LIMIT_EXCEEDED
+
+#: Zoho error code for "Problem occured while processing the request"
+INTERNAL_ERROR = 4500
+
+#: HTTP statuses telling that the server did not process the request
+REJECTED_STATUSES = (429, 503)
+
+
+class RetryPolicy(object):
+    """ Exponential backoff with full jitter.
+
+    A call is idempotent if repeating it does no harm, like reads, updates
+    and deletes. Idempotent calls are retried after any transient failure.
+    Other calls, like inserts, are retried only if the request certainly
+    was not processed: the connection could not be opened, the server
+    rejected the request as overloaded or Zoho throttled the call.
+    """
+
+    def __init__(self, max_attempts=3, backoff=0.5, max_backoff=30.0, deadline=None):
+        """
+        @param max_attempts: Total number of attempts, including the first one
+
+        @param backoff: Base delay in seconds. The delay before attempt n is
+            a random value between 0 and backoff * 2 ** n.
+
+        @param max_backoff: Maximum delay between two attempts in seconds
+
+        @param deadline: Give up if the call has not succeeded in this many seconds. None waits forever.
+        """
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+
+    def get_delay(self, attempt):
+        """
+        @param attempt: Number of failed attempts so far, starting from 1
+
+        @return: Seconds to sleep before the next attempt
+        """
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def is_retryable(self, exception, idempotent):
+        """ Classify a failure.
+
+        @param exception: Exception raised by the call
+
+        @param idempotent: Whether the call can be safely repeated
+
+        @return: True if the call should be attempted again
+        """
+        if isinstance(exception, ZohoException):
+            if exception.code == RATE_LIMIT_EXCEEDED:
+                return True
+            return idempotent and exception.code == INTERNAL_ERROR
+
+        if isinstance(exception, urllib2.HTTPError):
+            if exception.code in REJECTED_STATUSES:
+                return True
+            return idempotent and exception.code >= 500
+
+        if isinstance(exception, ConnectError):
+            return True
+
+        if isinstance(exception, (socket.error, httplib.HTTPException)):
+            return idempotent
+
+        return False
+
+    def call(self, func, idempotent=False):
+        """ Call func() until it succeeds or the policy gives up.
+
+        @param idempotent: Whether the call can be safely repeated
+
+        @return: Tuple (return value of func, number of retries)
+        """
+        start = time.time()
+        attempt = 0
+        while True:
+            try:
+                return func(), attempt
+            except Exception, e:
+                attempt += 1
+                if attempt >= self.max_attempts or not self.is_retryable(e, idempotent):
+                    raise
+
+                delay = self.get_delay(attempt)
+                if self.deadline is not None and time.time() - start + delay > self.deadline:
+                    raise
+
+                logger.warn("Retrying Zoho API call in %.1f seconds after error: %s" % (delay, e))
+                time.sleep(delay)
@@ -20,7 +20,9 @@ except ImportError:
     except ImportError:
         raise RuntimeError("XML library not available:  no etree, no lxml")
    
-from core import Connection, ZohoException, decode_json
+from core import Connection, ZohoException, flatten_row
+from serializer import XMLSerializer
+from workers import WorkerPool, chunked, iter_pages
 
 class SUPPORT(Connection):
     """ Zoho Support APIs mapped to Python """
@@ -28,13 +30,25 @@ class SUPPORT(Connection):
     """ Define the standard parameter for the XML data """
     parameter_xml = 'xml'
 
+    """ Where the API lives, can be overridden with api_url parameter """
+    api_url = "https://support.zoho.com"
+
+    """ Serializes the XML payloads, Support uses lowercase field elements """
+    serializer = XMLSerializer("fl")
+
+    """ Maximum number of rows sent in one addrecords call """
+    max_rows_per_call = 100
+
     def get_service_name(self):
         """ Called by base class """
         return "ZohoSupport"
 
-    def add_records(self, records, department, portal, extra_post_parameters={}):
+    def add_records(self, records, department, portal, extra_post_parameters={}, chunk_size=None, max_workers=4):
         """ 
-            Submits a new support request to Zoho Support 
+            Submits new support requests to Zoho Support 
+
+            More records than fit in one call are split to chunks, which are
+            sent in parallel, like with L{add_records_bulk}.
 
             @param records: List of dictionaries. Dictionary content is directly mapped to 
             <FL> XML parameters as described in Zoho Support API.
@@ -45,31 +59,29 @@ class SUPPORT(Connection):
 
             @param extra_post_parameters: Parameters appended to the HTTP POST call. 
             Described in Zoho Support API.
-        
-            @return: List of record ids which were created by add recoreds
 
-        """
-        self.ensure_opened()
+            @param chunk_size: Records per API call. Default is max_rows_per_call.
+
+            @param max_workers: Number of API calls in flight at once
         
-        root = Element("requests")
+            @return: List of record ids which were created by add recoreds.
+            If the records were split to several calls, a failed call does not
+            stop the others, and the list has the exception which failed the
+            chunk in place of each of its records.
+
+            @raise: ZohoException if the records fit in one call and it failed
 
-        # Row counter
-        no = 1
+        """
+        if len(records) <= (chunk_size or self.max_rows_per_call):
+            return self._add_chunk(records, department, portal, extra_post_parameters)
 
-        for record in records:
-            row = Element("row", no=str(no))
-            root.append(row)
+        return self.add_records_bulk([(department, portal, records)], extra_post_parameters, chunk_size, max_workers)[0]
 
-            assert type(record) == dict, "Records must be dictionaries inside a list, got:" + str(type(record))
+    def _add_chunk(self, records, department, portal, extra_post_parameters):
+        """ Do one addrecords call """
+        self.ensure_opened()
         
-            for key, value in record.items():
-                # <FL val="Lead Source">Web Download</FL>
-                # <FL val="First Name">contacto 1</FL>
-                fl = Element("fl", val=key)
-                fl.text = value
-                row.append(fl)
-                
-            no += 1
+        xml = self.serializer.serialize("requests", records)
 
         post = {
             'department': department,
@@ -78,8 +90,128 @@ class SUPPORT(Connection):
 
         post.update(extra_post_parameters)
         
-        response = self.do_xml_call("https://support.zoho.com/api/xml/requests/addrecords", post, root)
+        response = self.xml_request(self.api_url + "/api/xml/requests/addrecords", post, xml, check="xml")
 
-        self.check_successful_xml(response)
-        
-        return self.get_inserted_records(response)
\ No newline at end of file
+        return response.get_inserted_records()
+
+    def add_records_bulk(self, batches, extra_post_parameters={}, chunk_size=None, max_workers=4):
+        """ 
+            Submit requests to several departments and portals at once.
+
+            Records of all batches are split to chunks, and the chunks are sent in
+            parallel. A failing chunk does not stop the others, and the results
+            of the chunks which went in are always returned.
+
+            Connections are taken from the connection pool, so its maxsize
+            should be at least max_workers.
+
+            @param batches: List of (department, portal, records) tuples, see L{add_records}
+
+            @param chunk_size: Records per API call. Default is max_rows_per_call.
+
+            @param max_workers: Number of API calls in flight at once
+
+            @return: List with a list for each batch, in the order of its records,
+            with the created record details, or the exception which failed the
+            chunk of the record
+        """
+        chunks = []
+        for no, (department, portal, records) in enumerate(batches):
+            for chunk in chunked(records, chunk_size or self.max_rows_per_call):
+                chunks.append((no, department, portal, chunk))
+
+        def add(department, portal, chunk):
+            inserted = self._add_chunk(chunk, department, portal, extra_post_parameters)
+            if len(inserted) != len(chunk):
+                raise ZohoException("Got %d results for %d added records" % (len(inserted), len(chunk)))
+            return inserted
+
+        inserted = [[] for batch in batches]
+        pool = WorkerPool(max_workers)
+        try:
+            futures = [(no, chunk, pool.submit(add, department, portal, chunk)) for no, department, portal, chunk in chunks]
+            for no, chunk, future in futures:
+                error = future.exception()
+                if error is None:
+                    inserted[no].extend(future.result())
+                else:
+                    inserted[no].extend([error] * len(chunk))
+        finally:
+            pool.shutdown()
+
+        return inserted
+
+    def get_records(self, department, portal, selectfields=None, parameters={}, stream=False):
+        """ 
+            Read one page of support requests.
+
+            @param department: Name of the department of the requests
+
+            @param portal: Portal name
+
+            @param selectfields: Fields to read, like requests(Subject,Status).
+            By default the fields Zoho returns by default.
+
+            @param parameters: Extra parameters, like fromindex and toindex for the page.
+            Described in Zoho Support API.
+
+            @param stream: Parse the response incrementally while it is being read from
+            the network and return a generator instead of a list
+
+            @return: List of request dictionaries
+        """
+        self.ensure_opened()
+
+        post = {
+            'department': department,
+            'portal': portal
+        }
+
+        if selectfields is not None:
+            post['selectfields'] = selectfields
+
+        post.update(parameters)
+
+        url = self.api_url + "/api/json/requests/getrecords"
+
+        if stream:
+            return self.stream_records(url, post)
+
+        response = self.request(url, post, check="json", idempotent=True)
+
+        return self._parse_json_response(response.json())
+
+    def _parse_json_response(self, data):
+        response = data["response"]
+        if response.get("nodata"):
+            return []
+
+        # Result is keyed by the module name, which we do not need
+        result = response["result"].values()[0]
+        rows = result["row"]
+        # If single item returned
+        if type(rows) == dict:
+            rows = [rows]
+        return [flatten_row(row) for row in rows]
+
+    def iter_records(self, department, portal, selectfields=None, parameters={}, page_size=100):
+        """ 
+            Iterate over all support requests of a department, page by page.
+
+            The next page is fetched in the background while the caller
+            processes the current one, so at most two pages are held in memory.
+
+            @param parameters: See L{get_records}. fromindex and toindex are set by the iterator.
+
+            @param page_size: Requests per API call
+
+            @return: Generator yielding one request dictionary at a time
+        """
+
+        def fetch(number):
+            page_parameters = parameters.copy()
+            page_parameters["fromindex"] = number * page_size + 1
+            page_parameters["toindex"] = (number + 1) * page_size
+            return self.get_records(department, portal, selectfields, page_parameters)
+
+        return iter_pages(fetch, page_size)
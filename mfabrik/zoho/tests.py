@@ -89,9 +89,11 @@ class TestCRM(unittest.TestCase):
         
         records = self.crm.get_records()
         
-        for record in records:
-            if record["First Name"] == "TEST":
-                self.crm.delete_record(record["LEADID"])
+        ids = [record["LEADID"] for record in records if record["First Name"] == "TEST"]
+        results = self.crm.delete_records(ids)
+        
+        failed = [id for id, error in results.items() if error is not None]
+        self.assertEqual(failed, [], "Could not delete test leads %s: %s" % (failed, [str(results[id]) for id in failed]))
         
         
     def test_insert_lead(self):
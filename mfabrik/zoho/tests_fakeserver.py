@@ -0,0 +1,1010 @@
+# -*- coding: utf-8 -*-
+"""
+
+    Offline unit tests against the local fake Zoho server.
+
+    Unlike tests.py, these do not need Zoho credentials::
+
+        python -m unittest mfabrik.zoho.tests_fakeserver
+
+"""
+
+__copyright__ = "2010 mFabrik Research Oy"
+__author__ = "Mikko Ohtamaa <mikko@mfabrik.com>"
+__license__ = "GPL"
+__docformat__ = "Epytext"
+
+import csv
+import errno
+import httplib
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import urllib2
+
+from StringIO import StringIO
+
+from asynchronous import AsyncCRM, AsyncSupport
+from cache import LRUCache
+from crm import CRM, build_xml
+from core import ZohoException, simplejson, tostring
+from dedup import BloomDedupIndex, DedupIndex, insert_new_records
+from fakeserver import FakeZohoServer
+from export import Exporter
+from importer import Importer, read_records
+from lookup import RecordLoader
+from metrics import MetricsCollector
+from mirror import Mirror
+from serializer import XMLSerializer
+from support import SUPPORT
+from tickets import FileTicketCache
+from pool import ConnectError, ConnectionPool, default_pool
+from ratelimit import RateLimiter
+from retry import RetryPolicy
+from writer import BufferedWriter, CRMWriter, SupportWriter, _close_at_exit, _open_writers
+
+
+class TestSerializer(unittest.TestCase):
+    """ Fast XML serializer gives the same output as ElementTree """
+
+    def assertSame(self, records, module="Leads"):
+        self.assertEqual(XMLSerializer().serialize(module, records), tostring(build_xml(module, records)))
+
+    def test_escaping(self):
+        self.assertSame([{
+            u"First Name": u"ÅÄÖ € \U0001F600",
+            u"Quote\"\n<&>": u"a & b < c > d \" ' \n \t \r",
+            "Bytes": "plain",
+        }])
+
+    def test_values(self):
+        self.assertSame([{"Empty": "", "None": None, "Number": 5, "Float": 1.5, "Zero": 0, "Bool": False}, {}, {"A": "b"}])
+
+    def test_empty(self):
+        self.assertSame([])
+
+    def test_attached_module(self):
+        self.assertSame([{
+            "Subject": "Quote",
+            "Product Details": {"product": [{"Product Id": "123", "Quantity": "2", "Empty": ""}, {}]},
+            "No Products": {"product": []},
+        }], "Quotes")
+
+    def test_errors(self):
+        self.assertRaises(UnicodeDecodeError, XMLSerializer().serialize, "Leads", [{"Name": "\xc3\x85"}])
+        self.assertRaises(TypeError, XMLSerializer().serialize, "Leads", [{5: "x"}])
+
+
+class FakeServerTestCase(unittest.TestCase):
+    """ Run a fresh fake Zoho server for each test """
+
+    def setUp(self):
+        self.server = FakeZohoServer()
+        self.server.start()
+        self.pool = ConnectionPool(maxsize=8)
+        self.crm = CRM(authtoken="fake", scope="crmapi", api_url=self.server.url, pool=self.pool)
+
+    def tearDown(self):
+        self.pool.clear()
+        self.server.stop()
+
+
+class TestCRM(FakeServerTestCase):
+    """ CRM calls against the fake server """
+
+    def test_insert_and_get(self):
+        lead = {
+            u"First Name" : u"TEST",
+            u"Last Name" : u"UNIT TEST ÅÄÖ",
+            u"Company" : u"mFabrik Research Oy"
+        }
+        inserted = self.crm.insert_records("Leads", [lead])
+        self.assertEqual(len(inserted), 1)
+
+        record = self.crm.get_record_by_id(inserted[0]["Id"])
+        self.assertEqual(record["Last Name"], u"UNIT TEST ÅÄÖ")
+
+    def test_insert_missing_field(self):
+        try:
+            self.crm.insert_records("Leads", [{"First Name" : "Who?"}])
+            raise AssertionError("Should not be reached")
+        except ZohoException, e:
+            self.assertEqual(e.code, 4401)
+
+    def test_insert_bulk(self):
+        leads = [{"Last Name": "Last%d" % i, "Company": "Company"} for i in range(250)]
+        inserted = self.crm.insert_records_bulk("Leads", leads, max_workers=3)
+
+        self.assertEqual(self.server.requests["insertRecords"], 3)
+        ids = [int(record["Id"]) for record in inserted]
+        self.assertEqual(len(ids), 250)
+        # Chunks are inserted in parallel, but results are in input order
+        stored = dict([(record["LEADID"], record["Last Name"]) for record in self.server.store.records("Leads")])
+        self.assertEqual([stored[str(id)] for id in ids], [lead["Last Name"] for lead in leads])
+
+    def test_insert_bulk_partial_failure(self):
+        leads = [{"Last Name": "Last%d" % i, "Company": "Company"} for i in range(250)]
+        self.server.fail_next()
+        results = self.crm.insert_records_bulk("Leads", leads, max_workers=1)
+
+        failed = [result for result in results if isinstance(result, ZohoException)]
+        self.assertEqual(len(failed), 100)
+        self.assertEqual(failed[0].code, 4500)
+        # Ids of the chunks which went in are not lost
+        inserted = [result["Id"] for result in results if not isinstance(result, Exception)]
+        self.assertEqual(len(inserted), 150)
+        self.assertEqual(len(self.server.store.records("Leads")), 150)
+
+    def test_iter_records(self):
+        self.server.seed("Leads", 450)
+        ids = [record["LEADID"] for record in self.crm.iter_records(page_size=200)]
+        self.assertEqual(len(ids), 450)
+        self.assertEqual(len(set(ids)), 450)
+        self.assertEqual(self.server.requests["getRecords"], 3)
+
+    def test_stream_matches_list(self):
+        self.server.seed("Leads", 150)
+        parameters = {"fromIndex": 1, "toIndex": 200}
+        self.assertEqual(list(self.crm.get_records(parameters=parameters, stream=True)),
+                         self.crm.get_records(parameters=parameters))
+
+    def test_update_and_delete_records(self):
+        ids = [record["LEADID"] for record in self.server.seed("Leads", 5)]
+
+        results = self.crm.update_records("Leads", dict([(id, {"Company": "Updated"}) for id in ids[:3]] + [("0", {"Company": "X"})]))
+        self.assertEqual(results[ids[0]]["Id"], ids[0])
+        self.assertTrue(isinstance(results["0"], ZohoException))
+        self.assertEqual(self.crm.get_record_by_id(ids[1])["Company"], "Updated")
+
+        results = self.crm.delete_records(ids[:4], chunk_size=2)
+        self.assertEqual(results, dict([(id, None) for id in ids[:4]]))
+        self.assertEqual(self.server.requests["deleteRecords"], 2)
+        self.assertEqual(len(self.server.store.records("Leads")), 1)
+
+    def test_other_module(self):
+        ids = [record["CONTACTID"] for record in self.server.seed("Contacts", 3)]
+        self.assertEqual(self.crm.get_record_by_id(ids[1], "Contacts")["CONTACTID"], ids[1])
+        self.assertEqual(len(self.crm.search_records("(Company|starts with|Company)", "All", module="Contacts")), 3)
+        self.crm.delete_record(ids[0], module="Contacts")
+        self.assertEqual(len(self.server.store.records("Contacts")), 2)
+
+    def test_compact(self):
+        ids = [record["LEADID"] for record in self.server.seed("Leads", 20)]
+        self.crm.update_record("Leads", ids[3], {"Phone": "555"})
+
+        records = self.crm.get_records("All", {"fromIndex": 1, "toIndex": 20}, compact=True)
+        self.assertEqual(len(records), 20)
+        self.assertEqual(records.to_dicts(), self.crm.get_records("All", {"fromIndex": 1, "toIndex": 20}))
+
+        # Field seen in one record only
+        self.assertEqual(records[3]["Phone"], "555")
+        self.assertFalse("Phone" in records[0])
+        self.assertEqual(records[0].get("Phone"), None)
+        self.assertRaises(KeyError, lambda: records[0]["Phone"])
+        self.assertEqual(records.column("Phone")[2:5], [None, "555", None])
+        self.assertEqual([row["LEADID"] for row in records], ids)
+
+    def test_connections_reused(self):
+        self.server.seed("Leads", 1)
+        for i in range(10):
+            self.crm.get_records()
+        self.assertEqual(self.pool.stats()["new_connections"], 1)
+        self.assertEqual(self.pool.stats()["hits"], 9)
+
+    def test_dropped_connection_resent(self):
+        self.crm.get_records()
+        self.server.fail_next(status=None)
+        self.assertEqual(self.crm.get_records(), [])
+        self.assertEqual(self.server.requests["getRecords"], 3)
+        self.assertEqual(self.pool.stats()["new_connections"], 2)
+
+    def test_timeout_not_resent(self):
+        crm = CRM(authtoken="fake", scope="crmapi", api_url=self.server.url, pool=ConnectionPool(timeout=0.2))
+        crm.get_records()
+        self.server.latency = 0.5
+        self.assertRaises(socket.timeout, crm.insert_records, "Leads", [{"Last Name": "Once", "Company": "Slow"}])
+        time.sleep(0.5)
+        self.assertEqual(self.server.requests["insertRecords"], 1)
+        self.assertEqual(len(self.server.store.records("Leads")), 1)
+
+
+    def test_truncated_response_released(self):
+        crm = CRM(authtoken="fake", scope="crmapi", api_url=self.server.url, pool=ConnectionPool(maxsize=1, timeout=5))
+        self.server.seed("Leads", 10)
+        self.server.truncate_next()
+        self.assertRaises(httplib.IncompleteRead, crm.get_records)
+        self.assertEqual(crm.pool.stats()["active"], 0)
+        self.assertEqual(len(crm.get_records()), 10)
+        self.assertEqual(crm.pool.stats()["new_connections"], 2)
+
+
+class FlakyPool(ConnectionPool):
+    """ Connection pool failing to connect the first times """
+
+    def __init__(self, failures=1, **kwargs):
+        ConnectionPool.__init__(self, **kwargs)
+        self.failures = failures
+
+    def _open(self, scheme, netloc):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectError(errno.ECONNREFUSED, "Connection refused")
+        return ConnectionPool._open(self, scheme, netloc)
+
+
+class TestRetry(FakeServerTestCase):
+    """ Retrying failed calls """
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.crm = CRM(authtoken="fake", scope="crmapi", api_url=self.server.url, pool=self.pool,
+                       retry_policy=RetryPolicy(max_attempts=3, backoff=0.001))
+        self.lead = {"Last Name": "Retry", "Company": "Retry"}
+
+    def test_read_retried(self):
+        self.server.seed("Leads", 1)
+        self.server.fail_next()
+        self.assertEqual(len(self.crm.get_records()), 1)
+        self.assertEqual(self.server.requests["getRecords"], 2)
+
+    def test_read_gives_up(self):
+        self.server.fail_next(3)
+        self.assertRaises(ZohoException, self.crm.get_records)
+        self.assertEqual(self.server.requests["getRecords"], 3)
+
+    def test_insert_not_retried(self):
+        self.server.fail_next()
+        self.assertRaises(ZohoException, self.crm.insert_records, "Leads", [self.lead])
+        self.server.fail_next(status=500, message="Internal server error")
+        self.assertRaises(urllib2.HTTPError, self.crm.insert_records, "Leads", [self.lead])
+        self.assertEqual(self.server.requests["insertRecords"], 2)
+
+    def test_insert_retried_when_rejected(self):
+        self.server.fail_next(status=429, message="Too many requests")
+        self.crm.insert_records("Leads", [self.lead])
+        self.assertEqual(self.server.requests["insertRecords"], 2)
+        self.assertEqual(len(self.server.store.records("Leads")), 1)
+
+    def test_insert_retried_when_not_connected(self):
+        crm = CRM(authtoken="fake", scope="crmapi", api_url=self.server.url, pool=FlakyPool(),
+                  retry_policy=RetryPolicy(backoff=0.001))
+        crm.insert_records("Leads", [self.lead])
+        self.assertEqual(self.server.requests["insertRecords"], 1)
+        self.assertEqual(len(self.server.store.records("Leads")), 1)
+
+    def test_deadline(self):
+        crm = CRM(authtoken="fake", scope="crmapi", api_url=self.server.url, pool=self.pool,
+                  retry_policy=RetryPolicy(max_attempts=10, backoff=0.001, deadline=0.5))
+        self.server.latency = 0.2
+        self.server.fail_next(10)
+        start = time.time()
+        self.assertRaises(ZohoException, crm.get_records)
+        # Attempts ending at 0.2 and 0.4 seconds were retried, the third one passed the deadline
+        self.assertEqual(self.server.requests["getRecords"], 3)
+        self.assertTrue(time.time() - start < 1.0)
+
+
+class TestRateLimiter(FakeServerTestCase):
+    """ Client side rate limiting """
+
+    def get_crm(self, **kwargs):
+        return CRM(authtoken="fake", scope="crmapi", api_url=self.server.url, pool=self.pool, rate_limiter=RateLimiter(**kwargs))
+
+    def test_rate(self):
+        crm = self.get_crm(calls_per_minute=600, burst=1)
+        start = time.time()
+        for i in range(6):
+            crm.get_records()
+        # First call uses the burst, the other five wait 0.1 seconds each
+        self.assertTrue(time.time() - start >= 0.45)
+
+    def test_throttled(self):
+        crm = self.get_crm(throttle_pause=0.3)
+        self.server.fail_next(code=4820, message="API call limit exceeded")
+        try:
+            crm.get_records()
+            raise AssertionError("Should not be reached")
+        except ZohoException, e:
+            self.assertEqual(e.code, 4820)
+
+        start = time.time()
+        crm.get_records()
+        self.assertTrue(time.time() - start >= 0.25)
+        self.assertTrue(crm.rate_limiter.rate_factor < 1.0)
+
+    def test_daily_limit(self):
+        crm = self.get_crm(daily_limit=2)
+        crm.get_records()
+        crm.get_records()
+        try:
+            crm.get_records()
+            raise AssertionError("Should not be reached")
+        except ZohoException, e:
+            self.assertEqual(e.code, 4421)
+        self.assertEqual(self.server.requests["getRecords"], 2)
+
+
+class TestCache(FakeServerTestCase):
+    """ Cached record lookups """
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.ids = [record["LEADID"] for record in self.server.seed("Leads", 5)]
+
+    def get_crm(self, **kwargs):
+        return CRM(authtoken="fake", scope="crmapi", api_url=self.server.url, pool=self.pool, cache=LRUCache(**kwargs))
+
+    def test_eviction(self):
+        crm = self.get_crm(maxsize=2, ttl=None)
+        crm.get_record_by_id(self.ids[0])
+        self.assertEqual(crm.get_record_by_id(self.ids[0])["LEADID"], self.ids[0])
+        self.assertEqual(self.server.requests["getRecordById"], 1)
+
+        # Third record pushes out the least recently used one
+        crm.get_record_by_id(self.ids[1])
+        crm.get_record_by_id(self.ids[0])
+        crm.get_record_by_id(self.ids[2])
+        self.assertEqual(self.server.requests["getRecordById"], 3)
+        crm.get_record_by_id(self.ids[0])
+        self.assertEqual(self.server.requests["getRecordById"], 3)
+        crm.get_record_by_id(self.ids[1])
+        self.assertEqual(self.server.requests["getRecordById"], 4)
+
+    def test_ttl(self):
+        crm = self.get_crm(ttl=0.1)
+        crm.get_record_by_id(self.ids[0])
+        crm.get_record_by_id(self.ids[0])
+        self.assertEqual(self.server.requests["getRecordById"], 1)
+        time.sleep(0.15)
+        crm.get_record_by_id(self.ids[0])
+        self.assertEqual(self.server.requests["getRecordById"], 2)
+
+    def test_invalidation(self):
+        crm = self.get_crm()
+        for id in self.ids:
+            crm.get_record_by_id(id)
+
+        crm.update_record("Leads", self.ids[0], {"Company": "Updated"})
+        self.assertEqual(crm.get_record_by_id(self.ids[0])["Company"], "Updated")
+        self.assertEqual(self.server.requests["getRecordById"], 6)
+
+        crm.update_records("Leads", {self.ids[1]: {"Company": "Updated too"}})
+        self.assertEqual(crm.get_record_by_id(self.ids[1])["Company"], "Updated too")
+        self.assertEqual(self.server.requests["getRecordById"], 7)
+
+        crm.delete_record(self.ids[2])
+        crm.delete_records(self.ids[3:4])
+        self.assertEqual(crm.get_record_by_id(self.ids[2]), None)
+        self.assertEqual(crm.get_record_by_id(self.ids[3]), None)
+        self.assertEqual(self.server.requests["getRecordById"], 9)
+
+        # Untouched record still comes from the cache
+        crm.get_record_by_id(self.ids[4])
+        self.assertEqual(self.server.requests["getRecordById"], 9)
+
+
+class TestMetrics(FakeServerTestCase):
+    """ Call observers and metrics collection """
+
+    def test_collect(self):
+        metrics = MetricsCollector()
+        self.crm.add_observer(metrics)
+
+        self.server.seed("Leads", 150)
+        self.crm.get_records(parameters={"fromIndex": 1, "toIndex": 100})
+        self.assertEqual(len(list(self.crm.get_records(parameters={"fromIndex": 1, "toIndex": 200}, stream=True))), 150)
+        self.assertRaises(ZohoException, self.crm.insert_records, "Leads", [{"First Name" : "Who?"}])
+
+        series = metrics.get_series()
+        get_records = series[("getRecords", "Leads")]
+        self.assertEqual(get_records["calls"], 2)
+        self.assertEqual(get_records["rows"], 250)
+        self.assertEqual(get_records["errors"], {})
+        self.assertTrue(get_records["response_bytes"] > 0)
+        self.assertEqual(get_records["network_time"].count, 2)
+
+        self.assertEqual(series[("insertRecords", "Leads")]["errors"], {4401: 1})
+        self.assertEqual(metrics.in_flight, 0)
+
+        text = metrics.prometheus()
+        self.assertTrue('zoho_api_calls_total{endpoint="getRecords",module="Leads"} 2' in text)
+        self.assertTrue('zoho_api_errors_total{endpoint="insertRecords",module="Leads",code="4401"} 1' in text)
+        self.assertTrue('zoho_api_network_seconds_count{endpoint="getRecords",module="Leads"} 2' in text)
+
+    def test_compression(self):
+        metrics = MetricsCollector()
+        crm = CRM(authtoken="fake", scope="crmapi", api_url=self.server.url, pool=self.pool,
+                  observers=[metrics], compression=True, compress_requests=0)
+
+        leads = [{"Last Name": "Last%d" % i, "Company": "Company"} for i in range(100)]
+        self.assertEqual(len(crm.insert_records("Leads", leads)), 100)
+
+        parameters = {"fromIndex": 1, "toIndex": 200}
+        self.assertEqual(crm.get_records(parameters=parameters), self.crm.get_records(parameters=parameters))
+        self.assertEqual(list(crm.get_records(parameters=parameters, stream=True)), self.crm.get_records(parameters=parameters))
+
+        series = metrics.get_series()
+        self.assertTrue(series[("insertRecords", "Leads")]["request_bytes_saved"] > 0)
+        get_records = series[("getRecords", "Leads")]
+        self.assertTrue(get_records["response_bytes_saved"] > get_records["response_bytes"])
+
+    def test_failing_observer(self):
+        class Broken(object):
+            def before_call(self, info):
+                raise RuntimeError("Broken observer")
+            after_call = before_call
+
+        self.crm.add_observer(Broken())
+        self.assertEqual(self.crm.get_records(), [])
+
+
+class TestTickets(FakeServerTestCase):
+    """ Sharing login tickets """
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.tempdir = tempfile.mkdtemp()
+        self.tickets = FileTicketCache(os.path.join(self.tempdir, "tickets.json"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        FakeServerTestCase.tearDown(self)
+
+    def create_crm(self):
+        return CRM(username="user", password="pass", scope="crmapi", api_url=self.server.url,
+                   auth_url=self.server.url + "/login", pool=self.pool, ticket_cache=self.tickets)
+
+    def test_shared_ticket(self):
+        first = self.create_crm()
+        first.open()
+        second = self.create_crm()
+        second.open()
+
+        self.assertEqual(self.server.requests["login"], 1)
+        self.assertEqual(first.ticket, second.ticket)
+
+    def test_stale_ticket(self):
+        first = self.create_crm()
+        first.open()
+        second = self.create_crm()
+        second.open()
+
+        self.server.seed("Leads", 1)
+        self.server.expire_tickets()
+
+        self.assertEqual(len(first.get_records()), 1)
+        self.assertEqual(len(second.get_records()), 1)
+
+        # Second connection picked up the ticket the first one got
+        self.assertEqual(self.server.requests["login"], 2)
+        self.assertEqual(first.ticket, second.ticket)
+
+
+class TestConcurrency(FakeServerTestCase):
+    """ Many threads sharing one connection """
+
+    def test_stress(self):
+        crm = CRM(username="user", password="pass", scope="crmapi", api_url=self.server.url,
+                  auth_url=self.server.url + "/login", pool=self.pool)
+        crm.open()
+
+        errors = []
+        expired = threading.Event()
+
+        def work(thread):
+            try:
+                for i in range(15):
+                    name = "Thread%d-%d" % (thread, i)
+                    id = crm.insert_records("Leads", [{"Last Name": name, "Company": "Stress"}])[0]["Id"]
+
+                    if thread == 0 and i == 5:
+                        self.server.expire_tickets()
+                        expired.set()
+
+                    record = crm.get_record_by_id(id)
+                    self.assertEqual(record["Last Name"], name)
+
+                    crm.update_record("Leads", id, {"Company": name})
+                    self.assertEqual(crm.search_records("(Company|=|%s)" % name)[0]["LEADID"], id)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertTrue(expired.isSet())
+        self.assertEqual(len(self.server.store.records("Leads")), 16 * 15)
+        # Threads hitting the expired ticket logged in only once
+        self.assertEqual(self.server.requests["login"], 2)
+
+
+class TestAsync(FakeServerTestCase):
+    """ Non-blocking clients """
+
+    def test_crm(self):
+        maxsize = default_pool.maxsize
+        crm = AsyncCRM(authtoken="fake", scope="crmapi", api_url=self.server.url, max_concurrency=20)
+        # Own pool, the shared one is left alone
+        self.assertEqual(default_pool.maxsize, maxsize)
+        self.assertEqual(crm.connection.pool.maxsize, 20)
+
+        ids = [record["LEADID"] for record in self.server.seed("Leads", 30)]
+        completed = []
+        futures = [crm.get_record_by_id(id) for id in ids]
+        futures[0].add_done_callback(completed.append)
+        self.assertEqual([future.result(10)["LEADID"] for future in futures], ids)
+        self.assertEqual(completed, [futures[0]])
+
+        self.server.fail_next()
+        self.assertEqual(crm.get_records().exception(10).code, 4500)
+        crm.close()
+        crm.connection.pool.clear()
+
+    def test_given_pool(self):
+        crm = AsyncCRM(authtoken="fake", scope="crmapi", api_url=self.server.url, pool=self.pool, max_concurrency=20)
+        self.assertTrue(crm.connection.pool is self.pool)
+        self.assertEqual(self.pool.maxsize, 8)
+        crm.close()
+
+    def test_support(self):
+        support = AsyncSupport(authtoken="fake", scope="supportapi", api_url=self.server.url, pool=self.pool)
+        inserted = support.add_records([{"Subject": "Async"}], "Sales", "portal").result(10)
+        self.assertEqual(self.server.store.get_module("Requests")[inserted[0]["Id"]]["Subject"], "Async")
+        support.close()
+
+
+class TestImporter(FakeServerTestCase):
+    """ Bulk import with checkpoints """
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.tempdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tempdir, "leads.csv")
+        f = open(self.source, "wb")
+        f.write("Surname,Organization,Ignored\n")
+        for i in range(450):
+            # Every 50th row lacks the mandatory company
+            company = (i % 50) and "Company %d" % i or ""
+            f.write("Last%d,%s,x\n" % (i, company))
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        FakeServerTestCase.tearDown(self)
+
+    def create_importer(self):
+        return Importer(self.crm, "Leads", mapping={"Surname": "Last Name", "Organization": "Company"},
+                        max_workers=3, processes=2,
+                        checkpoint=os.path.join(self.tempdir, "checkpoint"),
+                        report=os.path.join(self.tempdir, "report"))
+
+    def test_resume(self):
+        # Network failure stops the first run
+        self.server.fail_next(status=500, message="Server error")
+        self.assertRaises(Exception, self.create_importer().run, read_records(self.source))
+        first_run = len(self.server.store.records("Leads"))
+        self.assertTrue(first_run < 441)
+
+        stats = self.create_importer().run(read_records(self.source))
+        self.assertTrue(stats["skipped"] > 0)
+
+        names = [record["Last Name"] for record in self.server.store.records("Leads")]
+        self.assertEqual(len(names), 441)
+        self.assertEqual(len(set(names)), 441)
+        self.assertTrue("Ignored" not in self.server.store.records("Leads")[0])
+
+        errors = [simplejson.loads(line) for line in open(os.path.join(self.tempdir, "report"))]
+        errors = [entry for entry in errors if entry["type"] == "error"]
+        self.assertEqual(sorted([entry["row"] for entry in errors]), range(1, 451, 50))
+        self.assertEqual(errors[0]["code"], 4401)
+
+    def test_resume_after_zoho_error(self):
+        # Zoho rejects a whole chunk with a transient error
+        self.server.fail_next(code=4500)
+        self.assertRaises(ZohoException, self.create_importer().run, read_records(self.source))
+
+        stats = self.create_importer().run(read_records(self.source))
+        self.assertEqual(stats["skipped"] + stats["rows"], 450)
+        self.assertEqual(len(self.server.store.records("Leads")), 441)
+
+
+class TestExporter(FakeServerTestCase):
+    """ Parallel export """
+
+    def test_iter_records(self):
+        ids = [record["CONTACTID"] for record in self.server.seed("Contacts", 1050)]
+        exporter = Exporter(self.crm, "Contacts", page_size=100, max_workers=4)
+        self.assertEqual([record["CONTACTID"] for record in exporter.iter_records()], ids)
+
+    def test_empty(self):
+        self.assertEqual(list(Exporter(self.crm, "Contacts").iter_records()), [])
+
+    def test_csv(self):
+        self.server.seed("Leads", 250)
+        exporter = Exporter(self.crm, "Leads", "Leads(Last Name,Company)")
+        output = StringIO()
+        self.assertEqual(exporter.write_csv(output), 250)
+
+        rows = list(csv.reader(StringIO(output.getvalue())))
+        self.assertEqual(rows[0], ["Last Name", "Company"])
+        self.assertEqual(rows[250], ["Last249", "Company 249"])
+
+
+class TestMirror(FakeServerTestCase):
+    """ Local SQLite mirror """
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.tempdir = tempfile.mkdtemp()
+        self.ids = [record["LEADID"] for record in self.server.seed("Leads", 30)]
+        self.mirror = Mirror(self.crm, os.path.join(self.tempdir, "mirror.sqlite"), "Leads", indexes=["Email", "Company"])
+
+    def tearDown(self):
+        self.mirror.close()
+        shutil.rmtree(self.tempdir)
+        FakeServerTestCase.tearDown(self)
+
+    def test_sync(self):
+        self.assertEqual(self.mirror.sync(), (30, 0))
+        self.assertEqual(len(self.mirror), 30)
+        self.assertEqual(self.mirror.get(self.ids[7])["Last Name"], "Last7")
+
+        self.assertEqual([record["LEADID"] for record in self.mirror.find("Email", "lead3@example.com")], [self.ids[3]])
+        self.assertEqual(self.mirror.find("Email", "nobody@example.com"), [])
+        companies = sorted([record["Company"] for record in self.mirror.find_prefix("Company", "Company 1")])
+        self.assertEqual(companies, sorted(["Company 1"] + ["Company %d" % i for i in range(10, 20)]))
+        self.assertRaises(ValueError, self.mirror.find, "Phone", "555")
+
+    def test_incremental(self):
+        self.mirror.sync()
+        self.crm.update_record("Leads", self.ids[0], {"Company": "Changed"})
+        id = self.crm.insert_records("Leads", [{"Last Name": "New", "Company": "New", "Email": "new@example.com"}])[0]["Id"]
+
+        self.mirror.sync()
+        self.assertEqual(len(self.mirror), 31)
+        self.assertEqual(self.mirror.get(self.ids[0])["Company"], "Changed")
+        self.assertEqual(self.mirror.find("Email", "new@example.com")[0]["LEADID"], id)
+        self.assertEqual(self.server.requests["getDeletedRecordIds"], 1)
+
+    def test_deleted(self):
+        self.mirror.sync()
+        self.crm.delete_records(self.ids[:25])
+
+        # More deletions than fit on one page
+        self.assertEqual(self.mirror.sync(page_size=10)[1], 25)
+        self.assertEqual(sorted([record["LEADID"] for record in self.mirror.find_prefix("Company", "")]), sorted(self.ids[25:]))
+        self.assertEqual(self.server.requests["getDeletedRecordIds"], 3)
+
+    def test_full_reload(self):
+        self.mirror.sync()
+        # Gone from Zoho without being listed as deleted
+        del self.server.store.get_module("Leads")[self.ids[5]]
+
+        stored, removed = self.mirror.sync(full=True)
+        self.assertEqual((stored, removed), (29, 1))
+        self.assertEqual(self.mirror.get(self.ids[5]), None)
+
+
+class TestLookup(FakeServerTestCase):
+    """ Batched and coalesced record lookups """
+
+    def test_get_records_by_ids(self):
+        ids = [record["LEADID"] for record in self.server.seed("Leads", 250)]
+        records = self.crm.get_records_by_ids(ids + ids[:10] + ["123"], chunk_size=100)
+        self.assertEqual(sorted(records.keys()), sorted(ids))
+        self.assertEqual(records[ids[42]]["Last Name"], "Last42")
+        self.assertEqual(self.server.requests["getRecordById"], 3)
+
+    def test_loader(self):
+        ids = [record["LEADID"] for record in self.server.seed("Leads", 50)]
+        loader = RecordLoader(self.crm, "Leads", window=0.05)
+
+        errors = []
+        results = {}
+
+        def work(thread):
+            try:
+                # Threads ask for overlapping ids
+                for id in ids[thread:thread + 20] + ["123"]:
+                    results[id] = loader.get(id, timeout=10)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        loader.close()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(results["123"], None)
+        for id in ids[:35]:
+            self.assertEqual(results[id]["LEADID"], id)
+        self.assertTrue(loader.coalesced > 0)
+        self.assertEqual(self.server.requests["getRecordById"], loader.calls)
+        self.assertTrue(loader.calls < loader.lookups / 4)
+
+    def test_get_many(self):
+        ids = [record["LEADID"] for record in self.server.seed("Leads", 250)]
+        loader = RecordLoader(self.crm, "Leads", window=1.0)
+        records = loader.get_many(ids, timeout=10)
+        loader.close()
+        self.assertEqual(records[ids[249]]["Last Name"], "Last249")
+        # Full batches are sent without waiting for the window
+        self.assertEqual(loader.calls, 3)
+
+
+class TestWriter(FakeServerTestCase):
+    """ Write-behind buffered inserts """
+
+    def test_batching(self):
+        writer = CRMWriter(self.crm, "Leads", max_rows=10, max_delay=0.05)
+        futures = []
+        lock = threading.Lock()
+
+        def work(thread):
+            for i in range(25):
+                future = writer.write({"Last Name": "Writer%d-%d" % (thread, i), "Company": "Buffered"})
+                lock.acquire()
+                futures.append(future)
+                lock.release()
+
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        writer.close()
+
+        ids = [future.result(10) for future in futures]
+        self.assertEqual(len(set(ids)), 200)
+        records = self.server.store.get_module("Leads")
+        for id in ids:
+            self.assertEqual(records[id]["Company"], "Buffered")
+        self.assertEqual(writer.rows, 200)
+        self.assertEqual(self.server.requests["insertRecords"], writer.batches)
+        self.assertTrue(writer.batches <= 30)
+
+    def test_row_errors(self):
+        writer = CRMWriter(self.crm, "Leads", max_delay=60)
+        good = writer.write({"Last Name": "Good", "Company": "Buffered"})
+        bad = writer.write({"Last Name": "No company"})
+        callbacks = []
+        writer.write({"Last Name": "Called", "Company": "Buffered"}, callback=callbacks.append)
+        # Flushed without waiting for the delay
+        writer.flush()
+
+        self.assertEqual(self.server.store.get_module("Leads")[good.result()]["Last Name"], "Good")
+        self.assertEqual(bad.exception().code, 4401)
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(writer.failed, 1)
+        writer.close()
+        self.assertRaises(RuntimeError, writer.write, {})
+
+    def test_backpressure(self):
+        release = threading.Event()
+
+        class SlowWriter(BufferedWriter):
+            def send(self, records):
+                release.wait()
+                return range(len(records))
+
+        writer = SlowWriter(max_rows=2, max_buffered=4)
+        for i in range(4):
+            writer.write({})
+        self.assertRaises(RuntimeError, writer.write, {}, timeout=0.1)
+
+        release.set()
+        self.assertEqual(writer.write({}, timeout=10).result(10), 0)
+        writer.close()
+        self.assertEqual(writer.rows, 5)
+
+    def test_failing_callback(self):
+        class ListWriter(BufferedWriter):
+            def send(self, records):
+                return range(len(records))
+
+        def broken(future):
+            raise ValueError("Callback failed")
+
+        writer = ListWriter(max_rows=3, max_delay=60)
+        first = writer.write({}, callback=broken)
+        others = [writer.write({}) for i in range(2)]
+        # The rest of the batch is still resolved
+        self.assertEqual([future.result(10) for future in others], [1, 2])
+        self.assertEqual(first.result(10), 0)
+        writer.close()
+
+    def test_close_at_exit(self):
+        writer = CRMWriter(self.crm, "Leads", max_delay=60)
+        future = writer.write({"Last Name": "Exit", "Company": "Buffered"})
+        self.assertTrue(writer in _open_writers)
+        _close_at_exit()
+        self.assertEqual(self.server.store.get_module("Leads")[future.result(10)]["Last Name"], "Exit")
+        self.assertFalse(writer in _open_writers)
+
+    def test_support(self):
+        support = SUPPORT(authtoken="fake", scope="supportapi", api_url=self.server.url, pool=self.pool)
+        writer = SupportWriter(support, "Sales", "portal", max_rows=5, max_delay=60)
+        futures = [writer.write({"Subject": "Request %d" % i}) for i in range(12)]
+        writer.close()
+
+        records = self.server.store.get_module("Requests")
+        self.assertEqual([records[future.result()]["Subject"] for future in futures], ["Request %d" % i for i in range(12)])
+        self.assertEqual(self.server.requests["addrecords"], 3)
+
+
+class TestDedup(FakeServerTestCase):
+    """ Local duplicate detection """
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.leads = self.server.seed("Leads", 50)
+
+    def get_records(self):
+        records = [{"Last Name": "Again%d" % i, "Company": "Dup", "Email": " LEAD%d@Example.com" % i} for i in range(10)]
+        records += [{"Last Name": "New%d" % i, "Company": "Dup", "Email": "new%d@example.com" % i} for i in range(5)]
+        # Repeated in the batch, and without the identifying field
+        records.append({"Last Name": "New0", "Company": "Dup", "Email": "new0@example.com"})
+        records.append({"Last Name": "No email", "Company": "Dup"})
+        return records
+
+    def test_skip(self):
+        index = DedupIndex(["Email"])
+        self.assertEqual(index.seed(self.crm, "Leads"), 50)
+        self.assertEqual(index.get({"Email": "lead7@example.com"}), self.leads[7]["LEADID"])
+
+        result = insert_new_records(self.crm, "Leads", self.get_records(), index)
+        self.assertEqual(len(result["inserted"]), 6)
+        self.assertEqual(len(result["skipped"]), 11)
+        self.assertEqual(self.server.requests["insertRecords"], 1)
+        self.assertEqual(len(self.server.store.records("Leads")), 56)
+
+        # Inserted records were added to the index
+        result = insert_new_records(self.crm, "Leads", self.get_records()[:-1], index)
+        self.assertEqual(result["inserted"], [])
+        self.assertEqual(self.server.requests["insertRecords"], 1)
+
+    def test_failed_insert(self):
+        index = DedupIndex(["Email"])
+        index.seed(self.crm, "Leads")
+        records = [{"Last Name": "New%d" % i, "Company": "Dup", "Email": "new%d@example.com" % i} for i in range(150)]
+        self.server.fail_next()
+        result = insert_new_records(self.crm, "Leads", records, index, max_workers=1)
+        self.assertEqual(len(result["inserted"]), 50)
+        self.assertEqual(len(result["failed"]), 100)
+        # Only the records which went in are in the index
+        self.assertEqual(len(index), 100)
+        self.assertFalse(result["failed"][0][0] in index)
+
+    def test_update(self):
+        index = DedupIndex(["Email"])
+        index.seed(self.crm, "Leads")
+        result = insert_new_records(self.crm, "Leads", self.get_records(), index, on_duplicate="update")
+        self.assertEqual(len(result["updated"]), 10)
+        self.assertEqual(self.server.store.get_module("Leads")[self.leads[3]["LEADID"]]["Last Name"], "Again3")
+
+    def test_file(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempdir, "leads")
+            index = DedupIndex(["Company", "Last Name"], path)
+            index.seed(self.crm, "Leads")
+            index.close()
+
+            index = DedupIndex(["Company", "Last Name"], path)
+            self.assertEqual(len(index), 50)
+            self.assertEqual(index.get({"Company": "company 4", "Last Name": "Last4"}), self.leads[4]["LEADID"])
+            self.assertEqual(index.get({"Company": "Company 4", "Last Name": "Last5"}), None)
+            index.close()
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_bloom(self):
+        index = BloomDedupIndex(["Email"], capacity=1000)
+        index.seed(self.crm, "Leads")
+        self.assertTrue({"Email": "lead1@example.com"} in index)
+        self.assertTrue(len([i for i in range(1000) if {"Email": "other%d@example.com" % i} in index]) < 10)
+
+        result = insert_new_records(self.crm, "Leads", self.get_records(), index)
+        self.assertEqual(len(result["skipped"]), 11)
+        self.assertRaises(ValueError, insert_new_records, self.crm, "Leads", [], index, on_duplicate="update")
+
+
+class TestSupport(FakeServerTestCase):
+    """ Zoho Support bulk adds and paged reads """
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.support = SUPPORT(authtoken="fake", scope="supportapi", api_url=self.server.url, pool=self.pool)
+
+    def add(self):
+        return self.support.add_records_bulk([
+            ("Sales", "portal", [{"Subject": "Sales %d" % i} for i in range(250)]),
+            ("Helpdesk", "portal", [{"Subject": "Help %d" % i} for i in range(30)]),
+        ])
+
+    def test_add_records_bulk(self):
+        sales, helpdesk = self.add()
+        self.assertEqual(len(sales), 250)
+        self.assertEqual(len(helpdesk), 30)
+        self.assertEqual(self.server.requests["addrecords"], 4)
+
+        records = self.server.store.get_module("Requests")
+        self.assertEqual(records[sales[249]["Id"]]["Subject"], "Sales 249")
+        self.assertEqual(records[helpdesk[0]["Id"]]["Department"], "Helpdesk")
+
+        # Large adds are chunked
+        self.assertEqual(len(self.support.add_records([{"Subject": "x"}] * 150, "Sales", "portal")), 150)
+        self.assertEqual(self.server.requests["addrecords"], 6)
+
+    def test_add_records_bulk_partial_failure(self):
+        self.server.fail_next()
+        sales, helpdesk = self.support.add_records_bulk([
+            ("Sales", "portal", [{"Subject": "Sales %d" % i} for i in range(250)]),
+            ("Helpdesk", "portal", [{"Subject": "Help %d" % i} for i in range(30)]),
+        ], max_workers=1)
+        # The first chunk failed, the others were still sent
+        self.assertEqual(self.server.requests["addrecords"], 4)
+        for result in sales[:100]:
+            self.assertTrue(isinstance(result, ZohoException))
+        self.assertEqual(sales[0].code, 4500)
+        records = self.server.store.get_module("Requests")
+        self.assertEqual(len(records), 180)
+        self.assertEqual(records[sales[100]["Id"]]["Subject"], "Sales 100")
+        self.assertEqual(records[helpdesk[29]["Id"]]["Subject"], "Help 29")
+
+        self.server.fail_next()
+        added = self.support.add_records([{"Subject": "x"}] * 150, "Sales", "portal", max_workers=1)
+        self.assertTrue(isinstance(added[99], ZohoException))
+        self.assertEqual(records[added[100]["Id"]]["Subject"], "x")
+
+    def test_iter_records(self):
+        self.add()
+        subjects = [record["Subject"] for record in self.support.iter_records("Sales", "portal", page_size=100)]
+        # Chunks were added in parallel, in any order
+        self.assertEqual(sorted(subjects), sorted(["Sales %d" % i for i in range(250)]))
+        self.assertEqual(self.server.requests["getrecords"], 3)
+        self.assertEqual(list(self.support.iter_records("Nobody", "portal")), [])
+
+    def test_get_records(self):
+        self.add()
+        records = self.support.get_records("Helpdesk", "portal", "requests(Subject)", {"fromindex": 11, "toindex": 20}, stream=True)
+        records = list(records)
+        self.assertEqual(len(records), 10)
+        self.assertEqual(sorted(records[0].keys()), ["REQUESTID", "Subject"])
+        self.assertEqual(records[0]["Subject"], "Help 10")
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(TestSerializer))
+    suite.addTest(makeSuite(TestCRM))
+    suite.addTest(makeSuite(TestRetry))
+    suite.addTest(makeSuite(TestRateLimiter))
+    suite.addTest(makeSuite(TestCache))
+    suite.addTest(makeSuite(TestMetrics))
+    suite.addTest(makeSuite(TestTickets))
+    suite.addTest(makeSuite(TestConcurrency))
+    suite.addTest(makeSuite(TestAsync))
+    suite.addTest(makeSuite(TestImporter))
+    suite.addTest(makeSuite(TestExporter))
+    suite.addTest(makeSuite(TestMirror))
+    suite.addTest(makeSuite(TestLookup))
+    suite.addTest(makeSuite(TestWriter))
+    suite.addTest(makeSuite(TestDedup))
+    suite.addTest(makeSuite(TestSupport))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
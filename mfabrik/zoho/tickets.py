@@ -0,0 +1,251 @@
+"""
+
+    Shared Zoho login ticket cache.
+
+    Opening a connection with username and password logs in to Zoho
+    accounts and gets a ticket. With a ticket cache, all connections and
+    processes using the same account share one ticket until it expires,
+    instead of logging in again at every start. When the ticket goes
+    stale, only one of them logs in again and the others wait for and
+    reuse the new ticket.
+
+    Example::
+
+        tickets = FileTicketCache("/var/run/zoho/tickets.json")
+        crm = CRM(username="user", password="pass", scope="crmapi", ticket_cache=tickets)
+        crm.open()
+
+    L{FileTicketCache} shares tickets between processes on one host.
+    L{KeyValueTicketCache} shares them through memcached.
+
+"""
+
+__copyright__ = "2010 mFabrik Research Oy"
+__author__ = "Mikko Ohtamaa <mikko@mfabrik.com>"
+__license__ = "GPL"
+__docformat__ = "Epytext"
+
+import os
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows
+    fcntl = None
+
+from core import simplejson
+
+#: Seconds a cached ticket is used before logging in again. Zoho tickets are valid for a week.
+DEFAULT_LIFETIME = 24 * 60 * 60
+
+
+class TicketCache(object):
+    """ Ticket cache interface.
+
+    Absract base class. Subclasses implement the storage and a lock shared
+    by all processes using the storage. This class takes care that only
+    one caller at a time logs in.
+    """
+
+    def __init__(self, lifetime=DEFAULT_LIFETIME):
+        """
+        @param lifetime: Seconds a ticket is used before logging in again
+        """
+        self.lifetime = lifetime
+        # Threads of this process queue here before taking the shared lock
+        self._local_lock = threading.Lock()
+
+    def load(self, key):
+        """ @return: Tuple (ticket, expiry timestamp) or None """
+        raise NotImplementedError("Subclass must implement")
+
+    def store(self, key, ticket, expires):
+        raise NotImplementedError("Subclass must implement")
+
+    def remove(self, key):
+        raise NotImplementedError("Subclass must implement")
+
+    def lock(self, key):
+        """ Wait for the lock shared by all processes using the storage """
+        raise NotImplementedError("Subclass must implement")
+
+    def unlock(self, key):
+        raise NotImplementedError("Subclass must implement")
+
+    def _valid_ticket(self, key):
+        entry = self.load(key)
+        if entry is not None:
+            ticket, expires = entry
+            if expires > time.time():
+                return ticket
+        return None
+
+    def get_ticket(self, key, create):
+        """ Get the cached ticket or log in.
+
+        @param key: Identifies the account and the service
+
+        @param create: Function logging in and returning a new ticket
+
+        @return: Ticket
+        """
+        ticket = self._valid_ticket(key)
+        if ticket is not None:
+            return ticket
+
+        self._local_lock.acquire()
+        try:
+            self.lock(key)
+            try:
+                # Somebody else may have logged in while we were waiting for the lock
+                ticket = self._valid_ticket(key)
+                if ticket is None:
+                    ticket = create()
+                    self.store(key, ticket, time.time() + self.lifetime)
+                return ticket
+            finally:
+                self.unlock(key)
+        finally:
+            self._local_lock.release()
+
+    def invalidate(self, key, ticket):
+        """ Forget a ticket Zoho no longer accepts.
+
+        Nothing is done if the ticket has already been replaced by a new one.
+
+        @param ticket: The stale ticket
+        """
+        self._local_lock.acquire()
+        try:
+            self.lock(key)
+            try:
+                entry = self.load(key)
+                if entry is not None and entry[0] == ticket:
+                    self.remove(key)
+            finally:
+                self.unlock(key)
+        finally:
+            self._local_lock.release()
+
+
+class FileTicketCache(TicketCache):
+    """ Tickets stored in a JSON file, shared by the processes of one host.
+
+    A lock file next to it is locked with flock() while logging in.
+    The file contains credentials, so it is readable by its owner only.
+    """
+
+    def __init__(self, path, lifetime=DEFAULT_LIFETIME):
+        """
+        @param path: Ticket file. Created if it does not exist.
+
+        @param lifetime: Seconds a ticket is used before logging in again
+        """
+        if fcntl is None:
+            raise RuntimeError("FileTicketCache needs fcntl module, which is not available on this platform")
+
+        TicketCache.__init__(self, lifetime)
+        self.path = os.path.abspath(path)
+        self.lock_path = self.path + ".lock"
+        self._lock_file = None
+
+    def _read(self):
+        try:
+            f = open(self.path, "rb")
+        except IOError:
+            return {}
+        try:
+            try:
+                return simplejson.loads(f.read())
+            except ValueError:
+                # Corrupted or empty file, log in again
+                return {}
+        finally:
+            f.close()
+
+    def _write(self, entries):
+        # Replace the file atomically, so that readers never see a half written file
+        fd, temp_path = tempfile.mkstemp(prefix=".tickets", dir=os.path.dirname(self.path))
+        try:
+            os.write(fd, simplejson.dumps(entries))
+        finally:
+            os.close(fd)
+        os.rename(temp_path, self.path)
+
+    def load(self, key):
+        entry = self._read().get(key)
+        if entry is None:
+            return None
+        return entry[0], entry[1]
+
+    def store(self, key, ticket, expires):
+        entries = self._read()
+        entries[key] = [ticket, expires]
+        self._write(entries)
+
+    def remove(self, key):
+        entries = self._read()
+        if key in entries:
+            del entries[key]
+            self._write(entries)
+
+    def lock(self, key):
+        # One lock for all keys, logins are rare
+        self._lock_file = open(self.lock_path, "a")
+        fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+
+    def unlock(self, key):
+        lock_file = self._lock_file
+        self._lock_file = None
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+        lock_file.close()
+
+
+class KeyValueTicketCache(TicketCache):
+    """ Tickets shared through memcached.
+
+    Works with any client having memcache style get(), set(), add() and delete(),
+    like python-memcached or pylibmc. The lock is an entry created with add(),
+    which succeeds in one client only.
+    """
+
+    def __init__(self, client, lifetime=DEFAULT_LIFETIME, prefix="mfabrik.zoho:ticket:", lock_timeout=30, poll_interval=0.1):
+        """
+        @param client: memcache.Client instance
+
+        @param lifetime: Seconds a ticket is used before logging in again
+
+        @param prefix: Key prefix separating our entries from other users of the server
+
+        @param lock_timeout: Seconds after which the lock of a crashed process expires
+
+        @param poll_interval: Seconds between attempts to take the lock
+        """
+        TicketCache.__init__(self, lifetime)
+        self.client = client
+        self.prefix = prefix
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+
+    def load(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return None
+        ticket, expires = simplejson.loads(value)
+        return ticket, expires
+
+    def store(self, key, ticket, expires):
+        self.client.set(self.prefix + key, simplejson.dumps([ticket, expires]), int(self.lifetime))
+
+    def remove(self, key):
+        self.client.delete(self.prefix + key)
+
+    def lock(self, key):
+        while not self.client.add(self.prefix + key + ":lock", "1", self.lock_timeout):
+            time.sleep(self.poll_interval)
+
+    def unlock(self, key):
+        self.client.delete(self.prefix + key + ":lock")
@@ -0,0 +1,296 @@
+"""
+
+    Minimal thread pool and futures for running Zoho API calls concurrently.
+
+    Zoho API calls spend nearly all of their time waiting for the network,
+    so plain threads give good parallelism here.
+
+"""
+
+__copyright__ = "2010 mFabrik Research Oy"
+__author__ = "Mikko Ohtamaa <mikko@mfabrik.com>"
+__license__ = "GPL"
+__docformat__ = "Epytext"
+
+import collections
+import logging
+import sys
+import threading
+import Queue
+
+logger = logging.getLogger("Zoho API")
+
+
+class CancelledError(Exception):
+    """ Future was cancelled before it was run """
+
+
+class Future(object):
+    """ Result of an asynchronous call. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._running = False
+        self._cancelled = False
+        self._callbacks = []
+
+    def done(self):
+        return self._event.isSet()
+
+    def cancelled(self):
+        return self._cancelled
+
+    def cancel(self):
+        """ Cancel the call if it has not started yet.
+
+        @return: True if the future was cancelled
+        """
+        self._lock.acquire()
+        try:
+            if self._running or self._event.isSet():
+                return False
+            self._cancelled = True
+            self._exc_info = (CancelledError, CancelledError(), None)
+        finally:
+            self._lock.release()
+        self._finish()
+        return True
+
+    def set_running(self):
+        """ Mark the future started.
+
+        @return: False if the future was already cancelled and should not be run
+        """
+        self._lock.acquire()
+        try:
+            if self._cancelled:
+                return False
+            self._running = True
+            return True
+        finally:
+            self._lock.release()
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exc_info):
+        """ @param exc_info: Tuple as returned by sys.exc_info() """
+        self._exc_info = exc_info
+        self._finish()
+
+    def _finish(self):
+        self._lock.acquire()
+        try:
+            callbacks = self._callbacks
+            self._callbacks = []
+            self._event.set()
+        finally:
+            self._lock.release()
+
+        for callback in callbacks:
+            self._call(callback)
+
+    def _call(self, callback):
+        # A failing callback must not keep the others from running
+        try:
+            callback(self)
+        except Exception:
+            logger.exception("Future done callback failed")
+
+    def add_done_callback(self, callback):
+        """ Call callback(future) when the future completes.
+
+        If the future is already done the callback is called immediately.
+        Exceptions raised by the callback are logged and ignored.
+        """
+        self._lock.acquire()
+        try:
+            if not self._event.isSet():
+                self._callbacks.append(callback)
+                return
+        finally:
+            self._lock.release()
+        self._call(callback)
+
+    def exception(self, timeout=None):
+        """ @return: Exception raised by the call or None """
+        self._wait(timeout)
+        if self._exc_info:
+            return self._exc_info[1]
+        return None
+
+    def result(self, timeout=None):
+        """ Wait for the call to complete.
+
+        @return: Return value of the call
+
+        @raise: Exception raised by the call, with its original traceback
+        """
+        self._wait(timeout)
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def _wait(self, timeout):
+        self._event.wait(timeout)
+        if not self._event.isSet():
+            raise RuntimeError("Timed out waiting for the result")
+
+
+class WorkerPool(object):
+    """ Bounded pool of daemon worker threads.
+
+    Threads are started lazily, up to max_workers.
+    """
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+    def submit(self, func, *args, **kwargs):
+        """ Schedule func(*args, **kwargs) to be run in a worker thread.
+
+        @return: L{Future}
+        """
+        future = Future()
+
+        self._lock.acquire()
+        try:
+            if self._shutdown:
+                raise RuntimeError("Worker pool has been shut down")
+            self._queue.put((future, func, args, kwargs))
+            if len(self._threads) < self.max_workers:
+                thread = threading.Thread(target=self._work)
+                thread.setDaemon(True)
+                thread.start()
+                self._threads.append(thread)
+        finally:
+            self._lock.release()
+
+        return future
+
+    def map(self, func, items):
+        """ Call func for each item in parallel.
+
+        If any call fails, the calls not yet started are cancelled
+        and the first failure (in input order) is raised.
+
+        @return: List of results in the order of items
+        """
+        futures = [self.submit(func, item) for item in items]
+        try:
+            return [future.result() for future in futures]
+        except:
+            for future in futures:
+                future.cancel()
+            raise
+
+    def shutdown(self, wait=True):
+        """ Stop worker threads after the queued calls have been run """
+        self._lock.acquire()
+        try:
+            self._shutdown = True
+            threads = list(self._threads)
+        finally:
+            self._lock.release()
+
+        for thread in threads:
+            self._queue.put(None)
+
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+
+            future, func, args, kwargs = task
+            if not future.set_running():
+                continue
+
+            try:
+                result = func(*args, **kwargs)
+            except:
+                future.set_exception(sys.exc_info())
+            else:
+                future.set_result(result)
+
+
+def chunked(items, size):
+    """ Split a sequence to lists of at most size items.
+
+    @return: List of lists
+    """
+    items = list(items)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def iter_chunks(items, size):
+    """ Split any iterable to lists of at most size items, lazily.
+
+    Unlike L{chunked}, the items are not all held in memory at once.
+
+    @return: Generator yielding lists
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_pages(fetch, page_size, max_workers=1):
+    """ Iterate over the items of numbered pages, fetching the next pages in the background.
+
+    Pages are fetched ahead while the caller processes the current one,
+    so at most max_workers + 1 pages are held in memory. Items are
+    yielded in page order.
+
+    @param fetch: Function fetch(number) returning the list of items of a page.
+        Pages are numbered from 0. A page shorter than page_size is the last one.
+
+    @param page_size: Items per full page
+
+    @param max_workers: Number of pages fetched at once
+
+    @return: Generator yielding the items
+    """
+    pool = WorkerPool(max_workers)
+    pending = collections.deque()
+    try:
+        next_page = 0
+        while len(pending) < max_workers:
+            pending.append(pool.submit(fetch, next_page))
+            next_page += 1
+
+        while pending:
+            page = pending.popleft().result()
+
+            if len(page) < page_size:
+                # Short page is the last one, the pages after it are empty
+                while pending:
+                    pending.popleft().cancel()
+            else:
+                while len(pending) < max_workers:
+                    pending.append(pool.submit(fetch, next_page))
+                    next_page += 1
+
+            for item in page:
+                yield item
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown()
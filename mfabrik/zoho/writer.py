@@ -0,0 +1,354 @@
+"""
+
+    Write-behind buffering of inserted records.
+
+    Code handling one event at a time, like a message queue consumer,
+    would make an API call per record. A buffered writer takes single
+    records from any number of threads and inserts them in full batches
+    from the background:
+
+        * A batch is sent when it has max_rows records, or max_delay seconds
+          after its first record was written.
+
+        * Writers block when max_buffered records are waiting to be inserted,
+          so a slow or failing Zoho does not fill the memory.
+
+        * Each write returns a future resolving to the id of the inserted record.
+          A row Zoho rejects fails its own future only.
+
+        * Buffered records are sent when the writer is closed, and at the latest
+          when the Python interpreter exits.
+
+    Example::
+
+        writer = CRMWriter(crm, "Leads", max_delay=2.0)
+
+        def on_event(event):
+            future = writer.write({"Last Name": event.name, "Company": event.company})
+
+        ...
+        writer.close()
+
+"""
+
+__copyright__ = "2010 mFabrik Research Oy"
+__author__ = "Mikko Ohtamaa <mikko@mfabrik.com>"
+__license__ = "GPL"
+__docformat__ = "Epytext"
+
+import atexit
+import logging
+import sys
+import threading
+import time
+import weakref
+
+from core import ZohoException
+from workers import Future, WorkerPool
+
+logger = logging.getLogger("Zoho API")
+
+
+class BufferedWriter(object):
+    """ Collect records to batches and send them in the background.
+
+    Absract base class. Subclasses implement L{send}. Thread safe.
+    Statistics are available as attributes:
+
+        * rows: number of records sent
+
+        * failed: number of records which failed
+
+        * batches: number of batches sent
+    """
+
+    def __init__(self, max_rows=100, max_delay=1.0, max_buffered=1000, max_workers=2):
+        """
+        @param max_rows: Records per batch. Zoho accepts 100 at most.
+
+        @param max_delay: Seconds a record may wait for its batch to fill up
+
+        @param max_buffered: Records queued or being sent before writers are blocked
+
+        @param max_workers: Number of batches sent at once
+        """
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.max_buffered = max_buffered
+
+        self.rows = 0
+        self.failed = 0
+        self.batches = 0
+
+        self._cond = threading.Condition()
+        # (record, future) tuples of the next batch
+        self._batch = []
+        self._deadline = None
+        # Records written, but not yet inserted or failed
+        self._buffered = 0
+        # Futures of the batches being sent
+        self._sending = []
+        self._closed = False
+        self._thread = None
+        self._workers = WorkerPool(max_workers)
+
+        _open_writers.add(self)
+
+    def send(self, records):
+        """ Insert a batch of records.
+
+        @param records: List of record dictionaries
+
+        @return: List with the id of each inserted record, or an exception for
+            the records which failed
+
+        @raise: Any exception if the whole batch failed
+        """
+        raise NotImplementedError("Subclass must implement")
+
+    def write(self, record, callback=None, timeout=None):
+        """ Queue a record for inserting.
+
+        Blocks if the buffer is full.
+
+        @param record: Record dictionary
+
+        @param callback: Function called as callback(future) when the record
+            has been inserted or has failed. Called in a background thread.
+
+        @param timeout: Seconds to wait for room in the buffer, or None to wait forever
+
+        @return: L{mfabrik.zoho.workers.Future} resolving to the id of the inserted record
+
+        @raise RuntimeError: Timed out waiting for room in the buffer, or the writer has been closed
+        """
+        future = Future()
+        if callback is not None:
+            future.add_done_callback(callback)
+
+        if timeout is not None:
+            end = time.time() + timeout
+
+        self._cond.acquire()
+        try:
+            while self._buffered >= self.max_buffered and not self._closed:
+                if timeout is None:
+                    self._cond.wait()
+                else:
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        raise RuntimeError("Timed out waiting for room in the write buffer")
+                    self._cond.wait(remaining)
+
+            if self._closed:
+                raise RuntimeError("Writer has been closed")
+
+            self._buffered += 1
+            self._batch.append((record, future))
+
+            if len(self._batch) >= self.max_rows:
+                self._dispatch()
+            elif len(self._batch) == 1:
+                self._deadline = time.time() + self.max_delay
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run)
+                    self._thread.setDaemon(True)
+                    self._thread.start()
+                self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+        return future
+
+    def flush(self):
+        """ Send the buffered records now and wait until they have been inserted.
+
+        Records written by other threads meanwhile may be left in the buffer.
+        """
+        self._cond.acquire()
+        try:
+            if self._batch:
+                self._dispatch()
+            sending = list(self._sending)
+        finally:
+            self._cond.release()
+
+        for future in sending:
+            # Errors are reported to the futures of the records
+            future.exception()
+
+    def close(self):
+        """ Send the buffered records and stop the background threads.
+
+        Writing to a closed writer raises RuntimeError.
+        """
+        self._cond.acquire()
+        try:
+            if self._closed:
+                return
+            self._closed = True
+            if self._batch:
+                self._dispatch()
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+        _open_writers.discard(self)
+
+        if self._thread is not None:
+            self._thread.join()
+        self._workers.shutdown()
+
+    def _dispatch(self):
+        """ Send the current batch. Called with the lock held. """
+        batch = self._batch
+        self._batch = []
+        self._deadline = None
+        self.batches += 1
+
+        future = self._workers.submit(self._send_batch, batch)
+        self._sending.append(future)
+        future.add_done_callback(self._sent)
+
+    def _sent(self, future):
+        self._cond.acquire()
+        try:
+            self._sending.remove(future)
+        finally:
+            self._cond.release()
+
+    def _run(self):
+        """ Send batches when their delay has passed """
+        self._cond.acquire()
+        try:
+            while True:
+                if self._batch:
+                    remaining = self._deadline - time.time()
+                    if remaining <= 0:
+                        self._dispatch()
+                    else:
+                        self._cond.wait(remaining)
+                elif self._closed:
+                    return
+                else:
+                    self._cond.wait()
+        finally:
+            self._cond.release()
+
+    def _send_batch(self, batch):
+        failed = 0
+        try:
+            try:
+                results = self.send([record for record, future in batch])
+                if len(results) != len(batch):
+                    raise ZohoException("Got %d results for %d inserted records" % (len(results), len(batch)))
+            except:
+                exc_info = sys.exc_info()
+                logger.warn("Inserting a batch of %d records failed: %s", len(batch), exc_info[1])
+                failed = len(batch)
+                for record, future in batch:
+                    future.set_exception(exc_info)
+            else:
+                for (record, future), result in zip(batch, results):
+                    if isinstance(result, Exception):
+                        failed += 1
+                        future.set_exception((type(result), result, None))
+                    else:
+                        future.set_result(result)
+        finally:
+            self._cond.acquire()
+            try:
+                self.rows += len(batch)
+                self.failed += failed
+                self._buffered -= len(batch)
+                # Wake up blocked writers
+                self._cond.notifyAll()
+            finally:
+                self._cond.release()
+
+
+#: Writers to close at exit. Weak, so that a writer can still be garbage collected.
+_open_writers = weakref.WeakSet()
+
+
+def _close_at_exit():
+    for writer in list(_open_writers):
+        writer.close()
+
+atexit.register(_close_at_exit)
+
+
+class CRMWriter(BufferedWriter):
+    """ Buffered inserting of Zoho CRM records.
+
+    Rows are inserted with version=4, so that a row Zoho rejects fails
+    its own future only.
+    """
+
+    def __init__(self, crm, module="Leads", extra_post_parameters={}, **kwargs):
+        """
+        @param crm: L{mfabrik.zoho.crm.CRM} connection
+
+        @param module: Zoho CRM module name
+
+        @param extra_post_parameters: Parameters appended to the insertRecords calls
+
+        @param kwargs: Passed to L{BufferedWriter}
+        """
+        BufferedWriter.__init__(self, **kwargs)
+        self.crm = crm
+        self.module = module
+
+        self.post = {
+            "newFormat": 1,
+            "duplicateCheck": 2,
+        }
+        self.post.update(extra_post_parameters)
+        self.post["version"] = 4
+
+    def send(self, records):
+        response = self.crm.insert_xml(self.module, self.crm.serializer.serialize(self.module, records), self.post)
+        results = response.get_row_results()
+
+        ids = []
+        for no in range(len(records)):
+            result = results.get(no + 1, ZohoException("No result for inserted row"))
+            if not isinstance(result, Exception):
+                result = result.get("Id")
+            ids.append(result)
+        return ids
+
+
+class SupportWriter(BufferedWriter):
+    """ Buffered adding of Zoho Support requests.
+
+    Support does not report errors per row, so a failed call fails all
+    records of its chunk.
+    """
+
+    def __init__(self, support, department, portal, extra_post_parameters={}, **kwargs):
+        """
+        @param support: L{mfabrik.zoho.support.SUPPORT} connection
+
+        @param department: Name of the department of the requests
+
+        @param portal: Portal name
+
+        @param extra_post_parameters: Parameters appended to the addrecords calls
+
+        @param kwargs: Passed to L{BufferedWriter}
+        """
+        BufferedWriter.__init__(self, **kwargs)
+        self.support = support
+        self.department = department
+        self.portal = portal
+        self.extra_post_parameters = extra_post_parameters
+
+    def send(self, records):
+        inserted = self.support.add_records(records, self.department, self.portal, self.extra_post_parameters)
+        ids = []
+        for details in inserted:
+            if not isinstance(details, Exception):
+                details = details.get("Id")
+            ids.append(details)
+        return ids
@@ -27,5 +27,8 @@ setup(name='mfabrik.zoho',
       ],
       entry_points="""
       # -*- Entry points: -*-
+      [console_scripts]
+      zoho-import = mfabrik.zoho.importer:main
+      zoho-export = mfabrik.zoho.export:main
       """,
       )